@@ -1,19 +1,43 @@
 #!/usr/env/python3
 import MDAnalysis as mda
+from MDAnalysis.lib.distances import capped_distance
 import numpy as np
 import parmed as pmd
 import pandas as pd
+import hashlib
+import inspect
+import itertools
+import json
+import os
 
 orig_pdb="../1-param-conversion/polk_2mGS_frame_139.pdb"
 tink_xyz="polk_2mGS_frame_139_convert_ff14SB.xyz"
 
-## Atom number for center of active atom shell
-shell_center=8107
-sc2=8149
+## Atom numbers for the centers of the active atom shell, each with the radius
+## (in angstroms) of the shell around it. Add a center for every metal.
+shell_centers=[(8107, 20.0), (8149, 20.0)]
 
-## Did you use the index from VMD for the shell_center? If yes, set True
+## Did you use the index from VMD for the shell_centers? If yes, set True
 VMD_index_shell=False
 
+## Optional JSON (or YAML, with PyYAML) file describing the QM, pseudobond,
+## boundary, and higher basis atoms, which is used instead of editing
+## select_QM and select_higher_basis (see create-reg-regions.json). Leave as
+## None to use those functions.
+region_spec=None
+## Folder for the atom masks compiled from region_spec
+region_cache_dir="region-cache"
+
+## Optional grid of region parameters to try with one loaded system, each a
+## list of values: "radius" (of every shell center), "around" (the distance of
+## every `around` clause in region_spec, or the QM water cutoff in select_QM),
+## and "criteria". Each variant is written to its own folder in sweep_dir, and
+## the region sizes to sweep_dir/sweep-summary.csv. Leave as None for one run.
+## ex: sweep_params={"radius": [15.0, 20.0, 25.0], "around": [3.0, 4.0],
+##  "criteria": ["loose", "tight"]}
+sweep_params=None
+sweep_dir="sweep"
+
 ## Specify AMBER (aka "CHARGES" for LICHEM) or AMOEBA
 electro="AMBER"
 ## Starting criteria -- loose, medium, or tight
@@ -33,7 +57,7 @@ PB1="STO-2G\nSP 2 1.00\n0.9034 1.00 1.00\n0.21310 1.90904 0.57864"
 PB2="try1 1 2\nS Component\n1\n1 7.75 16.49\nP\n1\n1 1.0 0.0"
 
 ##------------- Functions needing modification!!!!
-def select_QM(system, shell_center, sc2):
+def select_QM(system, shell_centers, box, around=4, neighbors=None):
     """
     Select the QM atoms using the atom selection language of MDAnalysis.
 
@@ -41,6 +65,14 @@ def select_QM(system, shell_center, sc2):
     ---------
     system : MDAnalysis.core.universe.Universe
         The Tinker XYZ information mapped onto a PDB topology.
+    shell_centers : list of tuple
+        The (VMD index, radius) of each center of the active atom shell.
+    box : numpy.ndarray or None
+        The box dimensions for the periodic images, from `shell_box`.
+    around : float
+        The cutoff for the QM waters around the metals.
+    neighbors : tuple, optional
+        The shell center neighbors from `shell_neighbors`.
 
     Returns
     -------
@@ -50,8 +82,8 @@ def select_QM(system, shell_center, sc2):
         An atom group of all of the selected pseudobond atoms.
     all_BA : MDAnalysis.core.groups.AtomGroup
         An atom group of all of the selected boundary atoms.
-    all_FR : list
-        A list of all of the frozen atoms.
+    all_FR : numpy.ndarray
+        An array of the indices of all of the frozen atoms.
 
     Examples
     ---------
@@ -135,7 +167,7 @@ def select_QM(system, shell_center, sc2):
     QM_MG_477 = system.select_atoms("resnum 477")
     ## Add extra water!
     QM_WAT_OPO = system.atoms[80892:80895]
-    QM_WAT = system.select_atoms("(around 4 resnum 475) or (around 4 resnum 477)  or (around 4 resnum 476 and name PA) and (resname WAT)")
+    QM_WAT = system.select_atoms("(around {0} resnum 475) or (around {0} resnum 477)  or (around {0} resnum 476 and name PA) and (resname WAT)".format(around))
     QM_WAT = QM_WAT.residues.atoms
     #
     ## Combine the QM atoms. Consider using `|` instead of '+' to make `all_QM`
@@ -177,38 +209,14 @@ def select_QM(system, shell_center, sc2):
     print("There are {} QM, {} pseudobond, and {} boundary atoms.\n".format( \
      len(all_QM), len(all_PB), len(all_BA)))
     #
-    ## Redo the sphere for the unfrozen list
-    my_sphere = system.select_atoms("sphzone 20.0 (index %d)" %shell_center)
-    #
-    ## ADD ANOTHER
-    second_sphere = system.select_atoms("sphzone 20.0 (index %d)" %sc2)
-    my_sphere = my_sphere.union(second_sphere)
-    ## END ADD
-    print_SC = system.atoms[shell_center]
-    #
-    print("You used residue {} {} at atom {} {} for the sphere center.\n"\
-     .format(print_SC.residue.resname, print_SC.residue.resnum, print_SC.id, \
-     print_SC.name))
+    ## Redo the sphere for the unfrozen list, with every center at once
+    my_sphere = select_shell(system, shell_centers, box, neighbors)
     print("There are {} active atoms.\n".format(len(my_sphere)))
     #
-    ## Get a list of all the unfrozen atoms
-    unfrozen = np.concatenate((my_sphere.ix, all_QM.atoms.ix, all_PB.atoms.ix,
-     all_BA.atoms.ix))
-    #
-    print("There are {} unfrozen atoms in my array.\n".format(len(unfrozen)))
-    #
-    tot = len(my_sphere.ix) + len(all_QM.atoms.ix) + len(all_PB.atoms.ix) + \
-     len(all_BA.atoms.ix)
-    #
-    print("There should be {} total unfrozen atoms.\n".format(tot))
-    #
-    ## Get array of all atoms
-    all_ix = system.atoms.ix
-    #
-    ## len(all_ix) - len(unfrozen) doesn't need to match the total number of
-    ## frozen atoms because the sphere will overlap with QM, BA, and PB
-    #
-    all_FR = [i for i in all_ix if i not in unfrozen]
+    ## Mark the regions over all the atoms; the frozen atoms are everything
+    ## that isn't in one of them
+    masks = region_masks(len(system.atoms), all_QM, all_PB, all_BA, my_sphere)
+    all_FR = np.flatnonzero(masks["FR"])
     #
     print("There are {} total frozen atoms.\n".format(len(all_FR)))
     return all_QM, all_BA, all_PB, all_FR
@@ -240,6 +248,398 @@ def select_higher_basis(system):
 
 ##------------- Standard Function definitions (no modification needed)
 
+def shell_box(x_box, y_box, z_box, box_angles):
+    """
+    Builds the box dimensions used for the periodic images in `select_shell`
+    and the `around` clauses of a region spec.
+
+    Parameters
+    ----------
+    x_box, y_box, z_box : float
+        X, Y, and Z box size coordinates from the input PDB.
+    box_angles : tuple of float
+        The alpha, beta, and gamma box angles from the input PDB.
+
+    Returns
+    -------
+    box : numpy.ndarray or None
+        The box as [x, y, z, alpha, beta, gamma], which can be triclinic (like
+        an AMBER truncated octahedron), or `None` if the PDB didn't have a
+        box, so the shell isn't periodic.
+    """
+    if x_box == 0. or y_box == 0. or z_box == 0.:
+        return None
+    return np.array([x_box, y_box, z_box, *box_angles], dtype=np.float32)
+
+def shell_neighbors(system, shell_centers, box, max_radius=None):
+    """
+    Finds every atom within max_radius of the shell centers with a single
+    capped distance search (one neighbor grid over the coordinates), using
+    the minimum image when there is a box.
+
+    Parameters
+    ----------
+    system : MDAnalysis.core.universe.Universe
+        The Tinker XYZ information mapped onto a PDB topology.
+    shell_centers : list of tuple
+        The (VMD index, radius) of each center of the active atom shell.
+    box : numpy.ndarray or None
+        The box dimensions for the periodic images, from `shell_box`.
+    max_radius : float, optional
+        The search radius. Defaults to the largest radius of shell_centers.
+
+    Returns
+    -------
+    pairs : numpy.ndarray
+        The (shell center position, atom index) of each neighbor.
+    distances : numpy.ndarray
+        The distance of each pair.
+    """
+    centers = np.array([center for center, radius in shell_centers])
+    if max_radius is None:
+        max_radius = max(radius for center, radius in shell_centers)
+    coords = system.atoms.positions
+    return capped_distance(coords[centers], coords, float(max_radius),
+     box=box, return_distances=True)
+
+def select_shell(system, shell_centers, box, neighbors=None):
+    """
+    Selects the active atom shell around any number of centers, each with its
+    own radius, from the neighbors of the centers out to at least the largest
+    radius.
+
+    Parameters
+    ----------
+    system : MDAnalysis.core.universe.Universe
+        The Tinker XYZ information mapped onto a PDB topology.
+    shell_centers : list of tuple
+        The (VMD index, radius) of each center of the active atom shell.
+    box : numpy.ndarray or None
+        The box dimensions for the periodic images, from `shell_box`.
+    neighbors : tuple, optional
+        The shell center neighbors from `shell_neighbors`, which are searched
+        for here if not given.
+
+    Returns
+    -------
+    my_sphere : MDAnalysis.core.groups.AtomGroup
+        An atom group of the atoms within the radius of any center.
+    """
+    radii = np.array([radius for center, radius in shell_centers], dtype=float)
+    if neighbors is None:
+        neighbors = shell_neighbors(system, shell_centers, box)
+    pairs, distances = neighbors
+    ## Keep the atoms within the radius of their own center
+    within = distances <= radii[pairs[:, 0]]
+    my_sphere = system.atoms[np.unique(pairs[within, 1])]
+    #
+    for center, radius in shell_centers:
+        print_SC = system.atoms[center]
+        print("You used residue {} {} at atom {} {} for a {} A sphere center.\n"\
+         .format(print_SC.residue.resname, print_SC.residue.resnum, \
+         print_SC.id, print_SC.name, radius))
+    return my_sphere
+
+def region_mask(n_atoms, *groups):
+    """
+    Marks the atoms of one or more atom groups in a boolean mask over every
+    atom index of the system.
+
+    Parameters
+    ----------
+    n_atoms : int
+        The number of atoms in the system.
+    *groups : MDAnalysis.core.groups.AtomGroup
+        The atom groups to mark.
+
+    Returns
+    -------
+    mask : numpy.ndarray
+        A boolean array that is `True` at the index of every atom in groups.
+    """
+    mask = np.zeros(n_atoms, dtype=bool)
+    for group in groups:
+        mask[group.atoms.ix] = True
+    return mask
+
+def region_masks(n_atoms, all_QM, all_PB, all_BA, my_sphere):
+    """
+    Builds the boolean masks of each region, so unions, differences, and
+    overlap checks are single array operations instead of membership tests.
+    Atoms that are in more than one of the QM, pseudobond, and boundary
+    regions are printed as a warning.
+
+    Parameters
+    ----------
+    n_atoms : int
+        The number of atoms in the system.
+    all_QM : MDAnalysis.core.groups.AtomGroup
+        An atom group of all of the selected atoms for the QM region.
+    all_PB : MDAnalysis.core.groups.AtomGroup
+        An atom group of all of the selected pseudobond atoms.
+    all_BA : MDAnalysis.core.groups.AtomGroup
+        An atom group of all of the selected boundary atoms.
+    my_sphere : MDAnalysis.core.groups.AtomGroup
+        An atom group of the active shell of MM atoms.
+
+    Returns
+    -------
+    masks : dict
+        The boolean masks of the "QM", "PB", "BA", "shell" (active shell),
+        "active" (any of those), and "FR" (frozen) atoms.
+    """
+    masks = {"QM": region_mask(n_atoms, all_QM),
+     "PB": region_mask(n_atoms, all_PB), "BA": region_mask(n_atoms, all_BA),
+     "shell": region_mask(n_atoms, my_sphere)}
+    for first, second in (("QM", "PB"), ("QM", "BA"), ("PB", "BA")):
+        overlap = np.flatnonzero(masks[first] & masks[second])
+        if len(overlap) > 0:
+            print("WARNING! The {} and {} regions share the atoms with index {}.\n"\
+             .format(first, second, " ".join(map(str, overlap))))
+    masks["active"] = masks["QM"] | masks["PB"] | masks["BA"] | masks["shell"]
+    masks["FR"] = ~masks["active"]
+    #
+    print("There are {} unfrozen atoms, counting each one once.\n".format(\
+     np.count_nonzero(masks["active"])))
+    return masks
+
+def read_region_spec(region_spec):
+    """
+    Reads the region spec, a JSON file (or YAML, if PyYAML is installed).
+
+    Parameters
+    ----------
+    region_spec : str
+        The path to the region spec.
+
+    Returns
+    -------
+    spec : dict
+        The "QM", "PB", "BA", and "HB" clauses of each region.
+    """
+    with open(region_spec) as spec_in:
+        if region_spec.endswith((".yaml", ".yml")):
+            import yaml
+            spec = yaml.safe_load(spec_in)
+        else:
+            spec = json.load(spec_in)
+    for region in spec:
+        if region not in ("QM", "PB", "BA", "HB"):
+            raise ValueError("Unknown region {} in {}. Use QM, PB, BA, or"
+             " HB.".format(region, region_spec))
+    return spec
+
+def spec_fields(system):
+    """
+    Builds the atom fields that every clause of a region spec is matched
+    against, once for the whole system. Names and residue names are stored as
+    integer codes into their unique values, so each match is an integer
+    comparison.
+
+    Parameters
+    ----------
+    system : MDAnalysis.core.universe.Universe
+        The Tinker XYZ information mapped onto a PDB topology.
+
+    Returns
+    -------
+    fields : dict
+        The "resnum", "bynum", and "index" arrays, and the ("codes",
+        "values") of "name" and "resname".
+    """
+    fields = {"resnum": system.atoms.resnums, "bynum": system.atoms.ids,
+     "index": system.atoms.ix}
+    for key, values in (("name", system.atoms.names),
+     ("resname", system.atoms.resnames)):
+        unique, codes = np.unique(values, return_inverse=True)
+        fields[key] = (codes, {value: i for i, value in enumerate(unique)})
+    return fields
+
+def clause_mask(clause, system, fields, box, plan):
+    """
+    Compiles one clause of a region spec into a boolean mask over the atom
+    indices. A string is an MDAnalysis selection, a list matches any of its
+    clauses, and a dictionary matches all of its keys:
+
+    - "resnum", "resname", "name": a value or list of values
+    - "bynum", "index": an inclusive [first, last] range of TINKER numbers or
+      VMD indices
+    - "around": atoms within this distance of the "of" clause (but not in
+      it), using the minimum image when there is a box
+    - "whole_residues": if true, the whole residues of the matching atoms
+
+    Masks are kept in the plan by their clause, so a clause used by more than
+    one region (or more than once) is only evaluated once.
+
+    Parameters
+    ----------
+    clause : str, list, or dict
+        The clause to match.
+    system : MDAnalysis.core.universe.Universe
+        The Tinker XYZ information mapped onto a PDB topology.
+    fields : dict
+        The shared atom fields from `spec_fields`.
+    box : numpy.ndarray or None
+        The box dimensions for the periodic images, from `shell_box`.
+    plan : dict
+        The masks of the clauses evaluated so far.
+
+    Returns
+    -------
+    mask : numpy.ndarray
+        A boolean array that is `True` at the index of every matching atom.
+    """
+    key = json.dumps(clause, sort_keys=True)
+    if key in plan:
+        return plan[key]
+    n_atoms = len(fields["index"])
+    if isinstance(clause, str):
+        mask = region_mask(n_atoms, system.select_atoms(clause))
+    elif isinstance(clause, list):
+        mask = np.zeros(n_atoms, dtype=bool)
+        for sub_clause in clause:
+            mask |= clause_mask(sub_clause, system, fields, box, plan)
+    else:
+        mask = np.ones(n_atoms, dtype=bool)
+        for field, value in clause.items():
+            if field in ("of", "whole_residues"):
+                continue
+            elif field == "around":
+                of = clause_mask(clause["of"], system, fields, box, plan)
+                coords = system.atoms.positions
+                near = np.zeros(n_atoms, dtype=bool)
+                if of.any():
+                    pairs = capped_distance(coords[of], coords, float(value),
+                     box=box, return_distances=False)
+                    near[pairs[:, 1]] = True
+                mask &= near & ~of
+            elif field in ("bynum", "index"):
+                first, last = value
+                mask &= (fields[field] >= first) & (fields[field] <= last)
+            elif field in ("name", "resname"):
+                codes, lookup = fields[field]
+                values = value if isinstance(value, list) else [value]
+                mask &= np.isin(codes, [lookup[v] for v in values if v in
+                 lookup])
+            elif field == "resnum":
+                mask &= np.isin(fields[field], value)
+            else:
+                raise ValueError("Unknown key {} in the region spec clause"
+                 " {}.".format(field, key))
+        if clause.get("whole_residues", False):
+            mask = np.isin(system.atoms.resindices,
+             system.atoms.resindices[mask])
+    plan[key] = mask
+    return mask
+
+def set_around(clause, around):
+    """
+    Sets the distance of every `around` clause (including nested ones) in a
+    region spec clause.
+
+    Parameters
+    ----------
+    clause : str, list, or dict
+        The region spec clause.
+    around : float
+        The new distance.
+
+    Returns
+    -------
+    clause : str, list, or dict
+        A copy of the clause with the new distances.
+    """
+    if isinstance(clause, list):
+        return [set_around(sub_clause, around) for sub_clause in clause]
+    elif isinstance(clause, dict):
+        clause = {field: set_around(value, around) if field == "of" else value
+         for field, value in clause.items()}
+        if "around" in clause:
+            clause["around"] = around
+    return clause
+
+def select_spec(system, region_spec, shell_centers, box, orig_pdb, tink_xyz,
+ region_cache_dir, around=None, fields=None, plan=None, neighbors=None):
+    """
+    Selects the QM, pseudobond, boundary, higher basis, and active shell
+    atoms from a region spec instead of `select_QM` and
+    `select_higher_basis`. The masks are cached in region_cache_dir, named by
+    the SHA-256 of the spec, the PDB, the TINKER XYZ, the shell centers, and
+    the selection code, so rerunning with only QM settings changed skips the
+    selection entirely.
+
+    Parameters
+    ----------
+    system : MDAnalysis.core.universe.Universe
+        The Tinker XYZ information mapped onto a PDB topology.
+    region_spec : str
+        The path to the region spec.
+    shell_centers : list of tuple
+        The (VMD index, radius) of each center of the active atom shell.
+    box : numpy.ndarray or None
+        The box dimensions for the periodic images, from `shell_box`.
+    orig_pdb : str
+        The path to the PDB file used to generate the QM/MM TINKER XYZ.
+    tink_xyz: str
+        The path to the TINKER XYZ file for QM/MM.
+    region_cache_dir : str
+        The folder for the cached masks.
+    around : float, optional
+        A distance to use for every `around` clause of the spec.
+    fields : dict, optional
+        The shared atom fields from `spec_fields`.
+    plan : dict, optional
+        The masks of the clauses evaluated so far, from `clause_mask`, which
+        is updated with the clauses evaluated here.
+    neighbors : tuple, optional
+        The shell center neighbors from `shell_neighbors`.
+
+    Returns
+    -------
+    all_QM, all_BA, all_PB, all_HB : MDAnalysis.core.groups.AtomGroup
+        Atom groups of the QM, boundary, pseudobond, and higher basis atoms.
+    all_FR : numpy.ndarray
+        An array of the indices of all of the frozen atoms.
+    """
+    spec_hash = hashlib.sha256()
+    for hash_file in (region_spec, orig_pdb, tink_xyz):
+        with open(hash_file, 'rb') as hash_in:
+            spec_hash.update(hash_in.read())
+    spec_hash.update(repr((shell_centers, box, around)).encode())
+    for function in (clause_mask, spec_fields, set_around, select_shell,
+     select_spec):
+        spec_hash.update(inspect.getsource(function).encode())
+    cache_file = os.path.join(region_cache_dir, spec_hash.hexdigest()+".npz")
+    regions = ("QM", "PB", "BA", "HB", "shell")
+    if os.path.isfile(cache_file):
+        print("Using the cached region masks in {}.\n".format(cache_file))
+        with np.load(cache_file) as cache_in:
+            masks = {region: cache_in[region] for region in regions}
+    else:
+        spec = read_region_spec(region_spec)
+        if around is not None:
+            spec = {region: set_around(clause, around) for region, clause in
+             spec.items()}
+        if fields is None:
+            fields = spec_fields(system)
+        if plan is None:
+            plan = {}
+        masks = {region: clause_mask(spec.get(region, []), system, fields, box,
+         plan) for region in regions[:-1]}
+        masks["shell"] = region_mask(len(system.atoms),
+         select_shell(system, shell_centers, box, neighbors))
+        os.makedirs(region_cache_dir, exist_ok=True)
+        np.savez_compressed(cache_file, **masks)
+    all_QM, all_PB, all_BA, all_HB, my_sphere = (system.atoms[np.flatnonzero(
+     masks[region])] for region in regions)
+    print("There are {} QM, {} pseudobond, and {} boundary atoms.\n".format( \
+     len(all_QM), len(all_PB), len(all_BA)))
+    print("There are {} active atoms.\n".format(len(my_sphere)))
+    all_FR = np.flatnonzero(region_masks(len(system.atoms), all_QM, all_PB,
+     all_BA, my_sphere)["FR"])
+    print("There are {} total frozen atoms.\n".format(len(all_FR)))
+    return all_QM, all_BA, all_PB, all_HB, all_FR
+
 def get_box(orig_pdb):
     """
     Determines the box size from the PDB for the regions file.
@@ -253,6 +653,8 @@ def get_box(orig_pdb):
     -------
     x_box, y_box, z_box : float
         X, Y, and Z box size coordinates from the input PDB.
+    box_angles : tuple of float
+        The alpha, beta, and gamma box angles from the input PDB.
     """
     pdb = pmd.load_file(orig_pdb)
     save_box = pdb.get_box()
@@ -262,13 +664,17 @@ def get_box(orig_pdb):
         x_box = 0.
         y_box = 0.
         z_box = 0.
+        box_angles = (90., 90., 90.)
     else:
         x_box = save_box.item(0)
         y_box = save_box.item(1)
         z_box = save_box.item(2)
+        box_angles = (save_box.item(3), save_box.item(4), save_box.item(5))
     #
     print("\nBox size: {} {} {}\n".format(x_box, y_box, z_box))
-    return x_box, y_box, z_box
+    if box_angles != (90., 90., 90.):
+        print("Box angles: {} {} {}\n".format(*box_angles))
+    return x_box, y_box, z_box, box_angles
 
 
 def load_XYZ(orig_pdb, tink_xyz):
@@ -317,7 +723,7 @@ def check_shell(shell_center, VMD_index_shell):
     return shell_center
 
 def make_regions(x_box, y_box, z_box, all_QM, all_PB, all_BA, all_FR, electro,\
-     criteria, method, mem, charge, spin):
+     criteria, method, mem, charge, spin, out_dir="."):
     """
     Generates the regions.inp file. The quantum, pseudobond, boundary, and
     frozen atom lists are formmated for printing in 10 columns.
@@ -332,8 +738,10 @@ def make_regions(x_box, y_box, z_box, all_QM, all_PB, all_BA, all_FR, electro,\
         An atom group of all of the selected pseudobond atoms.
     all_BA : MDAnalysis.core.groups.AtomGroup
         An atom group of all of the selected boundary atoms.
-    all_FR : list
-        A list of all of the frozen atoms.
+    all_FR : numpy.ndarray
+        An array of the indices of all of the frozen atoms.
+    out_dir : str
+        The folder to write regions.inp_backup to.
     """
     ##
     electro = electro.upper()
@@ -355,7 +763,7 @@ def make_regions(x_box, y_box, z_box, all_QM, all_PB, all_BA, all_FR, electro,\
     FR_len = (len(all_FR)-(len(all_FR)%(nc)))+(nc)
     FR_range = FR_len//(nc)
     print_FR = [all_FR[i*(nc):i*(nc)+(nc)] for i in range(FR_range)]
-    with open("regions.inp_backup", "w+") as reg_out:
+    with open(os.path.join(out_dir, "regions.inp_backup"), "w+") as reg_out:
         reg_out.write("Potential_type: QMMM\n")
         reg_out.write("QM_type: g16\n")
         # to match current
@@ -445,8 +853,29 @@ def map_BASIS(all_QM, all_PB):
     #     bl_out.close()
     return basis_df
 
+def basis_groups(basis_ID, size):
+    """
+    Splits the BASIS IDs into the groups written on each line of the BASIS
+    file.
+
+    Parameters
+    ----------
+    basis_ID : numpy.ndarray
+        The BASIS IDs of the atoms with one basis set.
+    size : int
+        The most IDs to put in a group.
+
+    Returns
+    -------
+    groups : list of numpy.ndarray
+        The groups of IDs, where only the last one can be shorter than size.
+    """
+    if len(basis_ID) == 0:
+        return []
+    return np.split(basis_ID, np.arange(size, len(basis_ID), size))
+
 def make_BASIS(basis_df, all_QM, all_HB, all_PB, reg_basis_level,
- high_basis_level, PB1, PB2):
+ high_basis_level, PB1, PB2, out_dir="."):
     """
     Generates the Gaussian BASIS file.
 
@@ -454,42 +883,29 @@ def make_BASIS(basis_df, all_QM, all_HB, all_PB, reg_basis_level,
     ----------
     basis_df : pandas.core.frame.DataFrame
         A DataFrame with the BASIS file mapping.
+    out_dir : str
+        The folder to write BASIS and BASIS_verification.txt to.
     """
     ## Get the "regular BASIS" atoms
     reg_B = all_QM.subtract(all_HB)
-    ## Create an empty column
-    basis_df["Type"] = np.nan
-    #
-    ## Assign "REG" type to atoms with regular BASIS
-    for index, row in basis_df.iterrows():
-        for atom in reg_B.atoms:
-            if atom.ix == row["Regions_ID"]:
-                basis_df.loc[basis_df.index[index], 'Type'] = "REG"
     #
-    ## Do the "higher BASIS" atoms
-    for index, row in basis_df.iterrows():
-        for atom in all_HB.atoms:
-            if atom.ix == row["Regions_ID"]:
-                basis_df.loc[basis_df.index[index], 'Type'] = "HIGH"
+    ## Assign the "REG", then "HIGH", then "PB" type to each row by its
+    ## Regions_ID, so later types win; rows in none of them stay empty
+    regions_ID = basis_df["Regions_ID"].to_numpy()
+    basis_type = np.full(len(basis_df), np.nan, dtype=object)
+    basis_type[np.isin(regions_ID, reg_B.atoms.ix)] = "REG"
+    basis_type[np.isin(regions_ID, all_HB.atoms.ix)] = "HIGH"
+    basis_type[np.isin(regions_ID, all_PB.atoms.ix)] = "PB"
+    basis_df["Type"] = basis_type
     #
-    ## Do the Pseudobond atoms
-    for index, row in basis_df.iterrows():
-        for atom in all_PB.atoms:
-            if atom.ix == row["Regions_ID"]:
-                basis_df.loc[basis_df.index[index], 'Type'] = "PB"
-    #
-    ## Separate into different DataFrames
-    reg = basis_df.loc[basis_df['Type'] == "REG"].reset_index(drop=True)
-    high = basis_df.loc[basis_df['Type'] == "HIGH"].reset_index(drop=True)
-    pb = basis_df.loc[basis_df['Type'] == "PB"].reset_index(drop=True)
-    #
-    ## Turn the BASIS_IDs for each DF into a list
-    reg_list = reg["BASIS_ID"].to_list()
-    high_list = high["BASIS_ID"].to_list()
-    pb_list = pb["BASIS_ID"].to_list()
+    ## Get the BASIS_IDs of each type
+    basis_ID = basis_df["BASIS_ID"].to_numpy()
+    reg_list = basis_ID[basis_type == "REG"]
+    high_list = basis_ID[basis_type == "HIGH"]
+    pb_list = basis_ID[basis_type == "PB"]
     #
     ## Write out the sanity check
-    with open("BASIS_verification.txt", "w+") as bv_out:
+    with open(os.path.join(out_dir, "BASIS_verification.txt"), "w+") as bv_out:
         bv_out.write("BASIS_ID Regions_ID TINKER_ID ResName ResNum AtomName Type\n")
         for r in basis_df.itertuples(index=True, name='Pandas'):
             bv_out.write("{:<8} {:<10} {:<9} {:<7} {:<6} {:<8} {:<5}\n".format(\
@@ -498,57 +914,28 @@ def make_BASIS(basis_df, all_QM, all_HB, all_PB, reg_basis_level,
         bv_out.close()
     #
     ## Now write the BASIS file
-    with open("BASIS", "w+") as b_out:
+    with open(os.path.join(out_dir, "BASIS"), "w+") as b_out:
     #---- Regular Basis
         ## Write indices of those with regular BASIS level in groups of 8
-        ## If there is no remainder:
-        if len(reg_list) % 8 == 0:
-            for i in range(int(len(reg_list)/8)):
-                b_out.write(" ".join(map(str,reg_list[i*8:(i+1)*8])) + "  0\n")
-                b_out.write("{}\n".format(reg_basis_level))
-                b_out.write("****\n")
-        ## If there is a remainder:
-        else:
-            for i in range(int(len(reg_list)/8+1)):
-                b_out.write(" ".join(map(str,reg_list[i*8:(i+1)*8])) + "  0\n")
-                b_out.write("{}\n".format(reg_basis_level))
-                b_out.write("****\n")
+        for group in basis_groups(reg_list, 8):
+            b_out.write(" ".join(map(str,group)) + "  0\n")
+            b_out.write("{}\n".format(reg_basis_level))
+            b_out.write("****\n")
     #---- Higher Basis
         ## Write indices of those with higher BASIS level in groups of 8
-        if len(high_list) % 8 == 0:
-            for i in range(int(len(high_list)/8)):
-                b_out.write(" ".join(map(str,high_list[i*8:(i+1)*8])) + "  0\n")
-                b_out.write("{}\n".format(high_basis_level))
-                b_out.write("****\n")
-        ## If there is a remainder:
-        else:
-            for i in range(int(len(high_list)/8+1)):
-                b_out.write(" ".join(map(str,high_list[i*8:(i+1)*8])) + "  0\n")
-                b_out.write("{}\n".format(high_basis_level))
-                b_out.write("****\n")
+        for group in basis_groups(high_list, 8):
+            b_out.write(" ".join(map(str,group)) + "  0\n")
+            b_out.write("{}\n".format(high_basis_level))
+            b_out.write("****\n")
     #---- PB Atoms
         ## Part 1: write indices of PB atoms in groups of 12
-        ## If there is no remainder:
-        if len(pb_list) % 12 == 0:
-            for i in range(int(len(pb_list)/12)):
-                b_out.write(" ".join(map(str,pb_list[i*12:(i+1)*12])) + "  0 {}\n".format(PB1.rstrip()))
-                b_out.write("****\n\n")
-        ## If there is a remainder:
-        else:
-            for i in range(int(len(pb_list)/12+1)):
-                b_out.write(" ".join(map(str,pb_list[i*12:(i+1)*12])) + "  0 {}\n".format(PB1.rstrip()))
-                b_out.write("****\n\n")
+        for group in basis_groups(pb_list, 12):
+            b_out.write(" ".join(map(str,group)) + "  0 {}\n".format(PB1.rstrip()))
+            b_out.write("****\n\n")
         ## Part 2: rewrite indices with additional info
-        ## If there is no remainder:
-        if len(pb_list) % 12 == 0:
-            for i in range(int(len(pb_list)/12)):
-                b_out.write(" ".join(map(str,pb_list[i*12:(i+1)*12])) + "  0\n")
-                b_out.write("{}\n\n".format(PB2.rstrip()))
-        ## If there is a remainder:
-        else:
-            for i in range(int(len(pb_list)/12+1)):
-                b_out.write(" ".join(map(str,pb_list[i*12:(i+1)*12])) + "  0\n")
-                b_out.write("{}\n\n".format(PB2.rstrip()))
+        for group in basis_groups(pb_list, 12):
+            b_out.write(" ".join(map(str,group)) + "  0\n")
+            b_out.write("{}\n\n".format(PB2.rstrip()))
         b_out.close()
         if len(pb_list) > 12:
             print("You may need to check the PB section formatting in the BASIS file.",
@@ -556,36 +943,144 @@ def make_BASIS(basis_df, all_QM, all_HB, all_PB, reg_basis_level,
             sep="\n")
     return basis_df
 
+def sweep_regions(system, sweep_params, sweep_dir, x_box, y_box, z_box, box,
+ shell_centers, region_spec, orig_pdb, tink_xyz, region_cache_dir, electro,
+ criteria, method, mem, charge, spin, reg_basis_level, high_basis_level, PB1,
+ PB2):
+    """
+    Writes the regions.inp_backup and BASIS files for every combination of
+    the swept region parameters, each in its own folder of sweep_dir (like
+    `radius-20.0_around-4_criteria-tight`), with the loaded system. The shell
+    center neighbors are found once out to the largest radius, and the atom
+    fields and clause masks of a region spec are shared by all the variants.
+
+    Parameters
+    ----------
+    system : MDAnalysis.core.universe.Universe
+        The Tinker XYZ information mapped onto a PDB topology.
+    sweep_params : dict
+        The list of values to try for each of "radius", "around", and
+        "criteria".
+    sweep_dir : str
+        The folder for the variant folders and sweep-summary.csv.
+    x_box, y_box, z_box : float
+        X, Y, and Z box size coordinates from the input PDB.
+    box : numpy.ndarray or None
+        The box dimensions for the periodic images, from `shell_box`.
+    shell_centers : list of tuple
+        The (VMD index, radius) of each center of the active atom shell.
+    region_spec : str or None
+        The path to the region spec, or `None` to use `select_QM` and
+        `select_higher_basis`.
+    orig_pdb : str
+        The path to the PDB file used to generate the QM/MM TINKER XYZ.
+    tink_xyz: str
+        The path to the TINKER XYZ file for QM/MM.
+    region_cache_dir : str
+        The folder for the cached masks of the region spec.
+    electro : str
+        The electrostatics, AMBER (aka CHARGES) or AMOEBA.
+    criteria : str
+        The convergence criteria (loose, medium, or tight) when it isn't swept.
+    method, mem, charge, spin : str
+        The QM method, memory, charge, and spin for the regions file.
+    reg_basis_level, high_basis_level : str
+        The regular and higher basis sets for the BASIS file.
+    PB1, PB2 : str
+        The basis information for the pseudobond atoms.
+
+    Returns
+    -------
+    summary : pandas.core.frame.DataFrame
+        The swept parameters and the number of QM, pseudobond, boundary,
+        active (unfrozen), and frozen atoms of each variant.
+    """
+    for param in sweep_params:
+        if param not in ("radius", "around", "criteria"):
+            raise ValueError("Unknown sweep parameter {}. Use radius, around,"
+             " or criteria.".format(param))
+    max_radius = max(sweep_params.get("radius", [radius for center, radius in
+     shell_centers]))
+    neighbors = shell_neighbors(system, shell_centers, box, max_radius)
+    if region_spec is not None:
+        fields = spec_fields(system)
+        plan = {}
+    #
+    summary = []
+    for values in itertools.product(*sweep_params.values()):
+        variant = dict(zip(sweep_params, values))
+        variant_name = "_".join("{}-{}".format(param, value) for param, value
+         in variant.items())
+        print("Writing the {} variant.\n".format(variant_name))
+        variant_centers = [(center, variant.get("radius", radius)) for center,
+         radius in shell_centers]
+        if region_spec is None:
+            all_QM, all_BA, all_PB, all_FR = select_QM(system, variant_centers,
+             box, variant.get("around", 4), neighbors)
+            all_HB = select_higher_basis(system)
+        else:
+            all_QM, all_BA, all_PB, all_HB, all_FR = select_spec(system,
+             region_spec, variant_centers, box, orig_pdb, tink_xyz,
+             region_cache_dir, variant.get("around"), fields, plan, neighbors)
+        #
+        out_dir = os.path.join(sweep_dir, variant_name)
+        os.makedirs(out_dir, exist_ok=True)
+        make_regions(x_box, y_box, z_box, all_QM, all_PB, all_BA, all_FR,
+         electro, variant.get("criteria", criteria), method, mem, charge, spin,
+         out_dir)
+        basis_df = map_BASIS(all_QM, all_PB)
+        make_BASIS(basis_df, all_QM, all_HB, all_PB, reg_basis_level,
+         high_basis_level, PB1, PB2, out_dir)
+        summary.append({**variant, "QM": len(all_QM), "PB": len(all_PB),
+         "BA": len(all_BA), "active": len(system.atoms)-len(all_FR),
+         "frozen": len(all_FR)})
+    summary = pd.DataFrame(summary)
+    summary.to_csv(os.path.join(sweep_dir, "sweep-summary.csv"), index=False)
+    print(summary.to_string(index=False), "\n")
+    return summary
+
 #-------------- Run the program -------------#
 
 ## Get box information
-x_box, y_box, z_box = get_box(orig_pdb)
+x_box, y_box, z_box, box_angles = get_box(orig_pdb)
+box = shell_box(x_box, y_box, z_box, box_angles)
 
 ## Load the system
 system = load_XYZ(orig_pdb, tink_xyz)
 
-## Correct the shell_center
-shell_center = check_shell(shell_center, VMD_index_shell)
-sc2 = check_shell(sc2, VMD_index_shell)
+## Correct the shell_centers
+shell_centers = [(check_shell(center, VMD_index_shell), radius) for center,
+ radius in shell_centers]
 
-## Select QM, Boundary, and Pseudobond atoms
-all_QM, all_BA, all_PB, all_FR = select_QM(system, shell_center, sc2)
+## Try every variant of the region parameters, or make one set of files
+if sweep_params is not None:
+    sweep_regions(system, sweep_params, sweep_dir, x_box, y_box, z_box, box,
+     shell_centers, region_spec, orig_pdb, tink_xyz, region_cache_dir, electro,
+     criteria, method, mem, charge, spin, reg_basis_level, high_basis_level,
+     PB1, PB2)
 
-## Make the regions file
-make_regions(x_box, y_box, z_box, all_QM, all_PB, all_BA, all_FR, electro, \
- criteria, method, mem, charge, spin)
+    print("I have successfully generated the swept regions and BASIS files.")
+else:
+    ## Select QM, Boundary, Pseudobond, and higher basis atoms
+    if region_spec is None:
+        all_QM, all_BA, all_PB, all_FR = select_QM(system, shell_centers, box)
+        all_HB = select_higher_basis(system)
+    else:
+        all_QM, all_BA, all_PB, all_HB, all_FR = select_spec(system, region_spec,
+         shell_centers, box, orig_pdb, tink_xyz, region_cache_dir)
 
-print("I have successfully generated the regions file.\n")
+    ## Make the regions file
+    make_regions(x_box, y_box, z_box, all_QM, all_PB, all_BA, all_FR, electro, \
+     criteria, method, mem, charge, spin)
 
-## Create a DataFrame relating the regions file IDs and the BASIS numbering
-basis_df = map_BASIS(all_QM, all_PB)
+    print("I have successfully generated the regions file.\n")
 
-## Select atoms using the higher basis
-all_HB = select_higher_basis(system)
+    ## Create a DataFrame relating the regions file IDs and the BASIS numbering
+    basis_df = map_BASIS(all_QM, all_PB)
 
-## Create the BASIS file
-basis_df = make_BASIS(basis_df, all_QM, all_HB, all_PB, reg_basis_level, \
- high_basis_level, PB1, PB2)
+    ## Create the BASIS file
+    basis_df = make_BASIS(basis_df, all_QM, all_HB, all_PB, reg_basis_level, \
+     high_basis_level, PB1, PB2)
 
-print("I have successfully generated the BASIS file. Good luck on the next \n\
+    print("I have successfully generated the BASIS file. Good luck on the next \n\
 steps of the QM/MM process!!!")
@@ -5,16 +5,24 @@
 import parmed as pmd
 import pandas as pd
 import numpy as np
-import copy
-from collections import OrderedDict
+import contextlib
+import hashlib
+import inspect
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
 
 ## Code to source a single parm file (not a leaprc)
 # source_params = "parm99.dat"
-# param_dat = pmd.load_file(source_params)
+# source_method = "parm"
 
 ## Prmtop Method
 source_params = "polk_Hrot_terWT_C_2met_wat.prmtop"
-param_dat = pmd.load_file(source_params)
+source_method = "prmtop"
 
 ## It looks like anything sourced in the leaprc needs to have an absolute
 ## path to it, so you might need to modify the leaprc to incorporate the
@@ -23,23 +31,151 @@ param_dat = pmd.load_file(source_params)
 
 ## Leaprc Method
 # source_params = "param_files/leaprc.ff14SB.OL15.tip3p"
-# param_dat = pmd.amber.AmberParameterSet().from_leaprc(source_params)
+# source_method = "leaprc"
+
+## Number of processes extracting the bonds, angles, dihedrals, impropers,
+## and atom list at the same time
+n_procs = os.cpu_count()
+
+## Folder to cache the loaded parameters in, named by a hash of source_params
+## and the files it loads, so reruns (like for a new ff_name) skip parsing
+param_cache_dir = "param-cache"
 
 ## Leave the X dihedrals as X to fix by hand
 ## Setting this false will likely result in a MAXPRM issue with TINKER
 ## Because... well... you'll likely have over a million dihedral angles.
 leave_as_X = True
 
+## TINKER's limit on the number of lines in a parameter file (maxprm in its
+## sizes module), checked before writing the expanded X dihedrals
+maxprm = 25000
+
+## Only expand the X dihedrals into the torsions that really occur in a
+## topology, instead of every combination of atom types. With the Prmtop
+## Method, that prmtop is used. With a leaprc or parm file, give a prmtop of
+## the system here, or leave as None to expand them all.
+X_topology = None
+
 ## Give your FF a name (it will be preceded by AMBER-)
 ff_name = "polk2m-ff14SB"
 
 ## Give your new parameter file a name
 param_file_name = "amber-polk2mCTP-ff14SB.prm"
 
+## Merge the atoms with the same AMBER type, element, charge, and valence into
+## one TINKER atom type, writing a .types file next to the prm that maps every
+## residue atom to its merged type for pdbxyz4amber-pmd-params.py (as its
+## type_map_file). Can't be used with previous_prm.
+compact_types = False
+
+## Incremental mode: an earlier prm from this script (with the .manifest
+## written next to it) to add a new frcmod/lib to. Its atom type and class
+## numbers are kept, so XYZs converted with it stay valid, and only new or
+## changed lines are added. Leave as None to write a fresh file.
+previous_prm = None
+
 ##################
 ##  Definitions ##
 ##################
 
+## Start of every TINKER parameter file, filled in by prm_header
+prm_template = """
+{force_field}forcefield              AMBER-{ff_name}
+
+vdwtype                 LENNARD-JONES
+radiusrule              ARITHMETIC
+radiustype              R-MIN
+radiussize              RADIUS
+epsilonrule             GEOMETRIC
+vdw-14-scale            {scnb}
+chg-14-scale            {scee}
+electric                {electric:.7f}
+dielectric              1.0
+
+
+{references}
+This was generated using parmed from the following parameter sets:
+{titles}
+Current parameter values are available from the Amber site, located
+at http://ambermd.org/
+
+
+   ##################################
+   ##                              ##
+   ##  Tinker Atom Class Numbers   ##
+   ##      to Amber Atom Types     ##
+   ##                              ##
+{classes}   ##                              ##
+   ##################################
+
+
+"""
+
+def source_files(source_params, source_method):
+    """List source_params and, for a leaprc, every file from_leaprc loads from
+    it (with loadAmberParams, loadOff, or loadMol2/3), found the same way
+    parmed does: in the working directory, then $AMBERHOME/dat/leap/lib and
+    parm. A file that can't be found raises FileNotFoundError, like loading
+    the leaprc would, so nothing is hashed by name only.
+    """
+    files = [source_params]
+    if source_method == 'leaprc':
+        leaprc_parser = pmd.amber.parameters
+        with open(source_params) as leaprc:
+            for line in leaprc:
+                line = line.split('#')[0]
+                found = (leaprc_parser._loadparamsre.findall(line) +
+                 leaprc_parser._loadoffre.findall(line) +
+                 [fname for resname, fname in
+                 leaprc_parser._loadmol2re.findall(line)])
+                for fname in found:
+                    files.append(leaprc_parser._find_amber_file(fname, False))
+    return files
+
+def load_source(source_params, source_method, param_cache_dir):
+    """Load source_params with source_method ('prmtop', 'leaprc', or 'parm'),
+    or load what was kept of it from param_cache_dir. A prmtop is run through
+    det_structure and get_topology, and only their results are kept, so a
+    cache hit doesn't cost as much as parsing the prmtop again. The cache
+    file is named by the SHA-256 of every file from source_files, the source
+    of the functions that build it, and the ParmEd version, so editing any of
+    them makes a new entry.
+
+    Returns the parameter set (None for a prmtop), the det_structure
+    parameter set (None unless a prmtop), and the get_topology dictionary
+    (None unless a prmtop).
+    """
+    if source_method not in ('prmtop', 'leaprc', 'parm'):
+        raise ValueError("Unknown source_method {}. Use prmtop, leaprc, or"
+         " parm.".format(source_method))
+    param_hash = hashlib.sha256(source_method.encode())
+    for hash_file in source_files(source_params, source_method):
+        param_hash.update(hash_file.encode())
+        with open(hash_file, 'rb') as hash_in:
+            param_hash.update(hash_in.read())
+    for function in (det_structure, get_topology, topology_torsion_types,
+     residue_frame, unique_terms):
+        param_hash.update(inspect.getsource(function).encode())
+    param_hash.update(pmd.__version__.encode())
+    cache_file = os.path.join(param_cache_dir, param_hash.hexdigest()+".pkl")
+    if os.path.isfile(cache_file):
+        print(" Using the cached parameters in {}.\n".format(cache_file))
+        with open(cache_file, 'rb') as cache_in:
+            return pickle.load(cache_in)
+    if source_method == 'leaprc':
+        loaded = (pmd.amber.AmberParameterSet().from_leaprc(source_params),
+         None, None)
+    elif source_method == 'parm':
+        loaded = (pmd.load_file(source_params), None, None)
+    else:
+        structure = pmd.load_file(source_params)
+        struct_dat = det_structure(structure)
+        loaded = (None, struct_dat, get_topology(structure))
+    os.makedirs(param_cache_dir, exist_ok=True)
+    with open(cache_file, 'wb') as cache_out:
+        pickle.dump(loaded, cache_out)
+    return loaded
+
 def det_structure(param_dat):
     if type(param_dat) == pmd.amber._amberparm.AmberParm:
         print(" Using an AMBER prmtop file.\n")
@@ -64,6 +200,25 @@ def det_structure(param_dat):
         struct_dat = None
     return struct_dat
 
+def get_topology(param_dat):
+    """Pull what get_bonds, get_atomlist, and the X dihedral expansion need
+    out of a prmtop (after det_structure has renamed its terminals), so the
+    structure itself doesn't have to be kept: the atom types, k, and req of
+    each bond type once, the atoms of a template of the last residue with
+    each name, and the atom types of every proper dihedral.
+    """
+    bonds = [(types, bond.k, bond.req) for types, bond in unique_terms(
+     ((bond.atom1.type, bond.atom2.type), bond.type)
+     for bond in param_dat.bonds)]
+    ## Only make a template from the last residue with each name
+    last_residue = {}
+    for residue in param_dat.residues:
+        last_residue[residue.name] = residue
+    res_types = [(name, pmd.modeller.residue.ResidueTemplate(name=name
+     ).from_residue(residue)) for name, residue in last_residue.items()]
+    return {'bonds': bonds, 'residues': residue_frame(res_types),
+     'torsions': topology_torsion_types(param_dat)}
+
 def get_ATs(param_dat, struct_dat):
     """Create a dictionary for the atom types, where the values are the TINKER
     atom types.
@@ -139,50 +294,37 @@ def get_VDW(param_dat, struct_dat):
     #
     return rmin14_dict, eps14_dict
 
-def get_bonds(param_dat, atom_types):
+def unique_terms(terms):
+    """Walk (atom types, parameter type) pairs once and keep the first of each.
+    parmed stores every term under both the AB/ABC/ABCD and reversed atom
+    types, pointing to the same parameter type, and TINKER reads either
+    order, so the reversed copy is skipped too. The check is on the atom types
+    and the parameter type itself, so the kept list only grows with the
+    number of unique terms, not the size of the system.
+    """
+    seen = set()
+    unique = []
+    for types, term in terms:
+        types = tuple(types)
+        if (types, id(term)) in seen or (types[::-1], id(term)) in seen:
+            continue
+        seen.add((types, id(term)))
+        unique.append((types, term))
+    return unique
+
+def get_bonds(param_dat, topology_dat, atom_types):
     """Create lists of the bond terms, k values, and req.
     """
-    ## If an AMBER prmtop
-    if type(param_dat) == pmd.amber._amberparm.AmberParm:
-        origin = 1
-        ## Create a dictionary of the bonds
-        bo_OD = { 'columns' : ('B1', 'B2', 'k', 'req')}
-        for i in range(len(param_dat.bonds)):
-            bo_OD.update({origin: [ param_dat.bonds[i].atom1.type,\
-             param_dat.bonds[i].atom2.type, param_dat.bonds[i].type.k,\
-             param_dat.bonds[i].type.req ] })
-            origin += 1
-        init_df = pd.DataFrame.from_dict(bo_OD, "index", columns=['B1', 'B2',
-         'k', 'req'])
-        #
-        # Remove the row used to set-up the dictionary
-        bo_df = init_df.drop(['columns'])
-        #
-        # Drop duplicate values, keeping one copy
-        bo_df.drop_duplicates(keep = 'first', inplace = True, ignore_index=True)
-        #
-        # Lookup AMBER types in dictionary and create column with TINKER type
-        bo_df['B1T'] = bo_df['B1'].map(atom_types)
-        bo_df['B2T'] = bo_df['B2'].map(atom_types)
-        #
-        # Write them to a list for printing
-        bond1 = bo_df['B1T'].tolist()
-        bond2 = bo_df['B2T'].tolist()
-        bond_k = bo_df['k'].tolist()
-        bond_req = bo_df['req'].tolist()
+    ## If an AMBER prmtop, use each bond type of the system from get_topology
+    if topology_dat is not None:
+        bonds = topology_dat['bonds']
     else:
-        bonds = list(param_dat.bond_types.items())
-        bond1a = []
-        bond2a = []
-        bond_k = []
-        bond_req = []
-        for i in range(len(bonds)):
-            bond1a.append(bonds[i][0][0])
-            bond2a.append(bonds[i][0][1])
-            bond_k.append(bonds[i][1].k)
-            bond_req.append(bonds[i][1].req)
-        bond1 = [atom_types[key] for key in bond1a]
-        bond2 = [atom_types[key] for key in bond2a]
+        bonds = [(types, bond.k, bond.req) for types, bond in
+         unique_terms(param_dat.bond_types.items())]
+    bond1 = [atom_types[bond[0][0]] for bond in bonds]
+    bond2 = [atom_types[bond[0][1]] for bond in bonds]
+    bond_k = [bond[1] for bond in bonds]
+    bond_req = [bond[2] for bond in bonds]
     print(" Achievement unlocked: the names bond, atom bond.\n")
     return bond1, bond2, bond_k, bond_req
 
@@ -221,9 +363,9 @@ def get_angles(param_dat, atom_types):
     #     ang_k = an_df['k'].tolist()
     #     ang_theteq = an_df['theteq'].tolist()
     if struct_dat is None:
-        angles = list(param_dat.angle_types.items())
+        angles = unique_terms(param_dat.angle_types.items())
     else:
-        angles = list(struct_dat.angle_types.items())
+        angles = unique_terms(struct_dat.angle_types.items())
     angle1a = []
     angle2a = []
     angle3a = []
@@ -242,71 +384,45 @@ def get_angles(param_dat, atom_types):
     return angle1, angle2, angle3, ang_k, ang_theteq
 
 def get_dihedrals(param_dat, struct_dat, atom_types):
-    """Create lists of the dihedral terms and extract out the force constant
-    (k), periodicity (per), and phase information.
+    """Create lists of the dihedral terms and read the force constant (k),
+    periodicity (per), and phase of each of their terms into arrays. Dihedral
+    i has the terms di_start[i] to di_start[i+1].
     """
     if struct_dat is None:
-        dihedrals = list(param_dat.dihedral_types.items())
+        dihedrals = unique_terms(param_dat.dihedral_types.items())
 
     else:
-        dihedrals = list(struct_dat.dihedral_types.items())
-    dihedral1a = []
-    dihedral2a = []
-    dihedral3a = []
-    dihedral4a = []
-    dval = []
-    for i in range(len(dihedrals)):
-        dihedral1a.append(dihedrals[i][0][0])
-        dihedral2a.append(dihedrals[i][0][1])
-        dihedral3a.append(dihedrals[i][0][2])
-        dihedral4a.append(dihedrals[i][0][3])
-        #
-        di_type = str(dihedrals[i][1])
-        di_type = str(di_type)
-        di_type.replace('<','').replace('>','').replace('[','').replace(']','').replace('DihedralTypes','').replace('DihedralType;','')
-        w_di_type = di_type.split()
-        for i in range(len(w_di_type)):
-            w_di_type[i] = w_di_type[i].strip(',')
-        #
-        saved_k = []
-        saved_per = []
-        saved_phase = []
-        for i in range(len(w_di_type)):
-            if w_di_type[i].rstrip('=.1234567890') == 'phi_k':
-                saved_k.append(w_di_type[i].lstrip('phi_k='))
-            if w_di_type[i].rstrip('=.1234567890') == 'per':
-                saved_per.append(w_di_type[i].lstrip('per='))
-            if w_di_type[i].rstrip('=.1234567890') == 'phase':
-                saved_phase.append(w_di_type[i].lstrip('phase='))
-        #
-        ## Combine k, periodicity, and phase into a single line
-        dval.append(list(zip(saved_k, saved_per, saved_phase)))
-        #
-    dihedral1 = [atom_types[key] for key in dihedral1a]
-    dihedral2 = [atom_types[key] for key in dihedral2a]
-    dihedral3 = [atom_types[key] for key in dihedral3a]
-    dihedral4 = [atom_types[key] for key in dihedral4a]
+        dihedrals = unique_terms(struct_dat.dihedral_types.items())
+    dihedral1 = [atom_types[key[0]] for key, di_types in dihedrals]
+    dihedral2 = [atom_types[key[1]] for key, di_types in dihedrals]
+    dihedral3 = [atom_types[key[2]] for key, di_types in dihedrals]
+    dihedral4 = [atom_types[key[3]] for key, di_types in dihedrals]
+    #
+    di_start = np.cumsum([0] + [len(di_types) for key, di_types in dihedrals])
+    terms = [term for key, di_types in dihedrals for term in di_types]
+    k = np.array([term.phi_k for term in terms], dtype=float)
+    per = np.array([term.per for term in terms], dtype=int)
+    phase = np.array([term.phase for term in terms], dtype=float)
+    dval = (di_start, k, per, phase)
     return dihedral1, dihedral2, dihedral3, dihedral4, dval
 
-## Should figure out how to remove duplicates (X-A-B-X == X-B-A-X)
 def clean_dihedrals(dval):
     """Create the print string for the force constant (k), periodicity (per),
     and phase.
     """
-    di_line = []
-    for i in dval:
-        i = str(i)
-        di_line.append(i.replace(')','').replace('(','').replace(',','').replace('\'','').replace('[','').replace(']',''))
+    di_start, k, per, phase = dval
+    ## Format all of the terms at once, then join them for each dihedral
+    terms = np.char.add(np.char.add(np.char.mod('%.3f ', k),
+     np.char.mod('%d ', per)), np.char.mod('%.3f', phase))
+    di_line = [' '.join(terms[start:stop]) for start, stop in
+     zip(di_start[:-1], di_start[1:])]
     print(" Achievement unlocked: dihedrals dealt with.\n")
     return di_line
 
 
-def build_X_dihedrals(dihedral1, dihedral2, dihedral3, dihedral4, atom_types, \
- di_line):
-    ## Copy atoms types to get rid of ions from torsions
-    c_atom_types = copy.deepcopy(atom_types)
+def X_atom_types(atom_types):
+    """List the TINKER atom types that an X torsion gets expanded over."""
     ## Remove know ion types AND X to not have repeats with X
-    ## Each of the iteration lines will print the original X-type for posterity
     ions = [
     ## KEEP THESE
      #'HO', 'H1', 'CT', 'OH', 'OS', 'C7', 'CJ', 'H2', 'N*', 'C', 'O', 'NA',
@@ -328,148 +444,102 @@ def build_X_dihedrals(dihedral1, dihedral2, dihedral3, dihedral4, atom_types, \
      'Tb3+', 'Dy3+', 'Er3+', 'Tm3+', 'Lu3+', 'Hf4+', 'Zr4+', 'Ce4+', 'U4+',
      'Pu4+', 'Th4+', 'X'
      ]
-    for i in ions:
-        try:
-            c_atom_types.pop(i)
-        except KeyError:
-            continue
-    ## Set up the dictionary to build the table from
-    di_OD = { 'columns' : ('tinker', 'DH1', 'DH2', 'DH3', 'DH4', 'KPP')}
-    ## use atom_types.values() for the numbers!
-    origin = 1
-    for i in range(len(dihedral1)):
-    # for i in range(10):
-        ## if only dihedral1 is X
-        if dihedral1[i] == 999 and dihedral2[i] != 999 and dihedral3[i] != 999 and dihedral4[i] != 999:
-            for a_key in c_atom_types.values():
-                # di_OD.update({origin: ['torsion      ', dihedral1[i], dihedral2[i],\
-                # dihedral3[i], dihedral4[i], di_line[i]] })
-                di_OD.update({origin: ['torsion      ', a_key, dihedral2[i],\
-                dihedral3[i], dihedral4[i], di_line[i]] })
-                origin += 1
-        ## if only dihedral2 is X
-        elif dihedral2[i] == 999 and dihedral1[i] != 999 and dihedral3[i] != 999 and dihedral4[i] != 999:
-            for a_key in c_atom_types.values():
-                di_OD.update({origin: ['torsion      ', dihedral1[i], a_key,\
-                dihedral3[i], dihedral4[i], di_line[i]] })
-                origin += 1
-        ## if only dihedral3 is X
-        elif dihedral3[i] == 999 and dihedral1[i] != 999 and dihedral2[i] != 999 and dihedral4[i] != 999:
-            for a_key in c_atom_types.values():
-                di_OD.update({origin: ['torsion      ', dihedral1[i], dihedral2[i],\
-                a_key, dihedral4[i], di_line[i]] })
-                origin += 1
-        ## if only dihedral4 is X
-        elif dihedral4[i] == 999 and dihedral1[i] != 999 and dihedral2[i] != 999 and dihedral3[i] != 999:
-            for a_key in c_atom_types.values():
-                di_OD.update({origin: ['torsion      ', dihedral1[i], dihedral2[i],\
-                dihedral3[i], a_key, di_line[i]] })
-                origin += 1
-        ## if dihedral1 and dihedral2 are X
-        elif dihedral1[i] == 999 and dihedral2[i] == 999 and dihedral3[i] != 999 and dihedral4[i] != 999:
-            for a_key in c_atom_types.values():
-                for b_key in c_atom_types.values():
-                    di_OD.update({origin: ['torsion      ', a_key, b_key,\
-                    dihedral3[i], dihedral4[i], di_line[i]] })
-                    origin += 1
-                    di_OD.update({origin: ['torsion      ', b_key, a_key,\
-                    dihedral3[i], dihedral4[i], di_line[i]] })
-                    origin += 1
-        ## if dihedral1 and dihedral3 are X
-        elif dihedral1[i] == 999 and dihedral3[i] == 999 and dihedral2[i] != 999 and dihedral4[i] != 999:
-            for a_key in c_atom_types.values():
-                for b_key in c_atom_types.values():
-                    di_OD.update({origin: ['torsion      ', a_key, dihedral2[i],\
-                    b_key, dihedral4[i], di_line[i]] })
-                    origin += 1
-                    di_OD.update({origin: ['torsion      ', b_key, dihedral2[i],\
-                    a_key, dihedral4[i], di_line[i]] })
-                    origin += 1
-        ## if dihedral1 and dihedral4 are X
-        elif dihedral1[i] == 999 and dihedral4[i] == 999 and dihedral2[i] != 999 and dihedral3[i] != 999:
-            for a_key in c_atom_types.values():
-                for b_key in c_atom_types.values():
-                    di_OD.update({origin: ['torsion      ', a_key, dihedral2[i],\
-                    dihedral3[i], b_key, di_line[i]] })
-                    origin += 1
-                    di_OD.update({origin: ['torsion      ', b_key, dihedral2[i],\
-                    dihedral3[i], a_key, di_line[i]] })
-                    origin += 1
-        ## if dihedral2 and dihedral3 are X
-        elif dihedral2[i] == 999 and dihedral3[i] == 999 and dihedral1[i] != 999 and dihedral4[i] != 999:
-            for a_key in c_atom_types.values():
-                for b_key in c_atom_types.values():
-                    di_OD.update({origin: ['torsion      ', dihedral1[i], a_key,\
-                    b_key, dihedral4[i], di_line[i]] })
-                    origin += 1
-                    di_OD.update({origin: ['torsion      ', dihedral1[i], b_key,\
-                    a_key, dihedral4[i], di_line[i]] })
-                    origin += 1
-        ## if dihedral2 and dihedral4 are X
-        elif dihedral2[i] == 999 and dihedral4[i] == 999 and dihedral1[i] != 999 and dihedral2[i] != 999:
-            for a_key in c_atom_types.values():
-                for b_key in c_atom_types.values():
-                    di_OD.update({origin: ['torsion      ', dihedral1[i], a_key,\
-                    dihedral3[i], b_key, di_line[i]] })
-                    origin += 1
-                    di_OD.update({origin: ['torsion      ', dihedral1[i], b_key,\
-                    dihedral3[i], a_key, di_line[i]] })
-                    origin += 1
-        ## if dihedral3 and dihedral4 are X
-        elif dihedral3[i] == 999 and dihedral4[i] == 999 and dihedral1[i] != 999 and dihedral2[i] != 999:
-            for a_key in c_atom_types.values():
-                for b_key in c_atom_types.values():
-                    di_OD.update({origin: ['torsion      ', dihedral1[i], dihedral2[i],\
-                    a_key, b_key, di_line[i]] })
-                    origin += 1
-                    di_OD.update({origin: ['torsion      ', dihedral1[i], dihedral2[i],\
-                    b_key, a_key, di_line[i]] })
-                    origin += 1
+    return [a_key for name, a_key in atom_types.items() if name not in ions]
+
+def torsion_key(dh1, dh2, dh3, dh4):
+    """Pack a torsion's TINKER types (all below 1000) into one integer, the
+    same for ABCD and DCBA."""
+    return min(((dh1*1000 + dh2)*1000 + dh3)*1000 + dh4,
+     ((dh4*1000 + dh3)*1000 + dh2)*1000 + dh1)
+
+def topology_torsion_types(topology):
+    """Collect the atom types of every proper dihedral in a topology (like a
+    prmtop), once each.
+    """
+    return sorted({(dihedral.atom1.type, dihedral.atom2.type,
+     dihedral.atom3.type, dihedral.atom4.type) for dihedral in
+     topology.dihedrals if not dihedral.improper})
+
+def get_topology_torsions(torsion_types, atom_types):
+    """Collect the TINKER types of the proper dihedrals from
+    topology_torsion_types as an (N, 4) array, with both the ABCD and DCBA
+    order of each. Dihedrals with an atom type that isn't in atom_types are
+    left out.
+    """
+    quads = set()
+    for torsion in torsion_types:
+        quad = tuple(atom_types.get(a_type) for a_type in torsion)
+        if None not in quad:
+            quads.add(quad)
+            quads.add(quad[::-1])
+    print(" Found {} unique proper torsions in the topology.\n".format(
+     len(quads)))
+    return np.array(sorted(quads), dtype=int).reshape(-1, 4)
+
+def build_X_dihedrals(dihedral1, dihedral2, dihedral3, dihedral4, atom_types, \
+ di_line, X_present=None):
+    """Lazily expand the X (999) torsions over the atom types from
+    X_atom_types, yielding [DH1, DH2, DH3, DH4, KPP] for each new torsion.
+    If X_present (from get_topology_torsions) is given, an X torsion is only
+    expanded into the torsions in it that match, instead of every type.
+    Torsions without X come first, then the ones with a single X, then the
+    rest, so the most specific parameters win. Repeats (including DCBA for
+    ABCD) are skipped through a set of torsion_key integers, so only the keys,
+    not the rows, are held in memory.
+    """
+    c_atom_types = X_atom_types(atom_types)
+    seen = set()
+    quads = list(zip(dihedral1, dihedral2, dihedral3, dihedral4))
+    for i in sorted(range(len(quads)), key=lambda i: quads[i].count(999)):
+        X_pos = [j for j, dh in enumerate(quads[i]) if dh == 999]
         ## To date, AMBER doesn't have any dihedrals that have 3 X's (which
-        ## seems like a good thing!)
-        # if none are X
+        ## seems like a good thing!), so leave those as is
+        if len(X_pos) > 2:
+            X_pos = []
+        if X_present is not None and len(X_pos) > 0:
+            pattern = np.array(quads[i])
+            rows = X_present[np.all((pattern == 999) | (X_present == pattern),
+             axis=1)].tolist()
         else:
-            di_OD.update({origin: ['torsion      ', dihedral1[i], dihedral2[i],\
-            dihedral3[i], dihedral4[i], di_line[i]] })
-            origin += 1
-    #
-    # Turn that ordered dictionary into a pd.DataFrame
-    init_df = pd.DataFrame.from_dict(di_OD, "index", columns=['tinker', 'DH1', 'DH2',
-     'DH3', 'DH4', 'KPP'])
-    #
-    # Remove the row used to set-up the dictionary
-    di_df = init_df.drop(['columns'])
-    #
-    # Drop duplicate values, keeping one copy
-    di_df.drop_duplicates(keep = 'first', inplace = True, ignore_index=True)
-    #
-    # https://stackoverflow.com/questions/49538497/how-to-apply-function-to-slice-of-columns-using-loc
-    # https://stackoverflow.com/questions/40474799/remove-reverse-duplicates-from-dataframe
-    # https://stackoverflow.com/questions/51603520/pandas-remove-duplicates-that-exist-in-any-order
-    #
-    ## Set-up drop reverse duplicates
-    columns = ['DH1', 'DH2', 'DH3', 'DH4']
-    ## Attach extra columns of the dihedral
-    dihed_df = pd.concat([di_df, pd.DataFrame(np.sort(di_df[columns], axis=1))], axis=1)
-    ## Remove the duplicates, based on what seems like ABCD DCBA/DCBA ABCD
-    dihed_df = dihed_df.drop_duplicates(dihed_df.columns.difference(di_df.columns))[di_df.columns]
-    #
-    dihed_df = dihed_df.reset_index()
-    #
-    # Remove new index that appears because of tinker????
-    dihed_df = dihed_df.drop('index', axis=1)
-    #
+            rows = []
+            for keys in itertools.product(c_atom_types, repeat=len(X_pos)):
+                row = list(quads[i])
+                for j, a_key in zip(X_pos, keys):
+                    row[j] = a_key
+                rows.append(row)
+        for row in rows:
+            key = torsion_key(*row)
+            if key in seen:
+                continue
+            seen.add(key)
+            yield row + [di_line[i]]
+
+def count_X_dihedrals(dihedral1, dihedral2, dihedral3, dihedral4, atom_types,\
+ di_line, X_present, n_params, maxprm):
+    """Count the torsions from build_X_dihedrals without keeping them, and
+    report the total against TINKER's MAXPRM before anything is written.
+    n_params is the number of the other parameter lines in the file.
+    """
+    n_torsions = sum(1 for row in build_X_dihedrals(dihedral1, dihedral2,
+     dihedral3, dihedral4, atom_types, di_line, X_present))
+    print(" Expanding the X torsions gives {} torsions, for {} parameter lines"
+     " in total (MAXPRM is {}).\n".format(n_torsions, n_torsions+n_params,
+     maxprm))
+    if n_torsions+n_params > maxprm:
+        print(" WARNING! That's over MAXPRM, so TINKER won't read the whole\n"
+         " parameter file. Raise maxprm in TINKER's sizes and recompile, set\n"
+         " X_topology, or set leave_as_X = True.\n")
     print(" Achievement unlocked: dihedrals dealt with.\n")
-    return dihed_df
+    return n_torsions
 
-def get_improper_torsions(param_dat, struct_dat):
+def get_improper_torsions(param_dat, struct_dat, atom_types):
     """Create lists of the improper terms, force constant values (phi_k), and
     equilibrium angles (theteq).
     """
     if struct_dat is None:
-        imptors = list(param_dat.improper_periodic_types.items())
+        imptors = unique_terms(param_dat.improper_periodic_types.items())
     else:
-        imptors = list(struct_dat.improper_periodic_types.items())
+        imptors = unique_terms(struct_dat.improper_periodic_types.items())
     imptor1a = []
     imptor2a = []
     imptor3a = []
@@ -493,225 +563,394 @@ def get_improper_torsions(param_dat, struct_dat):
     return imptor1, imptor2, imptor3, imptor4, imp_diheds_phik,\
      imp_diheds_phase, imp_diheds_per
 
+## Sections that extract_sections gets, in the order their results are used
+sections = ('bonds', 'angles', 'dihedrals', 'impropers', 'atoms')
+
+def set_section_inputs(param_dat, struct_dat, topology_dat, atom_types):
+    """Keep the parameters in each worker process for extract_section."""
+    global section_inputs
+    section_inputs = (param_dat, struct_dat, topology_dat, atom_types)
+
+def extract_section(section):
+    """Run the extractor for one of sections on the parameters from
+    set_section_inputs. Returns what it printed and its result.
+    """
+    param_dat, struct_dat, topology_dat, atom_types = section_inputs
+    with contextlib.redirect_stdout(io.StringIO()) as printed:
+        if section == 'bonds':
+            result = get_bonds(param_dat, topology_dat, atom_types)
+        elif section == 'angles':
+            result = get_angles(param_dat, atom_types)
+        elif section == 'dihedrals':
+            result = get_dihedrals(param_dat, struct_dat, atom_types)
+            result = result + (clean_dihedrals(result[-1]),)
+        elif section == 'impropers':
+            result = get_improper_torsions(param_dat, struct_dat, atom_types)
+        elif section == 'atoms':
+            # result = get_atomlist(param_dat, rmin14_dict, eps14_dict)
+            result = get_atomlist(param_dat, topology_dat)
+    return printed.getvalue(), result
+
+def extract_sections(param_dat, struct_dat, topology_dat, atom_types,
+ n_procs):
+    """Extract every one of sections at once with a pool of forked processes,
+    which inherit the parameters instead of having them pickled. The results
+    (and anything printed) are gathered in the order of sections, so the
+    output doesn't depend on which finishes first. Without fork, or with
+    n_procs=1, they're extracted one after another.
+    """
+    if n_procs > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        with ProcessPoolExecutor(min(n_procs, len(sections)),
+         mp_context=multiprocessing.get_context('fork'),
+         initializer=set_section_inputs,
+         initargs=(param_dat, struct_dat, topology_dat, atom_types)) as pool:
+            extracted = list(pool.map(extract_section, sections))
+    else:
+        set_section_inputs(param_dat, struct_dat, topology_dat, atom_types)
+        extracted = [extract_section(section) for section in sections]
+    results = []
+    for printed, result in extracted:
+        print(printed, end='')
+        results.append(result)
+    return results
+
+def residue_frame(res_types):
+    """Stack the atoms of (name, residue template) pairs into one dataframe.
+    """
+    ## A parm file on its own has no residues to list
+    if len(res_types) == 0:
+        return pd.DataFrame(columns=['name', 'type', 'charge',
+         'atomic_number', 'mass', 'resname'])
+    return pd.concat([res_type.to_dataframe() for name, res_type in
+     res_types], ignore_index=True, sort=False)
+
 # def get_atomlist(param_dat, rmin14_dict, eps14_dict):
-def get_atomlist(param_dat, struct_dat):
+def get_atomlist(param_dat, topology_dat):
     """Create a dataframe of all the different residues and update element and
     mass.
     """
-    if struct_dat is None:
-        res_types = list(param_dat.residues.items())
+    if topology_dat is None:
+        res_df = residue_frame(list(param_dat.residues.items()))
     else:
-        # res_types = list(struct_dat.residues.items())
-        ## Create a dictionary of all the different residue types
-        residue_dict = {}
-        for residue in param_dat.residues:
-            residue_dict[residue.name] = pmd.modeller.residue.ResidueTemplate(name=residue.name).from_residue(residue)
-        #
-        res_types = list(residue_dict.items())
-    #
-    res_df = pd.DataFrame()
-    for i in range(len(res_types)):
-        test_df = res_types[i][1].to_dataframe()
-        res_df = res_df.append(test_df, ignore_index=True, sort=False)
+        ## The residue templates of a prmtop, from get_topology
+        res_df = topology_dat['residues'].copy()
     #
-    ## Add element column that uses atomic_num to get element
-    res_df['element'] = ""
+    ## Add element column that uses atomic_num to get element, taking the first
+    ## element with that number (like H over D and T)
+    atomic_elements = {}
+    for element, atomic_number in pmd.periodic_table.AtomicNum.items():
+        atomic_elements.setdefault(atomic_number, element)
+    res_df['element'] = res_df['atomic_number'].map(atomic_elements)
     ## Update mass based on element
-    for i in range(len(res_df)):
-        res_df.loc[i,'element'] = list(pmd.periodic_table.AtomicNum.keys())[list(pmd.periodic_table.AtomicNum.values()).index(res_df.loc[i, 'atomic_number'])]
-        res_df.loc[i,'mass'] = pmd.periodic_table.Mass[res_df.loc[i,'element']]
-        # res_df.loc[i,'rmin_14'] = rmin14_dict[res_df.loc[i,'type']]
-        # res_df.loc[i,'epsilon_14'] = eps14_dict[res_df.loc[i,'type']]
+    res_df['mass'] = res_df['element'].map(pmd.periodic_table.Mass)
     #
     # ## Update index to start at 1, not zero (for mapping)
     # res_df.index = res_df.index + 1
     print(" Achievement unlocked: generated an atom list.\n")
     return res_df
 
-def write_params_noX(param_dat, struct_dat, atom_types,\
- bond1, bond2, bond_k, bond_req, \
+def read_manifest(previous_prm):
+    """Read the manifest written next to an earlier prm."""
+    with open(previous_prm + ".manifest") as manifest_in:
+        return json.load(manifest_in)
+
+def write_manifest(param_file_name, source_params, source_method, atom_types,
+ res_df, compact_types, manifest=None):
+    """Record the source files (with their SHA-256) and the class and atom
+    type numbers of a new prm next to it, for a later incremental update.
+    Numbers from the previous manifest are carried over, even for types that
+    are no longer used, so they're never handed out again. A compacted prm
+    only records its classes.
+    """
+    files = {}
+    for hash_file in source_files(source_params, source_method):
+        with open(hash_file, 'rb') as hash_in:
+            files[hash_file] = hashlib.sha256(hash_in.read()).hexdigest()
+    classes = {}
+    atoms = []
+    if manifest is not None:
+        classes.update(manifest['atom_types'])
+        atoms.extend(manifest['atoms'])
+    classes.update(atom_types)
+    new_atoms = res_df.index >= len(atoms)
+    atoms.extend([res_name, a_name] for res_name, a_name in
+     zip(res_df['resname'][new_atoms], res_df['name'][new_atoms]))
+    if compact_types:
+        atoms = []
+    with open(param_file_name + ".manifest", "w") as manifest_out:
+        json.dump({'source_params': source_params, 'files': files,
+         'atom_types': classes, 'atoms': atoms,
+         'compact_types': compact_types}, manifest_out, indent=1)
+
+def pin_atom_types(atom_types, manifest):
+    """Give the atom types from the previous manifest their old class numbers
+    and number any new ones after them.
+    """
+    old_types = manifest['atom_types']
+    next_class = max([a_class for a_type, a_class in old_types.items() if
+     a_type != 'X'], default=0) + 1
+    pinned = {}
+    for a_type in atom_types:
+        if a_type == 'X':
+            continue
+        elif a_type in old_types:
+            pinned[a_type] = old_types[a_type]
+        else:
+            pinned[a_type] = next_class
+            next_class += 1
+    pinned = dict(sorted(pinned.items(), key=lambda item: item[1]))
+    pinned['X'] = 999
+    print(" Kept the classes of {} atom types and added {} new ones.\n".format(
+     sum(a_type in old_types for a_type in pinned) - 1,
+     sum(a_type not in old_types for a_type in pinned)))
+    return pinned
+
+def pin_atom_numbers(res_df, manifest):
+    """Reindex res_df so every (residue, atom name) from the previous manifest
+    keeps its old atom type number (index plus one), and number any new ones
+    after them.
+    """
+    old_numbers = {tuple(atom): i for i, atom in enumerate(manifest['atoms'])}
+    numbers = []
+    next_number = len(old_numbers)
+    for key in zip(res_df['resname'], res_df['name']):
+        if key in old_numbers:
+            numbers.append(old_numbers[key])
+        else:
+            numbers.append(next_number)
+            next_number += 1
+    n_new = next_number - len(old_numbers)
+    print(" Kept {} atom types and added {} new ones.\n".format(
+     len(numbers) - n_new, n_new))
+    return res_df.set_axis(numbers).sort_index()
+
+## Number of fields after the keyword that name a prm term
+prm_term_fields = {'atom': 1, 'vdw': 1, 'bond': 2, 'angle': 3, 'imptors': 4,
+ 'torsion': 4, 'charge': 1}
+
+def read_prm_terms(prm_file):
+    """Read the term lines of a prm into a dictionary for each keyword, keyed
+    by their atom classes or types (in either order for bonds, angles, and
+    torsions).
+    """
+    terms = {keyword: {} for keyword in prm_term_fields}
+    with open(prm_file) as prm_in:
+        for line in prm_in:
+            words = line.split()
+            if len(words) == 0 or words[0] not in prm_term_fields:
+                continue
+            key = tuple(words[1:prm_term_fields[words[0]]+1])
+            if words[0] in ('bond', 'angle', 'torsion'):
+                key = min(key, key[::-1])
+            terms[words[0]][key] = line
+    return terms
+
+def merge_prm(old_terms, param_file_name):
+    """Patch the terms of the previous prm with the newly written file. Each
+    section keeps the old lines in their old order, swapping in the new line
+    where a term changed, and adds the new terms at its end. Terms that are
+    only in the previous prm are kept as they were.
+    """
+    new_terms = read_prm_terms(param_file_name)
+    with open(param_file_name) as prm_in:
+        new_lines = prm_in.readlines()
+    with open(param_file_name, "w") as prm_out:
+        for line in new_lines:
+            words = line.split()
+            if len(words) == 0 or words[0] not in prm_term_fields:
+                prm_out.write(line)
+                continue
+            keyword = words[0]
+            if keyword not in new_terms:
+                continue
+            ## Write the whole section at its first line
+            old, new = old_terms[keyword], new_terms.pop(keyword)
+            prm_out.writelines(new.get(key, old_line) for key, old_line in
+             old.items())
+            prm_out.writelines(new_line for key, new_line in new.items() if
+             key not in old)
+            print(" {:8} {} added, {} changed, {} kept from the old prm.".format(
+             keyword, sum(key not in old for key in new),
+             sum(key in old and new[key] != old[key] for key in new),
+             sum(key not in new for key in old)))
+        ## Sections with no new lines at all
+        for keyword in new_terms:
+            if len(old_terms[keyword]) > 0:
+                print(" WARNING! No {} lines were written, so the old ones are"
+                 " dropped.".format(keyword))
+    print("")
+
+def prm_banner(title, indent=6):
+    """Format a boxed section title of the TINKER parameter file."""
+    edge = " "*indent + "#"*(len(title) + 8) + "\n"
+    side = " "*indent + "##" + " "*(len(title) + 4) + "##\n"
+    return (edge + side + " "*indent + "##  {}  ##\n".format(title) + side +
+     edge + "\n\n")
+
+def prm_header(param_dat, struct_dat, atom_types, ff_name):
+    """Fill in prm_template, which is shared by both parameter file writers,
+    up to the atom type definitions.
+    """
+    if struct_dat is None:
+        param_set = param_dat
+    else:
+        param_set = struct_dat
+    return prm_template.format(
+     force_field=prm_banner("Force Field Definition"), ff_name=ff_name,
+     scnb=param_set.default_scnb, scee=param_set.default_scee,
+     electric=pmd.constants.AMBER_ELECTROSTATIC**2,
+     references=prm_banner("Literature References"),
+     titles="".join("{}.\n".format(name) for name in param_set.titles),
+     classes="".join("   ##           {:3}  {:<4}          ##\n".format(
+      a_class, a_type) for a_type, a_class in atom_types.items()))
+
+def atom_connection(a_type, atom_types, atom_connect):
+    """Find the TINKER type and connectivity for an atom line, guessing them
+    if needed.
+    """
+    ## Test_ion is to try and figure out letters of Atom Type
+    ## Test_AT is to try the guess atom connectivity from Atom Type
+    test_ion = atom_types.get(a_type)
+    test_AT = atom_connect.get(a_type)
+    if test_ion is None:
+        return "999", "0 !! GUESSED TYPE AND CONNECTION"
+    ## Attempt key retrieval
+    elif test_AT is None:
+        if a_type[0] in ('C', 'N'):
+            return test_ion, "3 !! GUESSED CONNECTION"
+        elif a_type[0] in ('O', 'S'):
+            return test_ion, "2 !! GUESSED CONNECTION"
+        elif a_type[0] == 'H':
+            return test_ion, "1 !! GUESSED CONNECTION"
+        else:
+            return test_ion, "0 !! GUESSED CONNECTION"
+    else:
+        return test_ion, test_AT
+
+def atom_lines(res_df, atom_types, atom_connect, numbers):
+    """Format the atom line of every row of res_df with its TINKER atom type
+    number.
+    """
+    for number, a_type, res_name, a_name, atomic_number, mass in zip(numbers,
+     res_df['type'], res_df['resname'], res_df['name'],
+     res_df['atomic_number'], res_df['mass']):
+        t_type, connect = atom_connection(a_type, atom_types, atom_connect)
+        yield "atom       {:4}  {:2}    {:<4}  \"{:<30} {:3}   {:>7.2f}    {}\n".format(
+         number, t_type, a_type, res_name + " " + a_name + '\"', atomic_number,
+         mass, connect)
+
+def compact_atom_types(res_df, atom_types, atom_connect):
+    """Merge the rows of res_df with the same AMBER type, atomic number,
+    charge (as written), and valence into one TINKER atom type, numbered in
+    order of first appearance.
+
+    Returns the first row of each merged type (indexed from zero for
+    write_prm) and the merged type number of every row.
+    """
+    keys = [(a_type, atomic_number, "{:.4f}".format(charge),
+     str(atom_connection(a_type, atom_types, atom_connect)[1]).split()[0]) for
+     a_type, atomic_number, charge in zip(res_df['type'],
+     res_df['atomic_number'], res_df['charge'])]
+    compact_numbers = {}
+    numbers = []
+    first_rows = []
+    for i, key in enumerate(keys):
+        if key not in compact_numbers:
+            compact_numbers[key] = len(compact_numbers) + 1
+            first_rows.append(i)
+        numbers.append(compact_numbers[key])
+    compact_df = res_df.iloc[first_rows].reset_index(drop=True)
+    print(" Merged {} atom types into {}.\n".format(len(res_df),
+     len(compact_df)))
+    return compact_df, numbers
+
+def write_type_map(param_file_name, res_df, numbers, atom_types, atom_connect):
+    """Write the atom line of every residue atom with its merged TINKER atom
+    type to a .types file next to the prm, which pdbxyz4amber-pmd-params.py
+    reads in place of the prm's own atom lines.
+    """
+    with open(param_file_name + ".types", "w") as types_out:
+        types_out.writelines(atom_lines(res_df, atom_types, atom_connect,
+         numbers))
+
+def vdw_values(rmin14_dict, eps14_dict, atom_types):
+    """Pair up the rmin_14 and epsilon_14 of each atom type with its class,
+    warning about and zeroing any that are missing.
+    """
+    for value1, value2 in zip(rmin14_dict.items(), eps14_dict.items()):
+        ## Get around immutable tuple by setting as a list
+        value1 = list(value1)
+        value2 = list(value2)
+        if value1[1] is None:
+            value1[1] = -0.0000
+            print("WARNING! {} has no listed rmin_14 value (VDW). Setting to -0.0000.".format(value1[0]))
+        if value2[1] is None:
+            value2[1] = -0.000
+            print("WARNING! {} has no listed epsilon_14 value (VDW). Setting to -0.0000.".format(value2[0]))
+        yield atom_types[value1[0]], value1[1], value2[1]
+
+def write_prm(param_dat, struct_dat, atom_types,\
+ bond1, bond2, bond_k, bond_req,\
  angle1, angle2, angle3, ang_k, ang_theteq,\
  imptor1, imptor2, imptor3, imptor4, imp_diheds_phik, imp_diheds_phase,\
- imp_diheds_per, dihed_df, res_df,\
+ imp_diheds_per, torsions, res_df,\
  rmin14_dict, eps14_dict, ff_name, atom_connect, param_file_name):
-    """Generate the new TINKER parameter file.
+    """Write the TINKER parameter file. Each section is formatted from its
+    columns with one line template and written with a single call, and the
+    torsions ([DH1, DH2, DH3, DH4, KPP] rows) are streamed from any iterable.
+    Atom types are numbered by the res_df index plus one.
     """
     with open(param_file_name, "w+") as tp_out:
-        tp_out.write("\n")
-        tp_out.write("      ##############################\n")
-        tp_out.write("      ##                          ##\n")
-        tp_out.write("      ##  Force Field Definition  ##\n")
-        tp_out.write("      ##                          ##\n")
-        tp_out.write("      ##############################\n")
-        tp_out.write("\n\n")
-        tp_out.write("forcefield              AMBER-{}\n\n".format(ff_name))
-        tp_out.write("vdwtype                 LENNARD-JONES\n")
-        tp_out.write("radiusrule              ARITHMETIC\n")
-        tp_out.write("radiustype              R-MIN\n")
-        tp_out.write("radiussize              RADIUS\n")
-        tp_out.write("epsilonrule             GEOMETRIC\n")
-        if struct_dat is None:
-            tp_out.write("vdw-14-scale            {}\n".format(param_dat.default_scnb))
-            tp_out.write("chg-14-scale            {}\n".format(param_dat.default_scee))
-        else:
-            tp_out.write("vdw-14-scale            {}\n".format(struct_dat.default_scnb))
-            tp_out.write("chg-14-scale            {}\n".format(struct_dat.default_scee))
-        tp_out.write("electric                {:.7f}\n".format(pmd.constants.AMBER_ELECTROSTATIC**2))
-        tp_out.write("dielectric              1.0\n")
-        tp_out.write("\n\n")
-        tp_out.write("      #############################\n")
-        tp_out.write("      ##                         ##\n")
-        tp_out.write("      ##  Literature References  ##\n")
-        tp_out.write("      ##                         ##\n")
-        tp_out.write("      #############################\n")
-        tp_out.write("\n\n")
-        tp_out.write("\nThis was generated using parmed from the following parameter sets:\n")
-        if struct_dat is None:
-            for name in param_dat.titles:
-                tp_out.write("{}.\n".format(name))
-        else:
-            for name in struct_dat.titles:
-                tp_out.write("{}.\n".format(name))
-        tp_out.write("\n")
-        tp_out.write("Current parameter values are available from the Amber site, located\nat http://ambermd.org/\n")
-        tp_out.write("\n\n")
-        tp_out.write("   ##################################\n")
-        tp_out.write("   ##                              ##\n")
-        tp_out.write("   ##  Tinker Atom Class Numbers   ##\n")
-        tp_out.write("   ##      to Amber Atom Types     ##\n")
-        tp_out.write("   ##                              ##\n")
-        for atom in atom_types.items():
-            tp_out.write("   ##           {:3}  {:<4}          ##\n".format(atom[1], atom[0]))
-        tp_out.write("   ##                              ##\n")
-        tp_out.write("   ##################################\n")
-        tp_out.write("\n\n")
-        tp_out.write("      #############################\n")
-        tp_out.write("      ##                         ##\n")
-        tp_out.write("      ##  Atom Type Definitions  ##\n")
-        tp_out.write("      ##                         ##\n")
-        tp_out.write("      #############################\n")
-        tp_out.write("\n\n")
-        for i in range(len(res_df)):
-            ## Test_ion is to try and figure out letters of Atom Type
-            ## Test_AT is to try the guess atom connectivity from Atom Type
-            test_ion = atom_types.get(res_df.loc[i,'type'])
-            test_AT = atom_connect.get(res_df.loc[i,'type'])
-            if test_ion is None:
-                guess_type = "999"
-                guess_connect = "0 !! GUESSED TYPE AND CONNECTION"
-                tp_out.write("atom       {:4}  {:2}    {:<4}  \"{:<30} {:3}   {:>7.2f}    {}\n".format((i+1),\
-                 guess_type, res_df.loc[i,'type'],\
-                 (res_df.loc[i, 'resname'] + " " + res_df.loc[i, 'name']+'\"'),\
-                 res_df.loc[i, 'atomic_number'], res_df.loc[i, 'mass'],\
-                 guess_connect))
-            ## Attempt key retrieval
-            elif test_AT is None:
-                if res_df.loc[i,'type'][0] in ('C', 'N'):
-                    guess_connect = "3 !! GUESSED CONNECTION"
-                    tp_out.write("atom       {:4}  {:2}    {:<4}  \"{:<30} {:3}   {:>7.2f}    {}\n".format((i+1),\
-                     atom_types[res_df.loc[i,'type']], res_df.loc[i,'type'],\
-                     (res_df.loc[i, 'resname'] + " " + res_df.loc[i, 'name']+'\"'),\
-                     res_df.loc[i, 'atomic_number'], res_df.loc[i, 'mass'],\
-                     guess_connect))
-                elif res_df.loc[i,'type'][0] in ('O', 'S'):
-                    guess_connect = "2 !! GUESSED CONNECTION"
-                    tp_out.write("atom       {:4}  {:2}    {:<4}  \"{:<30} {:3}   {:>7.2f}    {}\n".format((i+1),\
-                     atom_types[res_df.loc[i,'type']], res_df.loc[i,'type'],\
-                     (res_df.loc[i, 'resname'] + " " + res_df.loc[i, 'name']+'\"'),\
-                     res_df.loc[i, 'atomic_number'], res_df.loc[i, 'mass'],\
-                     guess_connect))
-                elif res_df.loc[i,'type'][0] == 'H':
-                    guess_connect = "1 !! GUESSED CONNECTION"
-                    tp_out.write("atom       {:4}  {:2}    {:<4}  \"{:<30} {:3}   {:>7.2f}    {}\n".format((i+1),\
-                     atom_types[res_df.loc[i,'type']], res_df.loc[i,'type'],\
-                     (res_df.loc[i, 'resname'] + " " + res_df.loc[i, 'name']+'\"'),\
-                     res_df.loc[i, 'atomic_number'], res_df.loc[i, 'mass'],\
-                     guess_connect))
-                else:
-                    guess_connect = "0 !! GUESSED CONNECTION"
-                    tp_out.write("atom       {:4}  {:2}    {:<4}  \"{:<30} {:3}   {:>7.2f}    {}\n".format((i+1),\
-                     atom_types[res_df.loc[i,'type']], res_df.loc[i,'type'],\
-                     (res_df.loc[i, 'resname'] + " " + res_df.loc[i, 'name']+'\"'),\
-                     res_df.loc[i, 'atomic_number'], res_df.loc[i, 'mass'],\
-                     guess_connect))
-            else:
-                tp_out.write("atom       {:4}  {:2}    {:<4}  \"{:<30} {:3}   {:>7.2f}    {}\n".format((i+1),\
-                 atom_types[res_df.loc[i,'type']], res_df.loc[i,'type'],\
-                 (res_df.loc[i, 'resname'] + " " + res_df.loc[i, 'name']+'\"'),\
-                 res_df.loc[i, 'atomic_number'], res_df.loc[i, 'mass'],\
-                 atom_connect[res_df.loc[i,'type']]))
-        tp_out.write("\n\n")
-        tp_out.write("      ################################\n")
-        tp_out.write("      ##                            ##\n")
-        tp_out.write("      ##  Van der Waals Parameters  ##\n")
-        tp_out.write("      ##                            ##\n")
-        tp_out.write("      ################################\n")
-        tp_out.write("\n\n")
-        for i, (value1, value2) in enumerate(zip(rmin14_dict.items(), eps14_dict.items())):
-            ## Get around immutable tuple by setting as a list
-            value1 = list(value1)
-            value2 = list(value2)
-            if value1[1] is None:
-                value1[1] = -0.0000
-                print("WARNING! {} has no listed rmin_14 value (VDW). Setting to -0.0000.".format(value1[0]))
-            if value2[1] is None:
-                value2[1] = -0.000
-                print("WARNING! {} has no listed epsilon_14 value (VDW). Setting to -0.0000.".format(value2[0]))
-            tp_out.write("vdw          {:2}               {:>8.4f}     {:>12.7f}\n".format((i+1), value1[1], value2[1]))
-        tp_out.write("\n\n")
-        tp_out.write("      ##################################\n")
-        tp_out.write("      ##                              ##\n")
-        tp_out.write("      ##  Bond Stretching Parameters  ##\n")
-        tp_out.write("      ##                              ##\n")
-        tp_out.write("      ##################################\n")
-        tp_out.write("\n\n")
-        for i in range(len(bond1)):
-            tp_out.write("bond        {:3}  {:3}          {:3.2f}     {:1.4f}\n".format(bond1[i],\
-             bond2[i], bond_k[i], bond_req[i]))
-        tp_out.write("\n\n")
-        tp_out.write("      ################################\n")
-        tp_out.write("      ##                            ##\n")
-        tp_out.write("      ##  Angle Bending Parameters  ##\n")
-        tp_out.write("      ##                            ##\n")
-        tp_out.write("      ################################\n")
-        tp_out.write("\n\n")
+        tp_out.write(prm_header(param_dat, struct_dat, atom_types, ff_name))
+        tp_out.write(prm_banner("Atom Type Definitions"))
+        tp_out.writelines(atom_lines(res_df, atom_types, atom_connect,
+         res_df.index + 1))
+        tp_out.write("\n\n" + prm_banner("Van der Waals Parameters"))
+        tp_out.writelines(
+         "vdw          {:2}               {:>8.4f}     {:>12.7f}\n".format(*vdw)
+         for vdw in vdw_values(rmin14_dict, eps14_dict, atom_types))
+        tp_out.write("\n\n" + prm_banner("Bond Stretching Parameters"))
+        tp_out.writelines(
+         "bond        {:3}  {:3}          {:3.2f}     {:1.4f}\n".format(*bond)
+         for bond in zip(bond1, bond2, bond_k, bond_req))
+        tp_out.write("\n\n" + prm_banner("Angle Bending Parameters"))
         ## You might be able to loop through for any of the 999 choices!
-        for i in range(len(angle1)):
-            tp_out.write("angle        {:2}   {:2}   {:2}     {:>5.1f}     {:>6.2f}\n".format(angle1[i],\
-             angle2[i], angle3[i], ang_k[i], ang_theteq[i], sep=' '))
-        tp_out.write("\n\n")
-        tp_out.write("      #####################################\n")
-        tp_out.write("      ##                                 ##\n")
-        tp_out.write("      ##  Improper Torsional Parameters  ##\n")
-        tp_out.write("      ##                                 ##\n")
-        tp_out.write("      #####################################\n")
-        tp_out.write("\n\n")
-        for i in range(len(imptor1)):
-            tp_out.write("imptors      {:3}  {:3}  {:3}  {:3}           {:6}  {:5}  {:1}\n".format(imptor1[i],\
-             imptor2[i], imptor3[i], imptor4[i], imp_diheds_phik[i], imp_diheds_phase[i], imp_diheds_per[i]))
-        tp_out.write("\n\n")
-        tp_out.write("            ############################\n")
-        tp_out.write("            ##                        ##\n")
-        tp_out.write("            ##  Torsional Parameters  ##\n")
-        tp_out.write("            ##                        ##\n")
-        tp_out.write("            ############################\n")
-        tp_out.write("\n\n")
-        ## If you don't want Xs in output
-        dihed_df.to_string(tp_out, header=False, index=False, index_names=False)
-        tp_out.write("\n\n")
-        tp_out.write("      ########################################\n")
-        tp_out.write("      ##                                    ##\n")
-        tp_out.write("      ##  Atomic Partial Charge Parameters  ##\n")
-        tp_out.write("      ##                                    ##\n")
-        tp_out.write("      ########################################\n")
-        tp_out.write("\n\n")
-        for i in range(len(res_df)):
-            tp_out.write("charge     {:>4}              {:>8.4f}\n".format((i+1), res_df.loc[i,'charge']))
+        tp_out.writelines(
+         "angle        {:2}   {:2}   {:2}     {:>5.1f}     {:>6.2f}\n".format(
+         *angle) for angle in zip(angle1, angle2, angle3, ang_k, ang_theteq))
+        tp_out.write("\n\n" + prm_banner("Improper Torsional Parameters"))
+        tp_out.writelines(
+         "imptors      {:3}  {:3}  {:3}  {:3}           {:6}  {:5}  {:1}\n".format(
+         *imptor) for imptor in zip(imptor1, imptor2, imptor3, imptor4,
+         imp_diheds_phik, imp_diheds_phase, imp_diheds_per))
+        tp_out.write("\n\n" + prm_banner("Torsional Parameters", indent=12))
+        tp_out.writelines(
+         "torsion      {:3}  {:3}  {:3}  {:3}           {:6}\n".format(*torsion)
+         for torsion in torsions)
+        tp_out.write("\n\n" + prm_banner("Atomic Partial Charge Parameters"))
+        tp_out.writelines("charge     {:>4}              {:>8.4f}\n".format(
+         i+1, charge) for i, charge in zip(res_df.index,
+         res_df['charge'].to_numpy()))
         tp_out.write("\n\n")
         ## You might need biotype, but I don't know if it's actually used.
-        tp_out.close()
     print(" Always remember to check the new parameters with TINKER analyze.")
-    print(" atom       {:4}  {:2}    {:<4}   missing important terms, especially from solvent.\n")
+    print(" You may be missing important terms, especially from solvent.\n")
+
+def write_params_noX(param_dat, struct_dat, atom_types,\
+ bond1, bond2, bond_k, bond_req, \
+ angle1, angle2, angle3, ang_k, ang_theteq,\
+ imptor1, imptor2, imptor3, imptor4, imp_diheds_phik, imp_diheds_phase,\
+ imp_diheds_per, torsions, res_df,\
+ rmin14_dict, eps14_dict, ff_name, atom_connect, param_file_name):
+    """Generate the new TINKER parameter file.
+    """
+    ## If you don't want Xs in output
+    write_prm(param_dat, struct_dat, atom_types,\
+     bond1, bond2, bond_k, bond_req,\
+     angle1, angle2, angle3, ang_k, ang_theteq,\
+     imptor1, imptor2, imptor3, imptor4, imp_diheds_phik, imp_diheds_phase,\
+     imp_diheds_per, torsions, res_df,\
+     rmin14_dict, eps14_dict, ff_name, atom_connect, param_file_name)
 
 def write_params(param_dat, struct_dat, atom_types,\
  bond1, bond2, bond_k, bond_req,\
@@ -721,213 +960,75 @@ def write_params(param_dat, struct_dat, atom_types,\
  rmin14_dict, eps14_dict, ff_name, atom_connect, param_file_name):
     """Generate the new TINKER parameter file.
     """
-    with open(param_file_name, "w+") as tp_out:
-        tp_out.write("\n")
-        tp_out.write("      ##############################\n")
-        tp_out.write("      ##                          ##\n")
-        tp_out.write("      ##  Force Field Definition  ##\n")
-        tp_out.write("      ##                          ##\n")
-        tp_out.write("      ##############################\n")
-        tp_out.write("\n\n")
-        tp_out.write("forcefield              AMBER-{}\n\n".format(ff_name))
-        tp_out.write("vdwtype                 LENNARD-JONES\n")
-        tp_out.write("radiusrule              ARITHMETIC\n")
-        tp_out.write("radiustype              R-MIN\n")
-        tp_out.write("radiussize              RADIUS\n")
-        tp_out.write("epsilonrule             GEOMETRIC\n")
-        if struct_dat is None:
-            tp_out.write("vdw-14-scale            {}\n".format(param_dat.default_scnb))
-            tp_out.write("chg-14-scale            {}\n".format(param_dat.default_scee))
-        else:
-            tp_out.write("vdw-14-scale            {}\n".format(struct_dat.default_scnb))
-            tp_out.write("chg-14-scale            {}\n".format(struct_dat.default_scee))
-        tp_out.write("electric                {:.7f}\n".format(pmd.constants.AMBER_ELECTROSTATIC**2))
-        tp_out.write("dielectric              1.0\n")
-        tp_out.write("\n\n")
-        tp_out.write("      #############################\n")
-        tp_out.write("      ##                         ##\n")
-        tp_out.write("      ##  Literature References  ##\n")
-        tp_out.write("      ##                         ##\n")
-        tp_out.write("      #############################\n")
-        tp_out.write("\n\n")
-        tp_out.write("\nThis was generated using parmed from the following parameter sets:\n")
-        if struct_dat is None:
-            for name in param_dat.titles:
-                tp_out.write("{}.\n".format(name))
-        else:
-            for name in struct_dat.titles:
-                tp_out.write("{}.\n".format(name))
-        tp_out.write("\n")
-        tp_out.write("Current parameter values are available from the Amber site, located\nat http://ambermd.org/\n")
-        tp_out.write("\n\n")
-        tp_out.write("   ##################################\n")
-        tp_out.write("   ##                              ##\n")
-        tp_out.write("   ##  Tinker Atom Class Numbers   ##\n")
-        tp_out.write("   ##      to Amber Atom Types     ##\n")
-        tp_out.write("   ##                              ##\n")
-        for atom in atom_types.items():
-            tp_out.write("   ##           {:3}  {:<4}          ##\n".format(atom[1], atom[0]))
-        tp_out.write("   ##                              ##\n")
-        tp_out.write("   ##################################\n")
-        tp_out.write("\n\n")
-        tp_out.write("      #############################\n")
-        tp_out.write("      ##                         ##\n")
-        tp_out.write("      ##  Atom Type Definitions  ##\n")
-        tp_out.write("      ##                         ##\n")
-        tp_out.write("      #############################\n")
-        tp_out.write("\n\n")
-        for i in range(len(res_df)):
-            ## Test_ion is to try and figure out letters of Atom Type
-            ## Test_AT is to try the guess atom connectivity from Atom Type
-            test_ion = atom_types.get(res_df.loc[i,'type'])
-            test_AT = atom_connect.get(res_df.loc[i,'type'])
-            if test_ion is None:
-                guess_type = "999"
-                guess_connect = "0 !! GUESSED TYPE AND CONNECTION"
-                tp_out.write("atom       {:4}  {:2}    {:<4}  \"{:<30} {:3}   {:>7.2f}    {}\n".format((i+1),\
-                 guess_type, res_df.loc[i,'type'],\
-                 (res_df.loc[i, 'resname'] + " " + res_df.loc[i, 'name']+'\"'),\
-                 res_df.loc[i, 'atomic_number'], res_df.loc[i, 'mass'],\
-                 guess_connect))
-            ## Attempt key retrieval
-            elif test_AT is None:
-                if res_df.loc[i,'type'][0] in ('C', 'N'):
-                    guess_connect = "3 !! GUESSED CONNECTION"
-                    tp_out.write("atom       {:4}  {:2}    {:<4}  \"{:<30} {:3}   {:>7.2f}    {}\n".format((i+1),\
-                     atom_types[res_df.loc[i,'type']], res_df.loc[i,'type'],\
-                     (res_df.loc[i, 'resname'] + " " + res_df.loc[i, 'name']+'\"'),\
-                     res_df.loc[i, 'atomic_number'], res_df.loc[i, 'mass'],\
-                     guess_connect))
-                elif res_df.loc[i,'type'][0] in ('O', 'S'):
-                    guess_connect = "2 !! GUESSED CONNECTION"
-                    tp_out.write("atom       {:4}  {:2}    {:<4}  \"{:<30} {:3}   {:>7.2f}    {}\n".format((i+1),\
-                     atom_types[res_df.loc[i,'type']], res_df.loc[i,'type'],\
-                     (res_df.loc[i, 'resname'] + " " + res_df.loc[i, 'name']+'\"'),\
-                     res_df.loc[i, 'atomic_number'], res_df.loc[i, 'mass'],\
-                     guess_connect))
-                elif res_df.loc[i,'type'][0] == 'H':
-                    guess_connect = "1 !! GUESSED CONNECTION"
-                    tp_out.write("atom       {:4}  {:2}    {:<4}  \"{:<30} {:3}   {:>7.2f}    {}\n".format((i+1),\
-                     atom_types[res_df.loc[i,'type']], res_df.loc[i,'type'],\
-                     (res_df.loc[i, 'resname'] + " " + res_df.loc[i, 'name']+'\"'),\
-                     res_df.loc[i, 'atomic_number'], res_df.loc[i, 'mass'],\
-                     guess_connect))
-                else:
-                    guess_connect = "0 !! GUESSED CONNECTION"
-                    tp_out.write("atom       {:4}  {:2}    {:<4}  \"{:<30} {:3}   {:>7.2f}    {}\n".format((i+1),\
-                     atom_types[res_df.loc[i,'type']], res_df.loc[i,'type'],\
-                     (res_df.loc[i, 'resname'] + " " + res_df.loc[i, 'name']+'\"'),\
-                     res_df.loc[i, 'atomic_number'], res_df.loc[i, 'mass'],\
-                     guess_connect))
-            else:
-                tp_out.write("atom       {:4}  {:2}    {:<4}  \"{:<30} {:3}   {:>7.2f}    {}\n".format((i+1),\
-                 atom_types[res_df.loc[i,'type']], res_df.loc[i,'type'],\
-                 (res_df.loc[i, 'resname'] + " " + res_df.loc[i, 'name']+'\"'),\
-                 res_df.loc[i, 'atomic_number'], res_df.loc[i, 'mass'],\
-                 atom_connect[res_df.loc[i,'type']]))
-        tp_out.write("\n\n")
-        tp_out.write("      ################################\n")
-        tp_out.write("      ##                            ##\n")
-        tp_out.write("      ##  Van der Waals Parameters  ##\n")
-        tp_out.write("      ##                            ##\n")
-        tp_out.write("      ################################\n")
-        tp_out.write("\n\n")
-        for i, (value1, value2) in enumerate(zip(rmin14_dict.items(), eps14_dict.items())):
-            ## Get around immutable tuple by setting as a list
-            value1 = list(value1)
-            value2 = list(value2)
-            if value1[1] is None:
-                value1[1] = -0.0000
-                print("WARNING! {} has no listed rmin_14 value (VDW). Setting to -0.0000.".format(value1[0]))
-            if value2[1] is None:
-                value2[1] = -0.000
-                print("WARNING! {} has no listed epsilon_14 value (VDW). Setting to -0.0000.".format(value2[0]))
-            tp_out.write("vdw          {:2}               {:>8.4f}     {:>12.7f}\n".format((i+1), value1[1], value2[1]))
-        tp_out.write("\n\n")
-        tp_out.write("      ##################################\n")
-        tp_out.write("      ##                              ##\n")
-        tp_out.write("      ##  Bond Stretching Parameters  ##\n")
-        tp_out.write("      ##                              ##\n")
-        tp_out.write("      ##################################\n")
-        tp_out.write("\n\n")
-        for i in range(len(bond1)):
-            tp_out.write("bond        {:3}  {:3}          {:3.2f}     {:1.4f}\n".format(bond1[i],\
-             bond2[i], bond_k[i], bond_req[i]))
-        tp_out.write("\n\n")
-        tp_out.write("      ################################\n")
-        tp_out.write("      ##                            ##\n")
-        tp_out.write("      ##  Angle Bending Parameters  ##\n")
-        tp_out.write("      ##                            ##\n")
-        tp_out.write("      ################################\n")
-        tp_out.write("\n\n")
-        ## You might be able to loop through for any of the 999 choices!
-        for i in range(len(angle1)):
-            tp_out.write("angle        {:2}   {:2}   {:2}     {:>5.1f}     {:>6.2f}\n".format(angle1[i],\
-             angle2[i], angle3[i], ang_k[i], ang_theteq[i], sep=' '))
-        tp_out.write("\n\n")
-        tp_out.write("      #####################################\n")
-        tp_out.write("      ##                                 ##\n")
-        tp_out.write("      ##  Improper Torsional Parameters  ##\n")
-        tp_out.write("      ##                                 ##\n")
-        tp_out.write("      #####################################\n")
-        tp_out.write("\n\n")
-        for i in range(len(imptor1)):
-            tp_out.write("imptors      {:3}  {:3}  {:3}  {:3}           {:6}  {:5}  {:1}\n".format(imptor1[i],\
-             imptor2[i], imptor3[i], imptor4[i], imp_diheds_phik[i], imp_diheds_phase[i], imp_diheds_per[i]))
-        tp_out.write("\n\n")
-        tp_out.write("            ############################\n")
-        tp_out.write("            ##                        ##\n")
-        tp_out.write("            ##  Torsional Parameters  ##\n")
-        tp_out.write("            ##                        ##\n")
-        tp_out.write("            ############################\n")
-        tp_out.write("\n\n")
-        ## If you WANT Xs in output
-        for i in range(len(dihedral1)):
-            tp_out.write("torsion      {:3}  {:3}  {:3}  {:3}           {:6}\n".format(dihedral1[i],\
-             dihedral2[i], dihedral3[i], dihedral4[i], di_line[i]))
-        tp_out.write("\n\n")
-        tp_out.write("      ########################################\n")
-        tp_out.write("      ##                                    ##\n")
-        tp_out.write("      ##  Atomic Partial Charge Parameters  ##\n")
-        tp_out.write("      ##                                    ##\n")
-        tp_out.write("      ########################################\n")
-        tp_out.write("\n\n")
-        for i in range(len(res_df)):
-            tp_out.write("charge     {:>4}              {:>8.4f}\n".format((i+1), res_df.loc[i,'charge']))
-        tp_out.write("\n\n")
-        ## You might need biotype, but I don't know if it's actually used.
-        tp_out.close()
-    print(" Always remember to check the new parameters with TINKER analyze.")
-    print(" You may be missing important terms, especially from solvent.\n")
+    ## If you WANT Xs in output
+    write_prm(param_dat, struct_dat, atom_types,\
+     bond1, bond2, bond_k, bond_req,\
+     angle1, angle2, angle3, ang_k, ang_theteq,\
+     imptor1, imptor2, imptor3, imptor4, imp_diheds_phik, imp_diheds_phase,\
+     imp_diheds_per, zip(dihedral1, dihedral2, dihedral3, dihedral4, di_line),\
+     res_df, rmin14_dict, eps14_dict, ff_name, atom_connect, param_file_name)
 
 ###########
 ##  RUN  ##
 ###########
-struct_dat = det_structure(param_dat)
+param_dat, struct_dat, topology_dat = load_source(source_params, source_method,
+ param_cache_dir)
 
 atom_types = get_ATs(param_dat, struct_dat)
 
+manifest = None
+if previous_prm is not None and compact_types:
+    print(" WARNING! compact_types renumbers the atom types, so it can't keep"
+     " the ones\n from previous_prm. Writing every atom type instead.\n")
+    compact_types = False
+if previous_prm is not None:
+    manifest = read_manifest(previous_prm)
+    old_terms = read_prm_terms(previous_prm)
+    if manifest.get('compact_types', False):
+        print(" WARNING! {} has compacted atom types, so only its classes"
+         " are kept.\n".format(previous_prm))
+        old_terms['atom'] = {}
+        old_terms['charge'] = {}
+    atom_types = pin_atom_types(atom_types, manifest)
+
 atom_connect = guess_connectivity(atom_types)
 
 rmin14_dict, eps14_dict = get_VDW(param_dat, struct_dat)
 
-bond1, bond2, bond_k, bond_req = get_bonds(param_dat, atom_types)
+bond_terms, angle_terms, dihedral_terms, improper_terms, res_df = \
+ extract_sections(param_dat, struct_dat, topology_dat, atom_types, n_procs)
 
-angle1, angle2, angle3, ang_k, ang_theteq = get_angles(param_dat, atom_types)
+bond1, bond2, bond_k, bond_req = bond_terms
 
-dihedral1, dihedral2, dihedral3, dihedral4, dval = get_dihedrals(param_dat, \
- struct_dat, atom_types)
+angle1, angle2, angle3, ang_k, ang_theteq = angle_terms
 
-di_line = clean_dihedrals(dval)
-
-if leave_as_X == False:
-    dihed_df = build_X_dihedrals(dihedral1, dihedral2, dihedral3, dihedral4, atom_types, di_line)
+dihedral1, dihedral2, dihedral3, dihedral4, dval, di_line = dihedral_terms
 
 imptor1, imptor2, imptor3, imptor4, imp_diheds_phik, imp_diheds_phase,\
- imp_diheds_per = get_improper_torsions(param_dat, struct_dat)
+ imp_diheds_per = improper_terms
 
-# res_df = get_atomlist(param_dat, rmin14_dict, eps14_dict)
-res_df = get_atomlist(param_dat, struct_dat)
+if manifest is not None:
+    res_df = pin_atom_numbers(res_df, manifest)
+
+atom_df = res_df
+if compact_types:
+    res_df, type_numbers = compact_atom_types(atom_df, atom_types, atom_connect)
+    write_type_map(param_file_name, atom_df, type_numbers, atom_types,
+     atom_connect)
+
+if leave_as_X == False:
+    X_present = None
+    if topology_dat is not None:
+        X_present = get_topology_torsions(topology_dat['torsions'], atom_types)
+    elif X_topology is not None:
+        X_present = get_topology_torsions(topology_torsion_types(
+         pmd.load_file(X_topology)), atom_types)
+    ## Count everything first, then stream the torsions into the file
+    count_X_dihedrals(dihedral1, dihedral2, dihedral3, dihedral4, atom_types,
+     di_line, X_present, 2*len(res_df) + len(rmin14_dict) + len(bond1) +
+     len(angle1) + len(imptor1), maxprm)
+    torsions = build_X_dihedrals(dihedral1, dihedral2, dihedral3, dihedral4,
+     atom_types, di_line, X_present)
 
 if leave_as_X == True:
     write_params(param_dat, struct_dat, atom_types,\
@@ -941,5 +1042,11 @@ else:
      bond1, bond2, bond_k, bond_req, \
      angle1, angle2, angle3, ang_k, ang_theteq,\
      imptor1, imptor2, imptor3, imptor4, imp_diheds_phik, imp_diheds_phase,\
-     imp_diheds_per, dihed_df, res_df,\
+     imp_diheds_per, torsions, res_df,\
      rmin14_dict, eps14_dict, ff_name, atom_connect, param_file_name)
+
+if manifest is not None:
+    merge_prm(old_terms, param_file_name)
+
+write_manifest(param_file_name, source_params, source_method, atom_types,
+ atom_df, compact_types, manifest)
@@ -2,118 +2,68 @@
 import parmed as pmd
 import numpy as np
 import pandas as pd
+import hashlib
+import inspect
+import io
+import os
+import pickle
 import re
 import sys
+from pdbxyz_common import (read_renames, clean_names, read_pdb_arrays,
+ assign_bonds_arrays, clean_arrays, structure_arrays, xyz_bondstrings,
+ write_xyz_arrays, find_frames, read_pdb_models, batch_coords, convert_batch)
 
 infile="polk_2mGS_frame_139.pdb"
 outfile="polk_2mGS_frame_139_convert.xyz"
 
 param_file="amber99_CTP_mod.prm"
-atom_lines="atom-lines.txt"
+## Folder for the cached, fixed prm atom lines
+prm_cache_dir="prm-cache"
+## Optional CSV of extra search,replace aliases for the prm atom names
+alias_file="param-aliases.csv"
 
 test_csv="test.csv"
 
-def clean_atoms(temp):
-    """ILE, LEU, ASN, THR, GLN, and VAL all have screwy 4-letter hydrogens,
-    as do ALL DNA residues. This fixes that."""
-    for atom in temp.atoms:
-        if atom.name == 'HD11':
-            atom.name = '1HD1'
-        if atom.name == 'HD12':
-            atom.name = '2HD1'
-        if atom.name == 'HD13':
-            atom.name = '3HD1'
-        if atom.name == 'HD21':
-            atom.name = '1HD2'
-        if atom.name == 'HD22':
-            atom.name = '2HD2'
-        if atom.name == 'HD23':
-            atom.name = '3HD2'
-        if atom.name == 'HG11':
-            atom.name = '1HG1'
-        if atom.name == 'HG12':
-            atom.name = '2HG1'
-        if atom.name == 'HG13':
-            atom.name = '3HG1'
-        if atom.name == 'HG21':
-            atom.name = '1HG2'
-        if atom.name == 'HG22':
-            atom.name = '2HG2'
-        if atom.name == 'HG23':
-            atom.name = '3HG2'
-        if atom.name == 'HE21':
-            atom.name = '1HE2'
-        if atom.name == 'HE22':
-            atom.name = '2HE2'
-        # if atom.name == 'H2\'1':
-        #     atom.name = '1H2\''
-        # if atom.name == 'H2\'2':
-        #     atom.name = '2H2\''
-    ## Terminal hydrogens on DNA are different
-    ## in the stinking parameter file, so fix it.
-    for atom in temp.atoms:
-        if atom.name == 'H5\'':
-            atom.name = 'H5\'1'
-            # atom.name = '1H5\''
-        if atom.name == 'H5\'\'':
-            atom.name = 'H5\'2'
-            # atom.name = '2H5\''
-        if atom.name == 'H2\'':
-            atom.name = 'H2\'1'
-            # atom.name = '1H2\''
-        if atom.name == 'H2\'\'':
-            atom.name = 'H2\'2'
-            # atom.name = '2H2\''
-        if atom.name == 'HO3\'':
-            atom.name = 'H3T'
-        if atom.name == 'HO2\'':
-            atom.name = 'HO\'2'
-        # if atom.name == 'H5\'1':
-        #     atom.name = '1H5\''
-        # if atom.name == 'H5\'2':
-        #     atom.name = '2H5\''
-    ## Deal with C and N Terminals
-    ## If there's a terminal OXT for the protein, use as CTERM
-    for residue in temp.residues:
-        for atom in residue.atoms:
-            if atom.name == 'OXT':
-                residue.name = 'C'+residue.name
-            ## Standardize ions
-            ## If the +/- is last character, don't escape it.
-            elif atom.name in ('K+', 'K', 'K\+1', 'k', 'k+'):
-                atom.name = 'K'
-                residue.name = 'K'
-            elif atom.name in ('MG', 'MG2', 'MG2+', 'Mg2', 'MG\+2', 'Mg2+',
-             'Mg\+2'):
-                atom.name = 'MG'
-                residue.name = 'MG'
-            elif atom.name in ('ZN', 'ZN2', 'ZN2+', 'Zn2', 'ZN\+2', 'Zn2+',
-             'Zn\+2'):
-                atom.name = 'ZN'
-                residue.name = 'ZN'
-            elif atom.name in ('CL', 'CL-', 'CL1-', 'Cl', 'CL\-1', 'Cl1-',
-             'Cl\-1'):
-                atom.name = 'CL'
-                residue.name = 'CL'
-            else:
-                continue
-        ## If there's an H3 in a protein residue, use NTERM
-        if residue.name in ('ALA', 'ARG', 'ASN', 'ASP', 'CYS', 'CYX', 'GLN',
-         'GLU', 'GLY', 'HID', 'HIE', 'HIP', 'HIS', 'ILE', 'LEU', 'LYS', 'MET',
-         'PHE', 'PRO', 'SER', 'THR', 'TRP', 'TYR', 'VAL'):
-            for atom in residue.atoms:
-                if atom.name == 'H3':
-                    residue.name = 'N'+residue.name
+## Table of PDB atom and residue renames shared by both converters, kept
+## next to the scripts
+rename_file=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+ "pdb-renames.csv")
+## Kinds of renames from rename_file to use
+rename_kinds=("hydrogen", "ion")
+
+## Read and bond the PDB with the native reader instead of building a parmed
+## structure, which is much faster for large systems
+native_pdb=False
+
+## Batch mode: a glob or list of PDB frames (multi-model PDBs and DCDs work
+## too) with the same atoms as infile. infile is typed once and an XYZ is
+## written for every frame. Leave as None to only convert infile.
+batch_frames=None
+## Ending that replaces the frame file extension for its XYZ
+batch_suffix="_convert.xyz"
+## Number of processes writing the frames
+n_procs=os.cpu_count()
+
+def clean_atoms(temp, renames):
+    """Fix the atom and residue names of a parmed structure with
+    clean_names."""
+    names, res_names = clean_names([atom.name for atom in temp.atoms],
+     np.array([atom.residue.idx for atom in temp.atoms], dtype=int),
+     [residue.name for residue in temp.residues], renames)
+    for atom, name in zip(temp.atoms, names):
+        atom.name = name
+    for residue, res_name in zip(temp.residues, res_names):
+        residue.name = res_name
 
 
 ## Mercileslly taken from Mark's pdbtinker.py
-def load_pdb(filename):
+def load_pdb(filename, renames):
     """Loads in PDB using parmed and sets atom masses to zero. Atom masses are
     then used to store the Tinker atom types for XYZ conversion."""
     system = pmd.load_file(filename)
     for atom in system.atoms:
         atom.mass = 0
-    clean_atoms(system)
+    clean_atoms(system, renames)
     return system
 
 # class Typing:
@@ -127,30 +77,58 @@ def load_pdb(filename):
 # a1 = Typing(1, 14, "N", "Glycine", "N")
 # print(a1.T_type, a1.T_atom_class, a1.A_atom_type, a1.res_name, a1.atom_name)
 
-## grep "^atom" param_file > atom_lines
-def read_prm(param_file, atom_lines):
-    """Based on using grep to locate atom lines."""
-    parm_atom_lines = []
-    pattern = '(?i)^atom' # case insensitive, starts line
-    for line in open(param_file).readlines():
-        if re.match(pattern, line):
-            parm_atom_lines.append(line)
-    ## Write a file of all the atom lines for use later
-    with open(atom_lines, 'w') as filehandle:
-        filehandle.writelines("%s" % line for line in parm_atom_lines)
-    filehandle.close()
+## grep "^atom" param_file
+def read_prm(param_file):
+    """Based on using grep to locate atom lines. Returns the list of atom
+    lines for fix_params."""
+    pattern = re.compile('(?i)^atom') # case insensitive, starts line
+    with open(param_file) as prm_in:
+        parm_atom_lines = [line for line in prm_in if pattern.match(line)]
+    return parm_atom_lines
+
+def read_name_rules(alias_file):
+    """Read user-defined aliases for fix_params from a CSV file with a
+    `search,replace` header, like `DUP -Phosphate,CTP`. The search string is
+    a case-insensitive regular expression for the quoted part of the prm atom
+    lines, and the replace string is the ResName in the PDB. These are tried
+    before the built-in rules. Returns an empty list if there's no file."""
+    if not os.path.isfile(alias_file):
+        return []
+    aliases = pd.read_csv(alias_file, dtype=str, keep_default_na=False)
+    return [('(?i)'+search, replace) for search, replace in
+     zip(aliases['search'], aliases['replace'])]
+
+def normalize_names(names, name_rules):
+    """Apply the ordered (search, replace) name_rules to a pandas Series in
+    one pass. The rules are joined into a single regex alternation with one
+    named group per rule, and each match is swapped for the replacement of
+    the rule that matched. When two rules could match at the same spot, the
+    earlier one wins."""
+    patterns = []
+    replacements = {}
+    for i, (search, replace) in enumerate(name_rules):
+        ## Scope a leading (?i) to just this rule
+        if search.startswith('(?i)'):
+            search = '(?i:' + search[4:] + ')'
+        patterns.append('(?P<r{}>{})'.format(i, search))
+        replacements['r{}'.format(i)] = replace
+    name_regex = re.compile('|'.join(patterns))
+    return names.str.replace(name_regex,
+     lambda match: replacements[match.lastgroup], regex=True)
 
 # def fix_params(atom_lines):
-def fix_params(atom_lines,test_csv):
-    """Read the atom_lines file into a pandas object. Rewrite the story
-    (quoted) section into PDB residue names and atom names through as series
-    of string replacements. This will work well for AMBER or AMOEBA sets."""
-    lines = pd.read_csv(atom_lines, sep='[\s]{2,}', header=None,
+def fix_params(atom_lines, test_csv, alias_file):
+    """Read the list of atom_lines into a pandas object. Rewrite the story
+    (quoted) section into PDB residue names and atom names with the ordered
+    name_rules (and any user aliases from alias_file), applied in a single
+    pass by normalize_names. This will work well for AMBER or AMOEBA sets."""
+    lines = pd.read_csv(io.StringIO(''.join(atom_lines)), sep='[\s]{2,}',
+     header=None,
      names=["what","T_type","T_atom_class","A_atom_type","A_names","element",
      "mass","connectivity"], engine='python')
 
     ## Remove the double quotes in the A_names column
-    lines.A_names = lines.A_names.replace({'"':''}, regex=True)
+    name_rules = [(r'"', '')]
 
     ## Determine if AMOEBA or AMBER based on aspartic acid
     ## While they vary by the space, this *should* check user-adjusted lines
@@ -158,232 +136,151 @@ def fix_params(atom_lines,test_csv):
     ## AMBER version needs to be ASP, AMOEBA is ASH
     trial = lines[lines['A_names'].str.contains(r'(?i)Aspartate', regex=True)]
     if trial['A_names'].any() == True:
-        lines.A_names = lines.A_names.str.replace(r'(?i)Aspartic Acid ', 'ASH',
-          regex=True)
-
-    ## Replace names of special residues (use the ?i regex to ignore case)
-    ## Histidine
-    lines.A_names = lines.A_names.str.replace(r'(?i)Histidine \(HD\)', 'HID',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Histidine \(HE\)', 'HIE',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Histidine \(\+\)', 'HIP',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)HIS \(HD\)', 'HID',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)HIS \(HE\)', 'HIE',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)HIS \(\+\)', 'HIP',
-      regex=True)
-    ## Cysteine
-    lines.A_names = lines.A_names.str.replace(r'(?i)Cysteine \(\-SH\)', 'CYS',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Cystine \(\-SS\-\)', 'CYX',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Cysteine Anion', 'CYM',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Cystine', 'CYX',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)CYS \(\-SH\)', 'CYS',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)CYS \(\-SS\-\)', 'CYX',
-      regex=True)
-    ## Lysine
-    lines.A_names = lines.A_names.str.replace(r'(?i)Lysine \(NH2\)', 'LYN',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Lysine \(Neutral\) ', 'LYN',
-      regex=True)
-    ## Tyrosine
-    lines.A_names = lines.A_names.str.replace(r'(?i)Tyrosine Anion', 'TYD',
-      regex=True)
-    ## Asp
-    lines.A_names = lines.A_names.str.replace(r'(?i)Aspartic Acid \(COOH\)',
-      'ASH', regex=True)
-    ## Caps and Termini
-    lines.A_names = lines.A_names.str.replace(r'(?i)Acetyl Cap', 'ACE',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)N\-MeAmide Cap', 'NME',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)N\-MeAmide', 'NME',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)N\-Term ', 'N',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)C\-Term ', 'C',
-      regex=True)
-    ## Atypical residues
-    lines.A_names = lines.A_names.str.replace(r'(?i)Ornithine', 'ORN',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)MethylAlanine', 'AIB',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Pyroglutamate', 'PCA',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Acetyl', 'ACE',
-      regex=True)
-
-    ## Replace standards with 3 letter codes
-    lines.A_names = lines.A_names.str.replace(r'(?i)Aspartic Acid', 'ASP',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Glutamic Acid', 'GLU',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Phenylalanine', 'PHE',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Alanine', 'ALA',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Arginine', 'ARG',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Asparagine', 'ASN',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Cysteine', 'CYS',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Glutamine', 'GLN',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Glycine', 'GLY',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Histidine', 'HIS',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Isoleucine', 'ILE',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Leucine', 'LEU',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Lysine', 'LYS',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Methionine', 'MET',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Proline', 'PRO',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Serine', 'SER',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Threonine', 'THR',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Tryptophan', 'TRP',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Tyrosine', 'TYR',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Valine', 'VAL',
-      regex=True)
+        name_rules.append((r'(?i)Aspartic Acid ', 'ASH'))
 
-    ## RNA
-    lines.A_names = lines.A_names.str.replace(r'(?i)R-Adenosine', 'RA',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)R-Guanosine', 'RG',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)R-Cytosine', 'RC',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)R-Uracil', 'RU',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)R\-Phosphodiester', 'RX',
-      regex=True)
-    ## The O5' and HO5' have same name in prm file; address it
-    lines.A_names = lines.A_names.str.replace(r'(?i)R\-5\'\-Hydroxyl O5\'',
-      'RX5 HO5\'', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)R\-5\'\-Hydroxyl', 'RX5',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)R\-5\'\-Phosphate', 'RX5',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)R\-3\'\-Phosphate', 'RX3',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)R\-3\'\-Hydroxyl O3\'',
-      'RX3 HO3\'', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)R\-3\'\-Hydroxyl', 'RX3',
-      regex=True)
+    name_rules += [
+        ## Replace names of special residues (use the ?i regex to ignore case)
+        ## Histidine
+        (r'(?i)Histidine \(HD\)', 'HID'),
+        (r'(?i)Histidine \(HE\)', 'HIE'),
+        (r'(?i)Histidine \(\+\)', 'HIP'),
+        (r'(?i)HIS \(HD\)', 'HID'),
+        (r'(?i)HIS \(HE\)', 'HIE'),
+        (r'(?i)HIS \(\+\)', 'HIP'),
+        ## Cysteine
+        (r'(?i)Cysteine \(\-SH\)', 'CYS'),
+        (r'(?i)Cystine \(\-SS\-\)', 'CYX'),
+        (r'(?i)Cysteine Anion', 'CYM'),
+        (r'(?i)Cystine', 'CYX'),
+        (r'(?i)CYS \(\-SH\)', 'CYS'),
+        (r'(?i)CYS \(\-SS\-\)', 'CYX'),
+        ## Lysine
+        (r'(?i)Lysine \(NH2\)', 'LYN'),
+        (r'(?i)Lysine \(Neutral\) ', 'LYN'),
+        ## Tyrosine
+        (r'(?i)Tyrosine Anion', 'TYD'),
+        ## Asp
+        (r'(?i)Aspartic Acid \(COOH\)', 'ASH'),
+        ## Caps and Termini
+        (r'(?i)Acetyl Cap', 'ACE'),
+        (r'(?i)N\-MeAmide Cap', 'NME'),
+        (r'(?i)N\-MeAmide', 'NME'),
+        (r'(?i)N\-Term ', 'N'),
+        (r'(?i)C\-Term ', 'C'),
+        ## Atypical residues
+        (r'(?i)Ornithine', 'ORN'),
+        (r'(?i)MethylAlanine', 'AIB'),
+        (r'(?i)Pyroglutamate', 'PCA'),
+        (r'(?i)Acetyl', 'ACE'),
 
-    ## DNA
-    lines.A_names = lines.A_names.str.replace(r'(?i)D-Adenosine', 'DA',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)D-Guanosine', 'DG',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)D-Cytosine', 'DC',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)D-Thymine', 'DT',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)D-Phosphodiester', 'DX',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)D\-5\'\-Hydroxyl O5\'',
-      'DX5 HO5\'', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)D\-5\'\-Hydroxyl', 'DX5',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)D\-5\'\-Phosphate', 'DX5',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)D\-3\'\-Hydroxyl O3\'',
-      'DX3 HO3\'', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)D\-3\'\-Hydroxyl', 'DX3',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)D\-3\'\-Phosphate', 'DX3',
-      regex=True)
-
-    ## AMOEBA nucleics...
-    lines.A_names = lines.A_names.replace({'\(CT\)':''}, regex=True)
-    lines.A_names = lines.A_names.replace({'\(CU\)':''}, regex=True)
-    lines.A_names = lines.A_names.replace({'\(AG\)':''}, regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Deoxyribose', 'DX',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Ribose', 'RX',
-      regex=True)
-
-    ## Do the same with water
-    lines.A_names = lines.A_names.str.replace(r'(?i)TIP3P Oxygen', 'WAT O',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)TIP3P Hydrogen', 'WAT H',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)AMOEBA Water', 'WAT',
-      regex=True)
-
-    ## Remove the word "Ion"
-    lines.A_names = lines.A_names.replace({' Ion':''}, regex=True)
-    ## Do the same with ions
-    lines.A_names = lines.A_names.str.replace(r'(?i)Lithium', 'LI',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Sodium', 'NA', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Potassium', 'K',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Rubidium', 'RB', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Cesium', 'CS', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Beryllium', 'BE',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Magnesium', 'MG',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Calcium', 'CA',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Zinc', 'ZN', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Fluoride', 'F', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Chloride', 'CL',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Bromide', 'BR', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Iodide', 'I', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Barium', 'BA', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Strontium', 'SR',
-      regex=True)
-    ## Now standardize them for string search
-    lines.A_names = lines.A_names.str.replace(r'(?i)Li\+', 'LI', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Na\+', 'NA', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)K\+', 'K', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Rb\+', 'RB', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Cs\+', 'CS', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Be\+', 'BE', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Mg\+2', 'MG', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Ca\+2', 'CA', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Zn\+2', 'ZN', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)F\-', 'F', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Cl\-', 'CL', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Br\-', 'BR', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)I\-', 'I', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Ba\+2', 'BA', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Sr\+2', 'SR', regex=True)
-
-    ## User-defined
-    ## The search string is what is listed in the string of the prm file's
-    ## atom line for a given atom type and the replace string is the ResName
-    ## in the PDB
-    # lines.A_names = lines.A_names.str.replace(r'(?i)DUP -Phosphate', 'DUP',
-    #   regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)DUP-Uracil', 'DUP',
-      regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)DGP and DCP PO4', 'DXP',
-      regex=True)
-    # lines.A_names = lines.A_names.str.replace(r'(?i)DUP-Uracil', 'CTP',
-    #   regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)DUP -Phosphate', 'CTP',
-      regex=True)
+        ## Replace standards with 3 letter codes
+        (r'(?i)Aspartic Acid', 'ASP'),
+        (r'(?i)Glutamic Acid', 'GLU'),
+        (r'(?i)Phenylalanine', 'PHE'),
+        (r'(?i)Alanine', 'ALA'),
+        (r'(?i)Arginine', 'ARG'),
+        (r'(?i)Asparagine', 'ASN'),
+        (r'(?i)Cysteine', 'CYS'),
+        (r'(?i)Glutamine', 'GLN'),
+        (r'(?i)Glycine', 'GLY'),
+        (r'(?i)Histidine', 'HIS'),
+        (r'(?i)Isoleucine', 'ILE'),
+        (r'(?i)Leucine', 'LEU'),
+        (r'(?i)Lysine', 'LYS'),
+        (r'(?i)Methionine', 'MET'),
+        (r'(?i)Proline', 'PRO'),
+        (r'(?i)Serine', 'SER'),
+        (r'(?i)Threonine', 'THR'),
+        (r'(?i)Tryptophan', 'TRP'),
+        (r'(?i)Tyrosine', 'TYR'),
+        (r'(?i)Valine', 'VAL'),
+
+        ## RNA
+        (r'(?i)R-Adenosine', 'RA'),
+        (r'(?i)R-Guanosine', 'RG'),
+        (r'(?i)R-Cytosine', 'RC'),
+        (r'(?i)R-Uracil', 'RU'),
+        (r'(?i)R\-Phosphodiester', 'RX'),
+        ## The O5' and HO5' have same name in prm file; address it
+        (r'(?i)R\-5\'\-Hydroxyl O5\'', 'RX5 HO5\''),
+        (r'(?i)R\-5\'\-Hydroxyl', 'RX5'),
+        (r'(?i)R\-5\'\-Phosphate', 'RX5'),
+        (r'(?i)R\-3\'\-Phosphate', 'RX3'),
+        (r'(?i)R\-3\'\-Hydroxyl O3\'', 'RX3 HO3\''),
+        (r'(?i)R\-3\'\-Hydroxyl', 'RX3'),
+
+        ## DNA
+        (r'(?i)D-Adenosine', 'DA'),
+        (r'(?i)D-Guanosine', 'DG'),
+        (r'(?i)D-Cytosine', 'DC'),
+        (r'(?i)D-Thymine', 'DT'),
+        (r'(?i)D-Phosphodiester', 'DX'),
+        (r'(?i)D\-5\'\-Hydroxyl O5\'', 'DX5 HO5\''),
+        (r'(?i)D\-5\'\-Hydroxyl', 'DX5'),
+        (r'(?i)D\-5\'\-Phosphate', 'DX5'),
+        (r'(?i)D\-3\'\-Hydroxyl O3\'', 'DX3 HO3\''),
+        (r'(?i)D\-3\'\-Hydroxyl', 'DX3'),
+        (r'(?i)D\-3\'\-Phosphate', 'DX3'),
+
+        ## AMOEBA nucleics...
+        (r'\(CT\)', ''),
+        (r'\(CU\)', ''),
+        (r'\(AG\)', ''),
+        (r'(?i)Deoxyribose', 'DX'),
+        (r'(?i)Ribose', 'RX'),
+
+        ## Do the same with water
+        (r'(?i)TIP3P Oxygen', 'WAT O'),
+        (r'(?i)TIP3P Hydrogen', 'WAT H'),
+        (r'(?i)AMOEBA Water', 'WAT'),
+
+        ## Remove the word "Ion"
+        (r' Ion', ''),
+        ## Do the same with ions
+        (r'(?i)Lithium', 'LI'),
+        (r'(?i)Sodium', 'NA'),
+        (r'(?i)Potassium', 'K'),
+        (r'(?i)Rubidium', 'RB'),
+        (r'(?i)Cesium', 'CS'),
+        (r'(?i)Beryllium', 'BE'),
+        (r'(?i)Magnesium', 'MG'),
+        (r'(?i)Calcium', 'CA'),
+        (r'(?i)Zinc', 'ZN'),
+        (r'(?i)Fluoride', 'F'),
+        (r'(?i)Chloride', 'CL'),
+        (r'(?i)Bromide', 'BR'),
+        (r'(?i)Iodide', 'I'),
+        (r'(?i)Barium', 'BA'),
+        (r'(?i)Strontium', 'SR'),
+        ## Now standardize them for string search
+        (r'(?i)Li\+', 'LI'),
+        (r'(?i)Na\+', 'NA'),
+        (r'(?i)K\+', 'K'),
+        (r'(?i)Rb\+', 'RB'),
+        (r'(?i)Cs\+', 'CS'),
+        (r'(?i)Be\+', 'BE'),
+        (r'(?i)Mg\+2', 'MG'),
+        (r'(?i)Ca\+2', 'CA'),
+        (r'(?i)Zn\+2', 'ZN'),
+        (r'(?i)F\-', 'F'),
+        (r'(?i)Cl\-', 'CL'),
+        (r'(?i)Br\-', 'BR'),
+        (r'(?i)I\-', 'I'),
+        (r'(?i)Ba\+2', 'BA'),
+        (r'(?i)Sr\+2', 'SR'),
+
+        ## User-defined
+        ## The search string is what is listed in the string of the prm file's
+        ## atom line for a given atom type and the replace string is the ResName
+        ## in the PDB
+        # (r'(?i)DUP -Phosphate', 'DUP'),
+        (r'(?i)DUP-Uracil', 'DUP'),
+        (r'(?i)DGP and DCP PO4', 'DXP'),
+        # (r'(?i)DUP-Uracil', 'CTP'),
+        (r'(?i)DUP -Phosphate', 'CTP'),
+    ]
+    lines.A_names = normalize_names(lines.A_names,
+     read_name_rules(alias_file) + name_rules)
 
     ## Print the new lines for testing
     #lines.to_csv(test_csv, index=False, encoding='utf8')
@@ -398,546 +295,286 @@ def fix_params(atom_lines,test_csv):
     lines.to_csv(test_csv, index=False, encoding='utf8')
     return lines
 
-def convert_names(system, lines):
-    """For every atom, find lines matching the residue name in the
-    pandas_object. From those lines, check for lines that match the atom name.
-    If a match isn't found, check through the known naming problems. Update the
-    atom mass with the TINKER type if a match is found; if no match is found,
-    keep the atom mass as zero.
+def load_params(param_file, test_csv, alias_file, prm_cache_dir):
+    """Read and fix the prm atom lines, or load them from prm_cache_dir.
+    The cache file is named by the SHA-256 of the prm file, the alias_file
+    (if there is one), and the source of read_prm, read_name_rules,
+    normalize_names, and fix_params, so editing any of them makes a new
+    entry. Repeat conversions with the same force field skip read_prm and
+    fix_params entirely, but still rewrite test_csv."""
+    prm_hash = hashlib.sha256()
+    for hash_file in (param_file, alias_file):
+        if os.path.isfile(hash_file):
+            with open(hash_file, 'rb') as hash_in:
+                prm_hash.update(hash_in.read())
+    for function in (read_prm, read_name_rules, normalize_names, fix_params):
+        prm_hash.update(inspect.getsource(function).encode())
+    cache_file = os.path.join(prm_cache_dir, prm_hash.hexdigest()+".pkl")
+    if os.path.isfile(cache_file):
+        print("Using the cached atom types in {}.\n".format(cache_file))
+        with open(cache_file, 'rb') as cache_in:
+            lines = pickle.load(cache_in)
+        ## Print the cached lines for testing, like fix_params does
+        lines.to_csv(test_csv, index=False, encoding='utf8')
+        return lines
+    lines = fix_params(read_prm(param_file), test_csv, alias_file)
+    os.makedirs(prm_cache_dir, exist_ok=True)
+    with open(cache_file, 'wb') as cache_out:
+        pickle.dump(lines, cache_out)
+    return lines
+
+def index_params(lines):
+    """Build a dictionary keyed by (ResName, AtomName) from the fixed atom
+    lines. Each value is a list of the matching TINKER types, so a lookup is a
+    single hash instead of filtering the whole table for every atom. More than
+    one type in a list means the parameter file has duplicate names."""
+    type_index = {}
+    for res_name, atom_name, t_type in zip(lines.ResName, lines.AtomName,
+     lines.T_type):
+        type_index.setdefault((res_name, atom_name), []).append(int(t_type))
+    return type_index
+
+def build_aliases():
+    """Compile the fallback naming rules into two lookup tables.
+
+    res_classes maps a PDB residue name to its residue class and the base
+    residue name used by the fallbacks (e.g. NALA -> ('nterm', 'ALA')).
+    alias_table maps (residue class, atom name) to the ordered candidates to
+    try once the plain (ResName, AtomName) lookup fails. Each candidate is a
+    (residue, atom) pair, where 'self' is the PDB residue name, 'base' is the
+    base residue name, and an atom of None keeps the PDB atom name. The
+    (residue class, None) entry is the default for atoms without a rule.
+    """
+    protein = ('ALA', 'ARG', 'ASN', 'ASP', 'CYS', 'CYX', 'GLN', 'GLU', 'GLY',
+     'HID', 'HIE', 'HIP', 'HIS', 'ILE', 'LEU', 'LYS', 'MET', 'PHE', 'PRO',
+     'SER', 'THR', 'TRP', 'TYR', 'VAL')
+    phosphate_O = ('OP1', 'OP2', 'O1P', 'O2P')
+    methyl_H = ('H71', 'H72', 'H73')
+    ## Fix the duplicate/triplicate names, in order of preference
+    degenerate = {'H': ('HN',), 'HA2': ('HA',), 'HA3': ('HA',),
+     'HB1': ('HB',), 'HB2': ('HB',), 'HB3': ('HB',),
+     'HG1': ('HG',), 'HG2': ('HG',), 'HG3': ('HG',),
+     '1HG1': ('HG1',), '2HG1': ('HG1',), '3HG1': ('HG1',),
+     '1HG2': ('HG2',), '2HG2': ('HG2',), '3HG2': ('HG2',),
+     'HD1': ('HD',), 'HD2': ('HD',), 'HD3': ('HD',),
+     ## HD condition
+     '1HD1': ('HD1', 'HD'), '2HD1': ('HD1', 'HD'), '3HD1': ('HD1', 'HD'),
+     '1HD2': ('HD2',), '2HD2': ('HD2',), '3HD2': ('HD2',),
+     'HE1': ('HE',), 'HE2': ('HE',), 'HE3': ('HE',),
+     '1HE1': ('HE1',), '2HE1': ('HE1',), '3HE1': ('HE1',),
+     '1HE2': ('HE2',), '2HE2': ('HE2',), '3HE2': ('HE2',),
+     'HH11': ('HH1', 'HH'), 'HH12': ('HH1', 'HH'),
+     'HH21': ('HH2', 'HH'), 'HH22': ('HH2', 'HH'),
+     'HZ1': ('HZ',), 'HZ2': ('HZ',), 'HZ3': ('HZ',),
+     'NH1': ('NH',), 'NH2': ('NH',), 'OD1': ('OD',), 'OD2': ('OD',),
+     'OE1': ('OE',), 'OE2': ('OE',),
+     ## CD condition
+     'CD1': ('CD',), 'CD2': ('CD',),
+     ## CE vs CE1 condition
+     'CE1': ('CE',), 'CE2': ('CE',),
+     'H71': ('H7',), 'H72': ('H7',), 'H73': ('H7',)}
+    #
+    res_classes = {}
+    for name in protein:
+        res_classes['N'+name] = ('nterm', name)
+        res_classes['C'+name] = ('cterm', name)
+    for name in ('DC', 'DG', 'DA', 'DT'):
+        res_classes[name+'5'] = ('dna5', name)
+        res_classes[name+'3'] = ('dna3', name)
+        res_classes[name] = ('dna', name)
+    for name in ('C', 'G', 'A', 'U'):
+        res_classes[name+'5'] = ('rna5', 'R'+name)
+        res_classes[name+'3'] = ('rna3', 'R'+name)
+        res_classes[name] = ('rna', 'R'+name)
+        res_classes['R'+name+'5'] = ('rna5', 'R'+name)
+        res_classes['R'+name+'3'] = ('rna3', 'R'+name)
+        res_classes['R'+name] = ('rna', 'R'+name)
+    res_classes['ACE'] = ('ace', 'ACE')
+    res_classes['NME'] = ('nme', 'NME')
+    #############################################
+    ##    Catch non-standard problems here!    ##
+    #############################################
+    ## Reinterpret CTP
+    res_classes['CTP'] = ('ctp', 'CTP')
+    ## Deoxy 5mC == 5CM, Deoxy 5hmC == 5HC
+    res_classes['5CM'] = ('dmod', '5CM')
+    res_classes['5HC'] = ('dmod', '5HC')
+    ## Ribo 5hmC == 5hC, Ribo 5mC == 5mC
+    res_classes['5hC'] = ('rmod', '5hC')
+    res_classes['5mC'] = ('rmod', '5mC')
+    #
+    alias_table = {}
+    ## CTERM/NTERM use the base residue; H1/H2/H3 are HN for N-Terminal
+    for res_class in ('nterm', 'cterm'):
+        alias_table[(res_class, None)] = (('base', None),)
+        for name, aliases in degenerate.items():
+            alias_table[(res_class, name)] = (('base', None),) + \
+             tuple(('base', alias) for alias in aliases)
+    for name in ('H1', 'H2', 'H3'):
+        alias_table[('nterm', name)] = (('self', 'HN'),)
+    ## DNA
+    alias_table[('dna5', None)] = (('base', None),)
+    alias_table[('dna3', None)] = (('base', None),)
+    alias_table[('dna', None)] = ()
+    for name in ('O5\'', 'HO5\'', 'H5T', 'P'):
+        alias_table[('dna5', name)] = (('DX5', None),)
+    for name in ('O3\'', 'HO3\'', 'H3T', 'P'):
+        alias_table[('dna3', name)] = (('DX3', None),)
+    alias_table[('dna', 'P')] = (('DX', None),)
+    for name in phosphate_O:
+        alias_table[('dna5', name)] = (('self', 'OP'),)
+        alias_table[('dna3', name)] = (('DX3', 'OP'),)
+        alias_table[('dna', name)] = (('DX', 'OP'),)
+    for name in methyl_H:
+        alias_table[('dna5', name)] = (('base', 'H7'),)
+        alias_table[('dna3', name)] = (('base', 'H7'),)
+        alias_table[('dna', name)] = (('self', 'H7'),)
+    ## RNA
+    alias_table[('rna5', None)] = (('base', None),)
+    alias_table[('rna3', None)] = (('base', None),)
+    alias_table[('rna', None)] = (('base', None),)
+    for name in ('O5\'', 'HO5\'', 'H5T', 'P'):
+        alias_table[('rna5', name)] = (('RX5', None),)
+    for name in ('O3\'', 'HO3\'', 'H3T', 'P'):
+        alias_table[('rna3', name)] = (('RX3', None),)
+    alias_table[('rna', 'P')] = (('RX', None),)
+    for name in phosphate_O:
+        alias_table[('rna5', name)] = (('RX5', 'OP'),)
+        alias_table[('rna3', name)] = (('RX3', 'OP'),)
+        alias_table[('rna', name)] = (('RX', 'OP'),)
+    ## Caps
+    alias_table[('ace', None)] = ()
+    alias_table[('nme', None)] = ()
+    for name in ('HH31', 'HH32', 'HH33'):
+        alias_table[('ace', name)] = (('self', 'HA'),)
+        alias_table[('nme', name)] = (('self', 'HC'),)
+    alias_table[('ace', 'CH3')] = (('self', 'CA'),)
+    alias_table[('nme', 'CH3')] = (('self', 'C'),)
+    ## Non-standard residues
+    alias_table[('ctp', None)] = (('DC', None), ('DUP', None))
+    alias_table[('dmod', None)] = (('DC', None),)
+    alias_table[('dmod', 'P')] = (('DC', None), ('DX', None))
+    alias_table[('rmod', None)] = (('RC', None),)
+    alias_table[('rmod', 'P')] = (('RC', None), ('RX', None))
+    for name in phosphate_O:
+        alias_table[('dmod', name)] = (('DC', None), ('DX', 'OP'))
+        alias_table[('rmod', name)] = (('RC', None), ('RX', 'OP'))
+    ########################################################
+    ##    Now we're just a typical protein residue lol    ##
+    ########################################################
+    alias_table[('protein', None)] = ()
+    for name, aliases in degenerate.items():
+        alias_table[('protein', name)] = tuple(('self', alias) for alias in
+         aliases)
+    for name in ('H1', 'H2', 'H3'):
+        alias_table[('protein', name)] = (('self', 'HA'), ('self', 'H'))
+    return res_classes, alias_table
+
+def resolve_type(type_index, res_classes, alias_table, res_name, atom_name):
+    """Look up the TINKER types for an atom. If the (ResName, AtomName) pair
+    isn't in the type_index, walk the alias candidates for the residue class
+    and keep the first one that matches.
+
+    Returns the list of matching types (empty if nothing matched) and the
+    last residue and atom names searched.
+    """
+    atom_test = type_index.get((res_name, atom_name), [])
+    test_RN, test_name = res_name, atom_name
+    if len(atom_test) == 0:
+        res_class, base = res_classes.get(res_name, ('protein', res_name))
+        candidates = alias_table.get((res_class, atom_name),
+         alias_table[(res_class, None)])
+        for cand_res, cand_name in candidates:
+            if cand_res == 'self':
+                test_RN = res_name
+            elif cand_res == 'base':
+                test_RN = base
+            else:
+                test_RN = cand_res
+            test_name = atom_name if cand_name is None else cand_name
+            atom_test = type_index.get((test_RN, test_name), [])
+            if len(atom_test) != 0:
+                break
+    return atom_test, test_RN, test_name
+
+def type_residue(res_name, atom_names, res_num, type_index, res_classes,
+ alias_table):
+    """Resolve the TINKER type of every atom name in a residue. Atoms that
+    aren't found, or that have too many matches, are printed and given type 0.
+
+    Returns a list of the TINKER types in residue atom order.
+    """
+    res_types = []
+    for atom_name in atom_names:
+        atom_test, test_RN, test_name = resolve_type(type_index,
+         res_classes, alias_table, res_name, atom_name)
+        if len(atom_test) == 0:
+            ## Prints out what you need to fix :)
+            print(res_name, atom_name, test_RN, test_name)
+            res_types.append(0)
+        elif len(atom_test) > 1:
+            print("""
+            Oof, please check the parameter file.
+               I have too many matches...
+            """)
+            print(res_name, atom_name, "ResID:", res_num)
+            res_types.append(0)
+        else:
+            res_types.append(atom_test[0])
+    return res_types
+
+def convert_names(system, type_index, res_classes, alias_table):
+    """For every residue, build its signature from the residue name and the
+    ordered atom names. The first residue with a given signature is typed
+    atom by atom through type_residue (using the type_index and the known
+    naming problems compiled by build_aliases); every later copy, like the
+    thousands of waters, reuses that list of types. Update the atom mass with
+    the TINKER type if a match is found; if no match is found, keep the atom
+    mass as zero. Missing atoms are only listed for the first copy.
     """
     print(
     '''If I didn't find residues, they'll be listed here:
     Residue Name | Atom Name | Search ResName | Search Atom Name
     ''')
+    template_cache = {}
     for residue in system.residues:
-        for atom in residue.atoms:
-            test_name = atom.name
-            res_test = lines[lines.ResName == residue.name]
-            atom_test = res_test[res_test.AtomName == test_name]
-            ## Address DNA, RNA, and CTERM/NTERM
-            if atom_test.empty == True:
-                if residue.name in ('NALA', 'NARG', 'NASN', 'NASP', 'NCYS',
-                 'NCYX', 'NGLN', 'NGLU', 'NGLY', 'NHID', 'NHIE', 'NHIP',
-                 'NHIS', 'NILE', 'NLEU', 'NLYS', 'NMET', 'NPHE', 'NPRO',
-                 'NSER', 'NTHR', 'NTRP', 'NTYR', 'NVAL'):
-                    if test_name in ('H1', 'H2', 'H3'):
-                        # It's HN for N-Terminal
-                        test_name = 'HN'
-                        res_test = lines[lines.ResName == residue.name]
-                        atom_test = res_test[res_test.AtomName == test_name]
-                    else:
-                        test_RN = residue.name[1:]
-                        test_name = atom.name
-                        res_test = lines[lines.ResName == test_RN]
-                        atom_test = res_test[res_test.AtomName == test_name]
-                        ##### Fix the duplicate/triplicates here
-                        if atom_test.empty == True:
-                            if test_name == ('H'):
-                                test_name = 'HN'
-                                atom_test = res_test[res_test.AtomName == test_name]
-                            elif test_name in ('HA2', 'HA3'):
-                                test_name = 'HA'
-                                atom_test = res_test[res_test.AtomName == test_name]
-                            elif test_name in ('HB1', 'HB2', 'HB3'):
-                                test_name = 'HB'
-                                atom_test = res_test[res_test.AtomName == test_name]
-                            elif test_name in ('HG1', 'HG2', 'HG3'):
-                                test_name = 'HG'
-                                atom_test = res_test[res_test.AtomName == test_name]
-                            elif test_name in ('1HG1', '2HG1', '3HG1'):
-                                test_name = 'HG1'
-                                atom_test = res_test[res_test.AtomName == test_name]
-                            elif test_name in ('1HG2', '2HG2', '3HG2'):
-                                test_name = 'HG2'
-                                atom_test = res_test[res_test.AtomName == test_name]
-                            elif test_name in ('HD1', 'HD2', 'HD3'):
-                                test_name = 'HD'
-                                atom_test = res_test[res_test.AtomName == test_name]
-                            elif test_name in ('1HD1', '2HD1', '3HD1'):
-                                test_name = 'HD1'
-                                atom_test = res_test[res_test.AtomName == test_name]
-                                # HD condition
-                                if atom_test.empty == True:
-                                    test_name = 'HD'
-                                    atom_test = res_test[res_test.AtomName == test_name]
-                            elif test_name in ('1HD2', '2HD2', '3HD2'):
-                                test_name = 'HD2'
-                                atom_test = res_test[res_test.AtomName == test_name]
-                            elif test_name in ('HE1', 'HE2', 'HE3'):
-                                test_name = 'HE'
-                                atom_test = res_test[res_test.AtomName == test_name]
-                            elif test_name in ('1HE1', '2HE1', '3HE1'):
-                                test_name = 'HE1'
-                                atom_test = res_test[res_test.AtomName == test_name]
-                            elif test_name in ('1HE2', '2HE2', '3HE2'):
-                                test_name = 'HE2'
-                                atom_test = res_test[res_test.AtomName == test_name]
-                            elif test_name in ('HH11', 'HH12'):
-                                test_name = 'HH1'
-                                atom_test = res_test[res_test.AtomName == test_name]
-                                if atom_test.empty == True:
-                                    test_name = 'HH'
-                                    atom_test = res_test[res_test.AtomName == test_name]
-                            elif test_name in ('HH21', 'HH22'):
-                                test_name = 'HH2'
-                                atom_test = res_test[res_test.AtomName == test_name]
-                                if atom_test.empty == True:
-                                    test_name = 'HH'
-                                    atom_test = res_test[res_test.AtomName == test_name]
-                            elif test_name in ('HZ1', 'HZ2', 'HZ3'):
-                                test_name = 'HZ'
-                                atom_test = res_test[res_test.AtomName == test_name]
-                            elif test_name in ('NH1', 'NH2'):
-                                test_name = 'NH'
-                                atom_test = res_test[res_test.AtomName == test_name]
-                            elif test_name in ('OD1', 'OD2'):
-                                test_name = 'OD'
-                                atom_test = res_test[res_test.AtomName == test_name]
-                            elif test_name in ('OE1', 'OE2'):
-                                test_name = 'OE'
-                                atom_test = res_test[res_test.AtomName == test_name]
-                            # CD condition
-                            elif test_name in ('CD1', 'CD2'):
-                                test_name = 'CD'
-                                atom_test = res_test[res_test.AtomName == test_name]
-                            # CE vs CE1 condition
-                            elif test_name in ('CE1', 'CE2'):
-                                test_name = 'CE'
-                                atom_test = res_test[res_test.AtomName == test_name]
-                            elif test_name in ('H71', 'H72', 'H73'):
-                                test_name = 'H7'
-                                atom_test = res_test[res_test.AtomName == test_name]
-                            else:
-                                atom_test = res_test[res_test.AtomName == test_name]
-                elif residue.name in ('CALA', 'CARG', 'CASN', 'CASP', 'CCYS',
-                 'CCYX', 'CGLN', 'CGLU', 'CGLY', 'CHID', 'CHIE', 'CHIP',
-                 'CHIS', 'CILE', 'CLEU', 'CLYS', 'CMET', 'CPHE', 'CPRO',
-                 'CSER', 'CTHR', 'CTRP', 'CTYR', 'CVAL'):
-                    test_RN = residue.name[1:]
-                    test_name = atom.name
-                    res_test = lines[lines.ResName == test_RN]
-                    atom_test = res_test[res_test.AtomName == test_name]
-                    ### Fix the duplicates/triplicates here
-                    if atom_test.empty == True:
-                        if test_name == ('H'):
-                            test_name = 'HN'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                        elif test_name in ('HA2', 'HA3'):
-                            test_name = 'HA'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                        elif test_name in ('HB1', 'HB2', 'HB3'):
-                            test_name = 'HB'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                        elif test_name in ('HG1', 'HG2', 'HG3'):
-                            test_name = 'HG'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                        elif test_name in ('1HG1', '2HG1', '3HG1'):
-                            test_name = 'HG1'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                        elif test_name in ('1HG2', '2HG2', '3HG2'):
-                            test_name = 'HG2'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                        elif test_name in ('HD1', 'HD2', 'HD3'):
-                            test_name = 'HD'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                        elif test_name in ('1HD1', '2HD1', '3HD1'):
-                            test_name = 'HD1'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                            # HD condition
-                            if atom_test.empty == True:
-                                test_name = 'HD'
-                                atom_test = res_test[res_test.AtomName == test_name]
-                        elif test_name in ('1HD2', '2HD2', '3HD2'):
-                            test_name = 'HD2'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                        elif test_name in ('HE1', 'HE2', 'HE3'):
-                            test_name = 'HE'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                        elif test_name in ('1HE1', '2HE1', '3HE1'):
-                            test_name = 'HE1'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                        elif test_name in ('1HE2', '2HE2', '3HE2'):
-                            test_name = 'HE2'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                        elif test_name in ('HH11', 'HH12'):
-                            test_name = 'HH1'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                            if atom_test.empty == True:
-                                test_name = 'HH'
-                                atom_test = res_test[res_test.AtomName == test_name]
-                        elif test_name in ('HH21', 'HH22'):
-                            test_name = 'HH2'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                            if atom_test.empty == True:
-                                test_name = 'HH'
-                                atom_test = res_test[res_test.AtomName == test_name]
-                        elif test_name in ('HZ1', 'HZ2', 'HZ3'):
-                            test_name = 'HZ'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                        elif test_name in ('NH1', 'NH2'):
-                            test_name = 'NH'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                        elif test_name in ('OD1', 'OD2'):
-                            test_name = 'OD'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                        elif test_name in ('OE1', 'OE2'):
-                            test_name = 'OE'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                        # CD condition
-                        elif test_name in ('CD1', 'CD2'):
-                            test_name = 'CD'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                        # CE vs CE1 condition
-                        elif test_name in ('CE1', 'CE2'):
-                            test_name = 'CE'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                        elif test_name in ('H71', 'H72', 'H73'):
-                            test_name = 'H7'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                        else:
-                            atom_test = res_test[res_test.AtomName == test_name]
-                    #####
-                elif residue.name in ('DC5', 'DG5', 'DA5', 'DT5'):
-                    if atom.name in ('O5\'', 'HO5\'', 'H5T', 'P'):
-                        test_RN = 'DX5'
-                        res_test = lines[lines.ResName == test_RN]
-                        atom_test = res_test[res_test.AtomName == atom.name]
-                    elif atom.name in ('OP1', 'OP2', 'O1P', 'O2P'):
-                        test_name = 'OP'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                    else:
-                        test_RN = residue.name[:-1]
-                        res_test = lines[lines.ResName == test_RN]
-                        atom_test = res_test[res_test.AtomName == atom.name]
-                        if atom.name in ('H71', 'H72', 'H73'):
-                            test_name = 'H7'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                elif residue.name in ('DC3', 'DG3', 'DA3', 'DT3'):
-                    test_RN = 'DX3'
-                    res_test = lines[lines.ResName == test_RN]
-                    if atom.name in ('O3\'', 'HO3\'', 'H3T', 'P'):
-                        atom_test = res_test[res_test.AtomName == atom.name]
-                    elif atom.name in ('OP1', 'OP2', 'O1P', 'O2P'):
-                        test_name = 'OP'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                    else:
-                        test_RN = residue.name[:-1]
-                        res_test = lines[lines.ResName == test_RN]
-                        atom_test = res_test[res_test.AtomName == atom.name]
-                        if atom.name in ('H71', 'H72', 'H73'):
-                            test_name = 'H7'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                elif residue.name in ('DC', 'DG', 'DA', 'DT'):
-                    if atom.name in ('H71', 'H72', 'H73'):
-                        test_name = 'H7'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                    else:
-                        test_RN = 'DX'
-                        res_test = lines[lines.ResName == test_RN]
-                        if atom.name in ('P'):
-                            atom_test = res_test[res_test.AtomName == atom.name]
-                        elif atom.name in ('OP1', 'OP2', 'O1P', 'O2P'):
-                            test_name = 'OP'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                elif residue.name in ('C5', 'G5', 'A5', 'U5'):
-                    test_RN = 'RX5'
-                    res_test = lines[lines.ResName == test_RN]
-                    if atom.name in ('O5\'', 'HO5\'', 'H5T', 'P'):
-                        atom_test = res_test[res_test.AtomName == atom.name]
-                    elif atom.name in ('OP1', 'OP2', 'O1P', 'O2P'):
-                        test_name = 'OP'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                    else:
-                        test_RN = 'R' + residue.name[:-1]
-                        res_test = lines[lines.ResName == test_RN]
-                        atom_test = res_test[res_test.AtomName == atom.name]
-                elif residue.name in ('C3', 'G3', 'A3', 'U3'):
-                    test_RN = 'RX3'
-                    res_test = lines[lines.ResName == test_RN]
-                    if atom.name in ('O3\'', 'HO3\'', 'H3T', 'P'):
-                        atom_test = res_test[res_test.AtomName == atom.name]
-                    elif atom.name in ('OP1', 'OP2', 'O1P', 'O2P'):
-                        test_name = 'OP'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                    else:
-                        test_RN = 'R' + residue.name[:-1]
-                        res_test = lines[lines.ResName == test_RN]
-                        atom_test = res_test[res_test.AtomName == atom.name]
-                elif residue.name in ('C', 'G', 'A', 'U'):
-                    test_RN = 'RX'
-                    res_test = lines[lines.ResName == test_RN]
-                    if atom.name in ('P'):
-                        atom_test = res_test[res_test.AtomName == atom.name]
-                    elif atom.name in ('OP1', 'OP2', 'O1P', 'O2P'):
-                        test_name = 'OP'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                    else:
-                        test_RN = 'R' + residue.name
-                        res_test = lines[lines.ResName == test_RN]
-                        atom_test = res_test[res_test.AtomName == test_name]
-                elif residue.name in ('RC5', 'RG5', 'RA5', 'RU5'):
-                    test_RN = 'RX5'
-                    res_test = lines[lines.ResName == test_RN]
-                    if atom.name in ('O5\'', 'HO5\'', 'H5T', 'P'):
-                        atom_test = res_test[res_test.AtomName == atom.name]
-                    elif atom.name in ('OP1', 'OP2', 'O1P', 'O2P'):
-                        test_name = 'OP'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                    else:
-                        test_RN = residue.name[:-1]
-                        res_test = lines[lines.ResName == test_RN]
-                        atom_test = res_test[res_test.AtomName == atom.name]
-                elif residue.name in ('RC3', 'RG3', 'RA3', 'RU3'):
-                    test_RN = 'RX3'
-                    res_test = lines[lines.ResName == test_RN]
-                    if atom.name in ('O3\'', 'HO3\'', 'H3T', 'P'):
-                        atom_test = res_test[res_test.AtomName == atom.name]
-                    elif atom.name in ('OP1', 'OP2', 'O1P', 'O2P'):
-                        test_name = 'OP'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                    else:
-                        test_RN = residue.name[:-1]
-                        res_test = lines[lines.ResName == test_RN]
-                        atom_test = res_test[res_test.AtomName == atom.name]
-                elif residue.name in ('RC', 'RG', 'RA', 'RU'):
-                    test_RN = 'RX'
-                    res_test = lines[lines.ResName == test_RN]
-                    if atom.name in ('P'):
-                        atom_test = res_test[res_test.AtomName == atom.name]
-                    elif atom.name in ('OP1', 'OP2', 'O1P', 'O2P'):
-                        test_name = 'OP'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                elif residue.name in ('ACE'):
-                    if atom.name in ('HH31', 'HH32', 'HH33'):
-                        test_name = 'HA'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                    elif atom.name in ('CH3'):
-                        test_name = 'CA'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                elif residue.name in ('NME'):
-                    if atom.name in ('HH31', 'HH32', 'HH33'):
-                        test_name = 'HC'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                    elif atom.name in ('CH3'):
-                        test_name = 'C'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                #############################################
-                ##    Catch non-standard problems here!    ##
-                #############################################
-                ## Reinterpret CTP
-                elif residue.name == 'CTP':
-                    test_RN = 'DC'
-                    res_test = lines[lines.ResName == test_RN]
-                    atom_test = res_test[res_test.AtomName == atom.name]
-                    if atom_test.empty == True:
-                        test_RN = 'DUP'
-                        res_test = lines[lines.ResName == test_RN]
-                        atom_test = res_test[res_test.AtomName == atom.name]
-                ## For the deoxy residues
-                ## Deoxy 5mC == 5CM
-                elif residue.name == '5CM':
-                    test_RN = 'DC'
-                    res_test = lines[lines.ResName == test_RN]
-                    atom_test = res_test[res_test.AtomName == atom.name]
-                    if atom_test.empty == True:
-                        test_RN = 'DX'
-                        res_test = lines[lines.ResName == test_RN]
-                        if atom.name in ('P'):
-                            atom_test = res_test[res_test.AtomName == atom.name]
-                        elif atom.name in ('OP1', 'OP2', 'O1P', 'O2P'):
-                            test_name = 'OP'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                ## Deoxy 5hmC == 5HC
-                elif residue.name == '5HC':
-                    test_RN = 'DC'
-                    res_test = lines[lines.ResName == test_RN]
-                    atom_test = res_test[res_test.AtomName == atom.name]
-                    if atom_test.empty == True:
-                        test_RN = 'DX'
-                        res_test = lines[lines.ResName == test_RN]
-                        if atom.name in ('P'):
-                            atom_test = res_test[res_test.AtomName == atom.name]
-                        elif atom.name in ('OP1', 'OP2', 'O1P', 'O2P'):
-                            test_name = 'OP'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                ## Ribo residues
-                ## Ribo 5hmC == 5hC
-                elif residue.name == '5hC':
-                    test_RN = 'RC'
-                    res_test = lines[lines.ResName == test_RN]
-                    atom_test = res_test[res_test.AtomName == atom.name]
-                    if atom_test.empty == True:
-                        test_RN = 'RX'
-                        res_test = lines[lines.ResName == test_RN]
-                        if atom.name in ('P'):
-                            atom_test = res_test[res_test.AtomName == atom.name]
-                        elif atom.name in ('OP1', 'OP2', 'O1P', 'O2P'):
-                            test_name = 'OP'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                ## Ribo 5mC == 5mC
-                elif residue.name == '5mC':
-                    test_RN = 'RC'
-                    res_test = lines[lines.ResName == test_RN]
-                    atom_test = res_test[res_test.AtomName == atom.name]
-                    if atom_test.empty == True:
-                        test_RN = 'RX'
-                        res_test = lines[lines.ResName == test_RN]
-                        if atom.name in ('P'):
-                            atom_test = res_test[res_test.AtomName == atom.name]
-                        elif atom.name in ('OP1', 'OP2', 'O1P', 'O2P'):
-                            test_name = 'OP'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                ########################################################
-                ##    Now we're just a typical protein residue lol    ##
-                ########################################################
-                else:
-                    if test_name == ('H'):
-                        test_name = 'HN'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                    elif test_name in ('HA2', 'HA3'):
-                        test_name = 'HA'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                    elif test_name in ('H1', 'H2', 'H3'):
-                        test_name = 'HA'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                        if atom_test.empty == True:
-                            test_name = 'H'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                    elif test_name in ('HB1', 'HB2', 'HB3'):
-                        test_name = 'HB'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                    elif test_name in ('HG1', 'HG2', 'HG3'):
-                        test_name = 'HG'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                    elif test_name in ('1HG1', '2HG1', '3HG1'):
-                        test_name = 'HG1'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                    elif test_name in ('1HG2', '2HG2', '3HG2'):
-                        test_name = 'HG2'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                    elif test_name in ('HD1', 'HD2', 'HD3'):
-                        test_name = 'HD'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                    elif test_name in ('1HD1', '2HD1', '3HD1'):
-                        test_name = 'HD1'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                        # HD condition
-                        if atom_test.empty == True:
-                            test_name = 'HD'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                    elif test_name in ('1HD2', '2HD2', '3HD2'):
-                        test_name = 'HD2'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                    elif test_name in ('HE1', 'HE2', 'HE3'):
-                        test_name = 'HE'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                    elif test_name in ('1HE1', '2HE1', '3HE1'):
-                        test_name = 'HE1'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                    elif test_name in ('1HE2', '2HE2', '3HE2'):
-                        test_name = 'HE2'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                    elif test_name in ('HH11', 'HH12'):
-                        test_name = 'HH1'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                        if atom_test.empty == True:
-                            test_name = 'HH'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                    elif test_name in ('HH21', 'HH22'):
-                        test_name = 'HH2'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                        if atom_test.empty == True:
-                            test_name = 'HH'
-                            atom_test = res_test[res_test.AtomName == test_name]
-                    elif test_name in ('HZ1', 'HZ2', 'HZ3'):
-                        test_name = 'HZ'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                    elif test_name in ('NH1', 'NH2'):
-                        test_name = 'NH'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                    elif test_name in ('OD1', 'OD2'):
-                        test_name = 'OD'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                    elif test_name in ('OE1', 'OE2'):
-                        test_name = 'OE'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                    # CD condition
-                    elif test_name in ('CD1', 'CD2'):
-                        test_name = 'CD'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                    # CE vs CE1 condition
-                    elif test_name in ('CE1', 'CE2'):
-                        test_name = 'CE'
-                        atom_test = res_test[res_test.AtomName == test_name]
-                    elif test_name in ('H71', 'H72', 'H73'):
-                        test_name = 'H7'
-                        atom_test = res_test[res_test.AtomName == test_name]
-            if atom_test.empty == True:
-                ## Prints out what you need to fix :)
-                try:
-                    print(residue.name, atom.name, test_RN, test_name)
-                    atom.mass = int(0)
-                except UnboundLocalError:
-                    print(residue.name, atom.name, residue.name, test_name)
-                atom.mass = int(0)
-            else:
-                try:
-                    atom.mass += int(atom_test['T_type'])
-                except TypeError:
-                    print("""
-                    Oof, please check the parameter file.
-                       I have too many matches...
-                    """)
-                    print(residue.name, atom.name, "ResID:", residue.number)
-                # atom.mass += atom_test['T_type']
+        signature = (residue.name, tuple(atom.name for atom in residue.atoms))
+        res_types = template_cache.get(signature)
+        if res_types is None:
+            res_types = type_residue(residue.name, signature[1],
+             residue.number, type_index, res_classes, alias_table)
+            template_cache[signature] = res_types
+        for atom, atom_type in zip(residue.atoms, res_types):
+            atom.mass = atom_type
+    print("Typed {} residues from {} unique residue templates.\n".format(
+     len(system.residues), len(template_cache)))
     return system
 
-## Taken from Mark's PDBTinker
-def write_xyz(system, outfile):
-    ## Add XYZ extension
-    if outfile.split(".")[-1] != "xyz":
-        outfile = outfile+".xyz"
-    ## Write to outfile
-    f = open(outfile,"w+")
-    f.write(str(len(system.atoms))+"\n")
-    for atom in system.atoms:
-        bondstring = ""
-        bondlist = []
-        for i in atom.bonds:
-            if i.atom1.idx == atom.idx:
-                bondlist.append(i.atom2.idx+1)
-                # bondstring = bondstring + str(i.atom2.idx+1) + "\t"
-            elif i.atom2.idx == atom.idx:
-                bondlist.append(i.atom1.idx+1)
-                # bondstring = bondstring + str(i.atom1.idx+1) + "\t"
-        if atom.name == "SS" and atom.residue.name == "CYX" and len(bondlist) \
-         < 2:
-            for atom2 in system.atoms:
-                if atom2.residue.name == "CYX" and atom2.name == "SS":
-                    ia_dist = interatomic_distance(atom,atom2)
-                    if ia_dist < 2 and ia_dist > 0:
-                        bondlist.append(atom2.idx)
-        bondlist.sort()
-        bondstring = ''.join(str('{:>8}'.format(x)) for x in bondlist)
-        index = atom.idx+1
-        name = atom.name
-        x = atom.xx
-        y = atom.xy
-        z = atom.xz
-        atomtype = atom.mass
-        linestring = "{:>6}  {:<4} {:>12.6f} {:>11.6f} {:>11.6f} {:>5}{}".\
-         format(str(index),str(name),x,y,z,str(atomtype),bondstring)
-        if atomtype == 0:
-            linestring = linestring + " ATOM TYPE NOT FOUND"
-        linestring = linestring + "\n"
-        f.write(linestring)
-    f.close()
+def convert_arrays(atoms, residues, type_index, res_classes, alias_table):
+    """convert_names for the arrays from read_pdb_arrays. Returns the TINKER
+    types as an array in atom order, with 0 where no match is found."""
+    print(
+    '''If I didn't find residues, they'll be listed here:
+    Residue Name | Atom Name | Search ResName | Search Atom Name
+    ''')
+    types = np.zeros(len(atoms), dtype=int)
+    template_cache = {}
+    for res in residues:
+        start, stop = res['start'], res['stop']
+        signature = (res['name'], tuple(atoms['name'][start:stop].tolist()))
+        res_types = template_cache.get(signature)
+        if res_types is None:
+            res_types = type_residue(signature[0], signature[1],
+             res['number'], type_index, res_classes, alias_table)
+            template_cache[signature] = res_types
+        types[start:stop] = res_types
+    print("Typed {} residues from {} unique residue templates.\n".format(
+     len(residues), len(template_cache)))
+    return types
 
 ## Begin function calls
-read_prm(param_file, atom_lines)
-
 try:
-    lines = fix_params(atom_lines,test_csv)
+    lines = load_params(param_file, test_csv, alias_file, prm_cache_dir)
 except pd.errors.ParserError:
     print("""
           ,-~~-.___.
@@ -953,11 +590,35 @@ except pd.errors.ParserError:
     """)
     sys.exit()
 
-system = load_pdb(infile)
+type_index = index_params(lines)
+
+renames = read_renames(rename_file, rename_kinds)
+
+res_classes, alias_table = build_aliases()
 
-system = convert_names(system, lines)
+if native_pdb:
+    atoms, residues, conect = read_pdb_arrays(infile)
+    bonds = assign_bonds_arrays(atoms, residues, conect)
+    clean_arrays(atoms, residues, renames)
+    types = convert_arrays(atoms, residues, type_index, res_classes,
+     alias_table)
+    names = atoms['name']
+    res_names = residues['name'][atoms['res_idx']]
+    coords = atoms['xyz']
+else:
+    system = load_pdb(infile, renames)
+    system = convert_names(system, type_index, res_classes, alias_table)
+    names, res_names, coords, types, bonds = structure_arrays(system)
 
-write_xyz(system, outfile)
+if batch_frames is None:
+    write_xyz_arrays(outfile, names, res_names, coords, types, bonds)
+else:
+    ## Check the frames against the names of infile as read
+    pdb_names, pdb_res_names, pdb_coords = next(read_pdb_models(infile))
+    bondstrings = xyz_bondstrings(names, res_names, coords, types, bonds)
+    frames = batch_coords(find_frames(batch_frames), infile, pdb_names,
+     pdb_res_names, batch_suffix)
+    convert_batch(frames, names, types, bondstrings, n_procs)
 
 # ## Write out the XYZ
 # system.save(outfile, overwrite=True)
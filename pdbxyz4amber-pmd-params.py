@@ -2,86 +2,126 @@
 import parmed as pmd
 import numpy as np
 import pandas as pd
+import hashlib
+import inspect
+import io
+import os
+import pickle
 import re
 import sys
+from pdbxyz_common import (read_renames, clean_names, read_pdb_arrays,
+ assign_bonds_arrays, clean_arrays, structure_arrays, xyz_bondstrings,
+ write_xyz_arrays, find_frames, read_pdb_models, batch_coords, convert_batch)
 
 infile="polk_2mGS_frame_139.pdb"
 outfile="polk_2mGS_frame_139_convert_ff14SB.xyz"
 
 param_file="amber-polk2mCTP-ff14SB.prm"
-atom_lines="atom-lines.txt"
+## A prm written with compact_types only has one atom line per merged type, so
+## give the .types file written next to it here to type the PDB with. Leave
+## as None to use the atom lines of param_file.
+type_map_file=None
+## Folder for the cached, fixed prm atom lines
+prm_cache_dir="prm-cache"
+## Optional CSV of extra search,replace aliases for the prm atom names
+alias_file="param-aliases.csv"
 
 test_csv="test.csv"
 
-def clean_atoms(temp):
-    ## Deal with C and N Terminals
-    ## If there's a terminal OXT for the protein, use as CTERM
-    for residue in temp.residues:
-        for atom in residue.atoms:
-            if atom.name == 'OXT':
-                residue.name = 'C'+residue.name
-            ## Standardize ions
-            ## If the +/- is last character, don't escape it.
-            elif atom.name in ('K+', 'K', 'K\+1', 'k', 'k+'):
-                atom.name = 'K'
-                residue.name = 'K'
-            elif atom.name in ('MG', 'MG2', 'MG2+', 'Mg2', 'MG\+2', 'Mg2+',
-             'Mg\+2'):
-                atom.name = 'MG'
-                residue.name = 'MG'
-            elif atom.name in ('ZN', 'ZN2', 'ZN2+', 'Zn2', 'ZN\+2', 'Zn2+',
-             'Zn\+2'):
-                atom.name = 'ZN'
-                residue.name = 'ZN'
-            elif atom.name in ('CL', 'CL-', 'CL1-', 'Cl', 'CL\-1', 'Cl1-',
-             'Cl\-1'):
-                atom.name = 'CL'
-                residue.name = 'CL'
-            else:
-                continue
-        ## If there's an H3 in a protein residue, use NTERM
-        if residue.name in ('ALA', 'ARG', 'ASN', 'ASP', 'CYS', 'CYX', 'GLN',
-         'GLU', 'GLY', 'HID', 'HIE', 'HIP', 'HIS', 'ILE', 'LEU', 'LYS', 'MET',
-         'PHE', 'PRO', 'SER', 'THR', 'TRP', 'TYR', 'VAL'):
-            for atom in residue.atoms:
-                if atom.name == 'H3':
-                    residue.name = 'N'+residue.name
+## Table of PDB atom and residue renames shared by both converters, kept
+## next to the scripts
+rename_file=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+ "pdb-renames.csv")
+## Kinds of renames from rename_file to use
+rename_kinds=("ion",)
+
+## Read and bond the PDB with the native reader instead of building a parmed
+## structure, which is much faster for large systems
+native_pdb=False
+
+## Batch mode: a glob or list of PDB frames (multi-model PDBs and DCDs work
+## too) with the same atoms as infile. infile is typed once and an XYZ is
+## written for every frame. Leave as None to only convert infile.
+batch_frames=None
+## Ending that replaces the frame file extension for its XYZ
+batch_suffix="_convert.xyz"
+## Number of processes writing the frames
+n_procs=os.cpu_count()
+
+def clean_atoms(temp, renames):
+    """Fix the atom and residue names of a parmed structure with
+    clean_names."""
+    names, res_names = clean_names([atom.name for atom in temp.atoms],
+     np.array([atom.residue.idx for atom in temp.atoms], dtype=int),
+     [residue.name for residue in temp.residues], renames)
+    for atom, name in zip(temp.atoms, names):
+        atom.name = name
+    for residue, res_name in zip(temp.residues, res_names):
+        residue.name = res_name
 
 
 ## Mercileslly taken from Mark's pdbtinker.py
-def load_pdb(filename):
+def load_pdb(filename, renames):
     """Loads in PDB using parmed and sets atom masses to zero. Atom masses are
     then used to store the Tinker atom types for XYZ conversion."""
     system = pmd.load_file(filename)
     for atom in system.atoms:
         atom.mass = 0
-    clean_atoms(system)
+    clean_atoms(system, renames)
     return system
 
-## grep "^atom" param_file > atom_lines
-def read_prm(param_file, atom_lines):
-    """Based on using grep to locate atom lines."""
-    parm_atom_lines = []
-    pattern = '(?i)^atom ' # case insensitive, starts line
-                           # keep the space to not match "atomic" in AMOEBA
-    for line in open(param_file).readlines():
-        if re.match(pattern, line):
-            parm_atom_lines.append(line)
-    ## Write a file of all the atom lines for use later
-    with open(atom_lines, 'w') as filehandle:
-        filehandle.writelines("%s" % line for line in parm_atom_lines)
-    filehandle.close()
+## grep "^atom" param_file
+def read_prm(param_file):
+    """Based on using grep to locate atom lines. Returns the list of atom
+    lines for fix_params."""
+    pattern = re.compile('(?i)^atom ') # case insensitive, starts line
+                    # keep the space to not match "atomic" in AMOEBA
+    with open(param_file) as prm_in:
+        parm_atom_lines = [line for line in prm_in if pattern.match(line)]
+    return parm_atom_lines
 
-def fix_params(atom_lines,test_csv):
-    """Read the atom_lines file into a pandas object. Rewrite the story
-    (quoted) section into PDB residue names and atom names through as series
-    of string replacements. This will work well for AMBER or AMOEBA sets."""
-    lines = pd.read_csv(atom_lines, sep='[\s]{2,}', header=None,
+def read_name_rules(alias_file):
+    """Read user-defined aliases for fix_params from a CSV file with a
+    `search,replace` header, like `DUP -Phosphate,CTP`. The search string is
+    a case-insensitive regular expression for the quoted part of the prm atom
+    lines, and the replace string is the ResName in the PDB. These are tried
+    before the built-in rules. Returns an empty list if there's no file."""
+    if not os.path.isfile(alias_file):
+        return []
+    aliases = pd.read_csv(alias_file, dtype=str, keep_default_na=False)
+    return [('(?i)'+search, replace) for search, replace in
+     zip(aliases['search'], aliases['replace'])]
+
+def normalize_names(names, name_rules):
+    """Apply the ordered (search, replace) name_rules to a pandas Series in
+    one pass. The rules are joined into a single regex alternation with one
+    named group per rule, and each match is swapped for the replacement of
+    the rule that matched. When two rules could match at the same spot, the
+    earlier one wins."""
+    patterns = []
+    replacements = {}
+    for i, (search, replace) in enumerate(name_rules):
+        ## Scope a leading (?i) to just this rule
+        if search.startswith('(?i)'):
+            search = '(?i:' + search[4:] + ')'
+        patterns.append('(?P<r{}>{})'.format(i, search))
+        replacements['r{}'.format(i)] = replace
+    name_regex = re.compile('|'.join(patterns))
+    return names.str.replace(name_regex,
+     lambda match: replacements[match.lastgroup], regex=True)
+
+def fix_params(atom_lines, test_csv, alias_file):
+    """Read the list of atom_lines into a pandas object. Rewrite the story
+    (quoted) section into PDB residue names and atom names with the ordered
+    name_rules (and any user aliases from alias_file), applied in a single
+    pass by normalize_names. This will work well for AMBER or AMOEBA sets."""
+    lines = pd.read_csv(io.StringIO(''.join(atom_lines)), sep='[\s]{2,}',
+     header=None,
      names=["what","T_type","T_atom_class","A_atom_type","A_names","element",
      "mass","connectivity"], engine='python')
     ##
     ## Remove the double quotes in the A_names column
-    lines.A_names = lines.A_names.replace({'"':''}, regex=True)
+    name_rules = [(r'"', '')]
     ##
     ## Determine if AMOEBA or AMBER based on aspartic acid
     ## While they vary by the space, this *should* check user-adjusted lines
@@ -91,46 +131,46 @@ def fix_params(atom_lines,test_csv):
     if trial.A_names.empty == False:
         print("Processing as AMOEBA parameters.")
         AMOEBA = True
-        # lines.A_names = lines.A_names.str.replace(r'(?i)XXX', 'YYY',
-        #   regex=True)
+        # name_rules.append((r'(?i)XXX', 'YYY'))
     else:
         print("Processing as AMBER parameters.")
         AMOEBA = False
     ##
     ## Replace names of special residues (use the ?i regex to ignore case)
-    #
-    # lines.A_names = lines.A_names.str.replace(r'(?i)XXX', 'YYY',
-    #   regex=True)
-    ##
-    ## The distributied TINKER params list incorrectly uses Glutamic Acid to
-    ## mean GLU NOT glutamate.
-    ## If you need the actual glutamic acid, you need to add params for GLH
-    ##
-    ## Now standardize the ions for string search
-    lines.A_names = lines.A_names.str.replace(r'(?i)Li\+', 'LI', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Na\+', 'NA', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)K\+', 'K', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Rb\+', 'RB', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Cs\+', 'CS', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Be\+', 'BE', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Mg\+2', 'MG', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Ca\+2', 'CA', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Zn\+2', 'ZN', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)F\-', 'F', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Cl\-', 'CL', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Br\-', 'BR', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)I\-', 'I', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Ba\+2', 'BA', regex=True)
-    lines.A_names = lines.A_names.str.replace(r'(?i)Sr\+2', 'SR', regex=True)
-    ##
-    ## User-defined
-    ## The search string is what is listed in the string of the prm file's
-    ## atom line for a given atom type and the replace string is the ResName
-    ## in the PDB
-    ##
-    ## From LEAPRC files
-    lines.A_names = lines.A_names.str.replace(r'(?i)TP3', 'WAT',
-      regex=True)
+    name_rules += [
+        # (r'(?i)XXX', 'YYY'),
+        ##
+        ## The distributied TINKER params list incorrectly uses Glutamic Acid
+        ## to mean GLU NOT glutamate.
+        ## If you need the actual glutamic acid, you need to add params for GLH
+        ##
+        ## Now standardize the ions for string search
+        (r'(?i)Li\+', 'LI'),
+        (r'(?i)Na\+', 'NA'),
+        (r'(?i)K\+', 'K'),
+        (r'(?i)Rb\+', 'RB'),
+        (r'(?i)Cs\+', 'CS'),
+        (r'(?i)Be\+', 'BE'),
+        (r'(?i)Mg\+2', 'MG'),
+        (r'(?i)Ca\+2', 'CA'),
+        (r'(?i)Zn\+2', 'ZN'),
+        (r'(?i)F\-', 'F'),
+        (r'(?i)Cl\-', 'CL'),
+        (r'(?i)Br\-', 'BR'),
+        (r'(?i)I\-', 'I'),
+        (r'(?i)Ba\+2', 'BA'),
+        (r'(?i)Sr\+2', 'SR'),
+        ##
+        ## User-defined
+        ## The search string is what is listed in the string of the prm file's
+        ## atom line for a given atom type and the replace string is the ResName
+        ## in the PDB
+        ##
+        ## From LEAPRC files
+        (r'(?i)TP3', 'WAT'),
+    ]
+    lines.A_names = normalize_names(lines.A_names,
+     read_name_rules(alias_file) + name_rules)
     ##
     ## Print the new lines for testing
     #lines.to_csv(test_csv, index=False, encoding='utf8')
@@ -143,101 +183,136 @@ def fix_params(atom_lines,test_csv):
     lines.to_csv(test_csv, index=False, encoding='utf8')
     return lines, AMOEBA
 
-def convert_names(system, lines, AMOEBA):
-    """For every atom, find lines matching the residue name in the
-    pandas_object. From those lines, check for lines that match the atom name.
-    If a match isn't found, check through the known naming problems. Update the
-    atom mass with the TINKER type if a match is found; if no match is found,
-    keep the atom mass as zero.
+def load_params(param_file, test_csv, alias_file, prm_cache_dir):
+    """Read and fix the prm atom lines, or load them from prm_cache_dir.
+    The cache file is named by the SHA-256 of the prm file, the alias_file
+    (if there is one), and the source of read_prm, read_name_rules,
+    normalize_names, and fix_params, so editing any of them makes a new
+    entry. Repeat conversions with the same force field skip read_prm and
+    fix_params entirely, but still rewrite test_csv."""
+    prm_hash = hashlib.sha256()
+    for hash_file in (param_file, alias_file):
+        if os.path.isfile(hash_file):
+            with open(hash_file, 'rb') as hash_in:
+                prm_hash.update(hash_in.read())
+    for function in (read_prm, read_name_rules, normalize_names, fix_params):
+        prm_hash.update(inspect.getsource(function).encode())
+    cache_file = os.path.join(prm_cache_dir, prm_hash.hexdigest()+".pkl")
+    if os.path.isfile(cache_file):
+        print("Using the cached atom types in {}.\n".format(cache_file))
+        with open(cache_file, 'rb') as cache_in:
+            lines, AMOEBA = pickle.load(cache_in)
+        ## Print the cached lines for testing, like fix_params does
+        lines.to_csv(test_csv, index=False, encoding='utf8')
+        return lines, AMOEBA
+    lines, AMOEBA = fix_params(read_prm(param_file), test_csv, alias_file)
+    os.makedirs(prm_cache_dir, exist_ok=True)
+    with open(cache_file, 'wb') as cache_out:
+        pickle.dump((lines, AMOEBA), cache_out)
+    return lines, AMOEBA
+
+def index_params(lines):
+    """Build a dictionary keyed by (ResName, AtomName) from the fixed atom
+    lines. Each value is a list of the matching TINKER types, so a lookup is a
+    single hash instead of filtering the whole table for every atom. More than
+    one type in a list means the parameter file has duplicate names."""
+    type_index = {}
+    for res_name, atom_name, t_type in zip(lines.ResName, lines.AtomName,
+     lines.T_type):
+        type_index.setdefault((res_name, atom_name), []).append(int(t_type))
+    return type_index
+
+def type_residue(res_name, atom_names, res_num, type_index):
+    """Resolve the TINKER type of every atom name in a residue. Atoms that
+    aren't found, or that have too many matches, are printed and given type 0.
+
+    Returns a list of the TINKER types in residue atom order.
+    """
+    res_types = []
+    for atom_name in atom_names:
+        test_name = atom_name
+        res_test = res_name
+        atom_test = type_index.get((res_test, test_name), [])
+        ## Address problem residues!
+        # if len(atom_test) == 0:
+        #     if res_name in ('AAA'):
+        #         test_RN = 'XXX'
+        #         test_name = 'J'
+        #         res_test = test_RN
+        #         atom_test = type_index.get((res_test, test_name), [])
+        #     elif res_name in ('BBB'):
+        #         test_RN = 'YYY'
+        #         test_name = 'K'
+        #         res_test = test_RN
+        #         atom_test = type_index.get((res_test, test_name), [])
+        #     ### And so on and so forth
+        if len(atom_test) == 0:
+            ## Prints out what you need to fix :)
+            print(res_name, atom_name, res_test, test_name)
+            res_types.append(0)
+        elif len(atom_test) > 1:
+            print("""
+            Oof, please check the parameter file.
+               I have too many matches...
+            """)
+            print(res_name, atom_name, "ResID:", res_num)
+            res_types.append(0)
+        else:
+            res_types.append(atom_test[0])
+    return res_types
+
+def convert_names(system, type_index, AMOEBA):
+    """For every residue, build its signature from the residue name and the
+    ordered atom names. The first residue with a given signature is typed
+    atom by atom through type_residue; every later copy, like the thousands
+    of waters, reuses that list of types. Update the atom mass with the
+    TINKER type if a match is found; if no match is found, keep the atom mass
+    as zero. Missing atoms are only listed for the first copy.
     """
     print(
     '''If I didn't find residues, they'll be listed here:
     Residue Name | Atom Name | Search ResName | Search Atom Name
     ''')
+    template_cache = {}
     for residue in system.residues:
-        for atom in residue.atoms:
-            test_name = atom.name
-            res_test = lines[lines.ResName == residue.name]
-            atom_test = res_test[res_test.AtomName == test_name]
-            ## Address problem residues!
-            # if atom_test.empty == True:
-            #     if residue.name in ('AAA'):
-            #         test_RN = 'XXX'
-            #         test_name = 'J'
-            #         res_test = lines[lines.ResName == test_RN]
-            #         atom_test = res_test[res_test.AtomName == test_name]
-            #     elif residue.name in ('BBB'):
-            #         test_RN = 'YYY'
-            #         test_name = 'K'
-            #         res_test = lines[lines.ResName == test_RN]
-            #         atom_test = res_test[res_test.AtomName == test_name]
-            #     ### And so on and so forth
-            if atom_test.empty == True:
-                ## Prints out what you need to fix :)
-                try:
-                    print(residue.name, atom.name, test_RN, test_name)
-                    atom.mass = int(0)
-                except UnboundLocalError:
-                    print(residue.name, atom.name, residue.name, test_name)
-                atom.mass = int(0)
-            else:
-                try:
-                    atom.mass += int(atom_test['T_type'])
-                except TypeError:
-                    print("""
-                    Oof, please check the parameter file.
-                       I have too many matches...
-                    """)
-                    print(residue.name, atom.name, "ResID:", residue.number)
-                # atom.mass += atom_test['T_type']
+        signature = (residue.name, tuple(atom.name for atom in residue.atoms))
+        res_types = template_cache.get(signature)
+        if res_types is None:
+            res_types = type_residue(residue.name, signature[1],
+             residue.number, type_index)
+            template_cache[signature] = res_types
+        for atom, atom_type in zip(residue.atoms, res_types):
+            atom.mass = atom_type
+    print("Typed {} residues from {} unique residue templates.\n".format(
+     len(system.residues), len(template_cache)))
     return system
 
-## Taken from Mark's PDBTinker
-def write_xyz(system, outfile):
-    ## Add XYZ extension
-    if outfile.split(".")[-1] != "xyz":
-        outfile = outfile+".xyz"
-    ## Write to outfile
-    f = open(outfile,"w+")
-    f.write(str(len(system.atoms))+"\n")
-    for atom in system.atoms:
-        bondstring = ""
-        bondlist = []
-        for i in atom.bonds:
-            if i.atom1.idx == atom.idx:
-                bondlist.append(i.atom2.idx+1)
-                # bondstring = bondstring + str(i.atom2.idx+1) + "\t"
-            elif i.atom2.idx == atom.idx:
-                bondlist.append(i.atom1.idx+1)
-                # bondstring = bondstring + str(i.atom1.idx+1) + "\t"
-        if atom.name == "SS" and atom.residue.name == "CYX" and len(bondlist) \
-         < 2:
-            for atom2 in system.atoms:
-                if atom2.residue.name == "CYX" and atom2.name == "SS":
-                    ia_dist = interatomic_distance(atom,atom2)
-                    if ia_dist < 2 and ia_dist > 0:
-                        bondlist.append(atom2.idx)
-        bondlist.sort()
-        bondstring = ''.join(str('{:>8}'.format(x)) for x in bondlist)
-        index = atom.idx+1
-        name = atom.name
-        x = atom.xx
-        y = atom.xy
-        z = atom.xz
-        atomtype = atom.mass
-        linestring = "{:>6}  {:<4} {:>12.6f} {:>11.6f} {:>11.6f} {:>5}{}".\
-         format(str(index),str(name),x,y,z,str(atomtype),bondstring)
-        if atomtype == 0:
-            linestring = linestring + " ATOM TYPE NOT FOUND"
-        linestring = linestring + "\n"
-        f.write(linestring)
-    f.close()
+def convert_arrays(atoms, residues, type_index):
+    """convert_names for the arrays from read_pdb_arrays. Returns the TINKER
+    types as an array in atom order, with 0 where no match is found."""
+    print(
+    '''If I didn't find residues, they'll be listed here:
+    Residue Name | Atom Name | Search ResName | Search Atom Name
+    ''')
+    types = np.zeros(len(atoms), dtype=int)
+    template_cache = {}
+    for res in residues:
+        start, stop = res['start'], res['stop']
+        signature = (res['name'], tuple(atoms['name'][start:stop].tolist()))
+        res_types = template_cache.get(signature)
+        if res_types is None:
+            res_types = type_residue(signature[0], signature[1],
+             res['number'], type_index)
+            template_cache[signature] = res_types
+        types[start:stop] = res_types
+    print("Typed {} residues from {} unique residue templates.\n".format(
+     len(residues), len(template_cache)))
+    return types
 
 ## Begin function calls
-read_prm(param_file, atom_lines)
-
 try:
-    lines, AMOEBA = fix_params(atom_lines,test_csv)
+    lines, AMOEBA = load_params(param_file if type_map_file is None else
+     type_map_file, test_csv, alias_file, prm_cache_dir)
 except pd.errors.ParserError:
     print("""
           ,-~~-.___.
@@ -252,11 +327,32 @@ except pd.errors.ParserError:
     """)
     sys.exit()
 
-system = load_pdb(infile)
+type_index = index_params(lines)
+
+renames = read_renames(rename_file, rename_kinds)
 
-system = convert_names(system, lines, AMOEBA)
+if native_pdb:
+    atoms, residues, conect = read_pdb_arrays(infile)
+    bonds = assign_bonds_arrays(atoms, residues, conect)
+    clean_arrays(atoms, residues, renames)
+    types = convert_arrays(atoms, residues, type_index)
+    names = atoms['name']
+    res_names = residues['name'][atoms['res_idx']]
+    coords = atoms['xyz']
+else:
+    system = load_pdb(infile, renames)
+    system = convert_names(system, type_index, AMOEBA)
+    names, res_names, coords, types, bonds = structure_arrays(system)
 
-write_xyz(system, outfile)
+if batch_frames is None:
+    write_xyz_arrays(outfile, names, res_names, coords, types, bonds)
+else:
+    ## Check the frames against the names of infile as read
+    pdb_names, pdb_res_names, pdb_coords = next(read_pdb_models(infile))
+    bondstrings = xyz_bondstrings(names, res_names, coords, types, bonds)
+    frames = batch_coords(find_frames(batch_frames), infile, pdb_names,
+     pdb_res_names, batch_suffix)
+    convert_batch(frames, names, types, bondstrings, n_procs)
 
 # ## Write out the XYZ
 # system.save(outfile, overwrite=True)
@@ -0,0 +1,523 @@
+"""Shared PDB reading, bonding, TINKER XYZ writing, and batch frame helpers
+for pdbxyz-for-amber.py and pdbxyz4amber-pmd-params.py, which import it from
+next to them."""
+import parmed as pmd
+import numpy as np
+import pandas as pd
+import glob
+import itertools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+def read_renames(rename_file, rename_kinds):
+    """Read the table of PDB renames shared by both converters. Each row has
+    the kind of rule, the PDB name to search for, and its replacement:
+    hydrogen rules rename atoms (ILE, LEU, ASN, THR, GLN, and VAL all have
+    screwy 4-letter hydrogens, as do ALL DNA residues), and ion rules rename
+    both the ion and its residue.
+
+    Returns a dictionary of each kind in rename_kinds to its search: replace
+    dictionary.
+    """
+    ## Don't read NA (sodium) as a missing value
+    renames = pd.read_csv(rename_file, dtype=str, keep_default_na=False)
+    return {kind: dict(zip(renames['search'][renames['kind'] == kind],
+     renames['replace'][renames['kind'] == kind])) for kind in rename_kinds}
+
+def clean_names(names, res_idx, res_names, renames):
+    """Fix the atom and residue names in one pass over the arrays, where
+    res_idx is the residue index of every atom. Atoms are renamed through the
+    hydrogen and ion lookups from read_renames, then the terminal residues are
+    found with per-residue groups.
+
+    Returns the fixed atom names and residue names.
+    """
+    names = pd.Series(names, dtype=object).replace(renames.get('hydrogen',
+     {}))
+    ## Standardize ions
+    ions = names.map(renames.get('ion', {}))
+    is_ion = ions.notna().to_numpy()
+    names = np.where(is_ion, ions, names).astype(object)
+    res_names = np.array(res_names, dtype=object)
+    ## Deal with C and N Terminals
+    ## If there's a terminal OXT for the protein, use as CTERM
+    cterm = np.unique(res_idx[names == 'OXT'])
+    res_names[cterm] = 'C'+res_names[cterm]
+    res_names[res_idx[is_ion]] = names[is_ion]
+    ## If there's an H3 in a protein residue, use NTERM
+    nterm = np.unique(res_idx[names == 'H3'])
+    nterm = nterm[np.isin(res_names[nterm], ['ALA', 'ARG', 'ASN', 'ASP',
+     'CYS', 'CYX', 'GLN', 'GLU', 'GLY', 'HID', 'HIE', 'HIP', 'HIS', 'ILE',
+     'LEU', 'LYS', 'MET', 'PHE', 'PRO', 'SER', 'THR', 'TRP', 'TYR', 'VAL'])]
+    res_names[nterm] = 'N'+res_names[nterm]
+    return names, res_names
+
+def read_pdb_arrays(filename):
+    """Read the ATOM/HETATM, TER, and CONECT records of a PDB by
+    their fixed columns straight into numpy arrays, without building a parmed
+    structure. Only the first model is read, and only the first alternate
+    location of an atom is kept.
+
+    Returns a structured array of the atoms, a structured array of the
+    residues (with the start and stop atom of each), and an (N, 2) array of
+    the CONECT bonds as atom indices.
+    """
+    atom_rows = []
+    res_rows = []
+    conect = []
+    serials = {}
+    last_res = None
+    with open(filename) as pdb_in:
+        for line in pdb_in:
+            record = line[:6].strip()
+            if record in ('ATOM', 'HETATM'):
+                if line[16] not in (' ', 'A'):
+                    continue
+                res_id = (line[17:21].strip(), line[21].strip(),
+                 line[22:27])
+                if res_id != last_res:
+                    try:
+                        res_num = int(line[22:26])
+                    except ValueError:
+                        res_num = res_rows[-1][2]+1 if res_rows else 1
+                    res_rows.append([res_id[0], res_id[1], res_num,
+                     len(atom_rows), 0, False])
+                    last_res = res_id
+                name = line[12:16].strip()
+                element = line[76:78].strip()
+                element = element[:1].upper() + element[1:].lower()
+                if element not in pmd.periodic_table.AtomicNum:
+                    element = pmd.periodic_table.element_by_name(name)
+                serials[line[6:11].strip()] = len(atom_rows)
+                atom_rows.append((name, len(res_rows)-1,
+                 pmd.periodic_table.AtomicNum[element],
+                 (float(line[30:38]), float(line[38:46]),
+                 float(line[46:54]))))
+            elif record == 'TER':
+                if res_rows:
+                    res_rows[-1][5] = True
+                last_res = None
+            elif record == 'CONECT':
+                origin = serials.get(line[6:11].strip())
+                for col in range(11, 31, 5):
+                    partner = serials.get(line[col:col+5].strip())
+                    if origin is not None and partner is not None:
+                        conect.append((origin, partner))
+            elif record in ('ENDMDL', 'END'):
+                break
+    atoms = np.array(atom_rows, dtype=[('name', 'U4'), ('res_idx', int),
+     ('atomic_number', int), ('xyz', float, (3,))])
+    residues = np.array([tuple(row) for row in res_rows], dtype=[('name',
+     'U6'), ('chain', 'U1'), ('number', int), ('start', int), ('stop', int),
+     ('ter', bool)])
+    residues['stop'] = np.append(residues['start'][1:], len(atoms))
+    return atoms, residues, np.array(conect, dtype=int).reshape(-1, 2)
+
+def find_template(res_name, templates):
+    """Find the parmed residue template for a residue name, including the
+    amino acid and nucleic acid aliases parmed knows about."""
+    if res_name in templates:
+        return templates[res_name]
+    if len(res_name) == 3 and pmd.residue.AminoAcidResidue.has(res_name):
+        return templates[pmd.residue.AminoAcidResidue.get(res_name).abbr]
+    if pmd.residue.DNAResidue.has(res_name):
+        return templates[pmd.residue.DNAResidue.get(res_name).abbr]
+    if (pmd.residue.RNAResidue.has(res_name) and
+     pmd.residue.RNAResidue.get(res_name).abbr != 'T'):
+        return templates[pmd.residue.RNAResidue.get(res_name).abbr]
+    return None
+
+def template_bonds(template, atom_names):
+    """Bond the atoms of one residue from its template. Returns an (N, 2)
+    array of the bonded atom positions in the residue, and a mask of the
+    atoms that aren't in the template (all of them if there's no template)."""
+    if template is None:
+        return np.empty((0, 2), dtype=int), np.ones(len(atom_names), bool)
+    position = {name: i for i, name in enumerate(atom_names)}
+    res_bonds = []
+    for i, name in enumerate(atom_names):
+        if name not in template.map:
+            continue
+        for partner in template.map[name].bond_partners:
+            j = position.get(partner.name)
+            if j is not None and i < j:
+                res_bonds.append((i, j))
+    missing = np.array([name not in template.map for name in atom_names],
+     dtype=bool)
+    return np.array(res_bonds, dtype=int).reshape(-1, 2), missing
+
+def find_close_pairs(coords, query, candidates, cutoff):
+    """Find every (query, candidate) atom pair closer than the cutoff. The
+    candidates are sorted into a grid of cutoff-sized cells, so each query
+    atom only checks the 27 cells around it.
+
+    Returns the query atom indices, candidate atom indices, and squared
+    distances of the pairs.
+    """
+    cells = np.floor(coords/cutoff).astype(int)
+    cells -= cells.min(axis=0)
+    ## Pad the grid by a cell on every side so neighbor keys never wrap
+    dims = cells.max(axis=0)+3
+    keys = ((cells[:, 0]+1)*dims[1] + cells[:, 1]+1)*dims[2] + cells[:, 2]+1
+    order = candidates[np.argsort(keys[candidates], kind='stable')]
+    sorted_keys = keys[order]
+    pair_i = []
+    pair_j = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            for dz in (-1, 0, 1):
+                cell_keys = keys[query] + (dx*dims[1] + dy)*dims[2] + dz
+                lo = np.searchsorted(sorted_keys, cell_keys, 'left')
+                hi = np.searchsorted(sorted_keys, cell_keys, 'right')
+                counts = hi-lo
+                pair_i.append(np.repeat(query, counts))
+                pair_j.append(order[np.arange(counts.sum()) - np.repeat(
+                 np.cumsum(counts)-counts, counts) + np.repeat(lo, counts)])
+    pair_i = np.concatenate(pair_i)
+    pair_j = np.concatenate(pair_j)
+    dist2 = ((coords[pair_i] - coords[pair_j])**2).sum(axis=1)
+    keep = (pair_i != pair_j) & (dist2 < cutoff**2)
+    return pair_i[keep], pair_j[keep], dist2[keep]
+
+def assign_bonds_arrays(atoms, residues, conect):
+    """Bond the atoms from read_pdb_arrays the way parmed does when it loads
+    a PDB: standard residues are bonded from parmed's residue templates (each
+    unique residue is only matched once), consecutive residues are joined
+    head to tail unless a TER card, chain change, or numbering gap splits
+    them, and atoms without a template are bonded by distance. The CONECT
+    bonds are kept too.
+
+    Returns an (N, 2) array of the unique bonds as atom indices.
+    """
+    templates = pmd.modeller.StandardBiomolecularResidues
+    names = atoms['name']
+    coords = atoms['xyz']
+    n_atoms = len(atoms)
+    atomic_numbers = atoms['atomic_number']
+    ## Squared bond cutoffs for every pair of atomic numbers
+    bond_lengths2 = pmd.structure.STANDARD_BOND_LENGTHS_SQUARED
+    max_bond2 = np.full((119, 119), bond_lengths2.default_factory())
+    for (z1, z2), bond2 in bond_lengths2.items():
+        max_bond2[z1, z2] = bond2
+    bonds = [conect]
+    unassigned = np.zeros(n_atoms, dtype=bool)
+    no_template = np.zeros(n_atoms, dtype=bool)
+    res_templates = []
+    res_cache = {}
+    for res in residues:
+        start, stop = res['start'], res['stop']
+        signature = (res['name'], tuple(names[start:stop].tolist()))
+        cached = res_cache.get(signature)
+        if cached is None:
+            template = find_template(res['name'], templates)
+            cached = (template,) + template_bonds(template, signature[1])
+            res_cache[signature] = cached
+        template, res_bonds, missing = cached
+        res_templates.append(template)
+        bonds.append(res_bonds+start)
+        unassigned[start:stop] = missing
+        no_template[start:stop] = template is None
+    ## Join each residue's tail to the next residue's head
+    for i in range(len(residues)-1):
+        res, next_res = residues[i], residues[i+1]
+        template, next_template = res_templates[i], res_templates[i+1]
+        if res['ter'] or (res['chain'] and res['chain'] != next_res['chain']):
+            continue
+        if next_res['number'] != res['number']+1:
+            continue
+        if template is None and next_template is None:
+            continue
+        if template is not None and template.tail is None:
+            continue
+        if next_template is not None and next_template.head is None:
+            continue
+        res_atoms = np.arange(res['start'], res['stop'])
+        next_atoms = np.arange(next_res['start'], next_res['stop'])
+        tail = res_atoms
+        head = next_atoms
+        if template is not None:
+            tail = res_atoms[names[res_atoms] == template.tail.name][:1]
+        if next_template is not None:
+            head = next_atoms[names[next_atoms] == next_template.head.name][:1]
+        if len(tail) == 0 or len(head) == 0:
+            continue
+        if template is not None and next_template is not None:
+            bonds.append(np.array([[tail[0], head[0]]]))
+            continue
+        ## Without both templates, bond to the first atom in bonding distance
+        pair_i, pair_j = np.meshgrid(tail, head, indexing='ij')
+        pair_i, pair_j = pair_i.ravel(), pair_j.ravel()
+        dist2 = ((coords[pair_i] - coords[pair_j])**2).sum(axis=1)
+        close = np.flatnonzero(dist2 < max_bond2[atomic_numbers[pair_i],
+         atomic_numbers[pair_j]])
+        if len(close) > 0:
+            bonds.append(np.array([[pair_i[close[0]], pair_j[close[0]]]]))
+    bonds = np.concatenate(bonds).reshape(-1, 2)
+    ## CYS sulfurs with a single bond are often crosslinked, so check them by
+    ## distance too
+    n_bonded = np.bincount(bonds.ravel(), minlength=n_atoms)
+    cys_sg = np.zeros(n_atoms, dtype=bool)
+    for i, res in enumerate(residues):
+        if (len(res['name']) != 3 or not
+         pmd.residue.AminoAcidResidue.has(res['name']) or
+         pmd.residue.AminoAcidResidue.get(res['name']).abbr != 'CYS'):
+            continue
+        res_atoms = np.arange(res['start'], res['stop'])
+        sg = res_atoms[names[res_atoms] == 'SG'][:1]
+        if len(sg) > 0 and n_bonded[sg[0]] < 2:
+            cys_sg[sg] = True
+    unassigned |= cys_sg
+    ## Bond the leftover atoms to each other by distance, and to the rest of
+    ## their residue if it had a template
+    query = np.flatnonzero(unassigned)
+    if len(query) > 0:
+        cutoff = np.sqrt(max(bond_lengths2.values()))
+        pair_i, pair_j, dist2 = find_close_pairs(coords, query, query, cutoff)
+        in_res = ~no_template[query] & ~cys_sg[query]
+        res_i, res_j, res_dist2 = find_close_pairs(coords, query[in_res],
+         np.arange(n_atoms), cutoff)
+        same_res = atoms['res_idx'][res_i] == atoms['res_idx'][res_j]
+        pair_i = np.concatenate((pair_i, res_i[same_res]))
+        pair_j = np.concatenate((pair_j, res_j[same_res]))
+        dist2 = np.concatenate((dist2, res_dist2[same_res]))
+        close = dist2 < max_bond2[atomic_numbers[pair_i],
+         atomic_numbers[pair_j]]
+        bonds = np.concatenate((bonds, np.column_stack((pair_i[close],
+         pair_j[close]))))
+    bonds = np.sort(bonds, axis=1)
+    return np.unique(bonds[bonds[:, 0] != bonds[:, 1]], axis=0)
+
+def clean_arrays(atoms, residues, renames):
+    """Fix the atom and residue names from read_pdb_arrays in place with
+    clean_names."""
+    atoms['name'], residues['name'] = clean_names(atoms['name'],
+     atoms['res_idx'], residues['name'], renames)
+
+def find_disulfides(names, res_names, coords, cutoff=2.0):
+    """Find disulfide partners for the CYX sulfurs. The sulfur coordinates
+    are binned into a grid of cutoff-sized cells, so each sulfur only checks
+    the 27 cells around it instead of every atom in the system.
+
+    Returns a dictionary of sulfur atom index to a list of the partner atom
+    indices within the cutoff, closest first.
+    """
+    ss_idx = np.flatnonzero((names == "SS") & (res_names == "CYX"))
+    ss_coords = coords[ss_idx]
+    ss_cells = np.floor(ss_coords/cutoff).astype(int)
+    cells = {}
+    for i, cell in enumerate(ss_cells):
+        cells.setdefault(tuple(cell), []).append(i)
+    ss_partners = {}
+    for i, (cx, cy, cz) in enumerate(ss_cells):
+        found = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for dz in (-1, 0, 1):
+                    for j in cells.get((cx+dx, cy+dy, cz+dz), []):
+                        ia_dist = np.linalg.norm(ss_coords[i] - ss_coords[j])
+                        if ia_dist < cutoff and ia_dist > 0:
+                            found.append((ia_dist, ss_idx[j]))
+        found.sort()
+        ss_partners[ss_idx[i]] = [idx for ia_dist, idx in found]
+    return ss_partners
+
+def build_adjacency(n_atoms, bond_from, bond_to):
+    """Build a compressed sparse row (CSR) neighbor list from directed bond
+    arrays. The neighbors of atom i are indices[indptr[i]:indptr[i+1]],
+    sorted by atom index."""
+    order = np.lexsort((bond_to, bond_from))
+    indices = bond_to[order]
+    indptr = np.zeros(n_atoms+1, dtype=int)
+    np.cumsum(np.bincount(bond_from, minlength=n_atoms), out=indptr[1:])
+    return indptr, indices
+
+def structure_arrays(system):
+    """Pull the atom names, residue names, coordinates, TINKER types (stored
+    as the atom masses), and bonds out of a parmed structure as flat arrays
+    for write_xyz_arrays."""
+    names = np.array([atom.name for atom in system.atoms], dtype=object)
+    res_names = np.array([atom.residue.name for atom in system.atoms],
+     dtype=object)
+    coords = np.array([[atom.xx, atom.xy, atom.xz] for atom in system.atoms],
+     dtype=float).reshape(-1, 3)
+    types = np.array([atom.mass for atom in system.atoms], dtype=int)
+    bonds = np.array([[bond.atom1.idx, bond.atom2.idx] for bond in
+     system.bonds], dtype=int).reshape(-1, 2)
+    return names, res_names, coords, types, bonds
+
+def xyz_bondstrings(names, res_names, coords, types, bonds):
+    """Format the bond columns of every TINKER XYZ line from flat atom arrays
+    and an (N, 2) array of bonded atom indices. The bonds are turned into a
+    CSR neighbor list once and every bond string is built in a single pass.
+
+    Returns the list of bond strings, with the missing type flag added.
+    """
+    n_atoms = len(names)
+    bond_from = np.concatenate((bonds[:, 0], bonds[:, 1]))
+    bond_to = np.concatenate((bonds[:, 1], bonds[:, 0]))
+    ## Bond CYX sulfurs missing their disulfide to the closest partner
+    n_bonded = np.bincount(bond_from, minlength=n_atoms)
+    ss_from = []
+    ss_to = []
+    for idx, partners in find_disulfides(names, res_names, coords).items():
+        if n_bonded[idx] >= 2 or len(partners) == 0:
+            continue
+        if len(partners) > 1:
+            print("WARNING! CYX atom {} {} has {} possible disulfide partners"
+             " (atoms {}). Bonding it to the closest one, {}.".format(idx+1,
+             names[idx], len(partners),
+             ' '.join(str(ss+1) for ss in partners), partners[0]+1))
+        if partners[0] not in bond_to[bond_from == idx]:
+            ss_from.append(idx)
+            ss_to.append(partners[0])
+    bond_from = np.concatenate((bond_from, np.array(ss_from, dtype=int)))
+    bond_to = np.concatenate((bond_to, np.array(ss_to, dtype=int)))
+    indptr, indices = build_adjacency(n_atoms, bond_from, bond_to)
+    ## Lay the formatted bond columns out in an (atoms, max bonds) table and
+    ## add the table columns together to get every bond string at once
+    n_bonds = np.diff(indptr)
+    bond_cols = np.char.rjust((indices+1).astype(str), 8)
+    bond_table = np.full((n_atoms, max(n_bonds.max(initial=0), 1)), '',
+     dtype=bond_cols.dtype)
+    bond_table[np.repeat(np.arange(n_atoms), n_bonds),
+     np.arange(len(indices)) - np.repeat(indptr[:-1], n_bonds)] = bond_cols
+    bondstrings = bond_table[:, 0]
+    for col in range(1, bond_table.shape[1]):
+        bondstrings = np.char.add(bondstrings, bond_table[:, col])
+    bondstrings = np.char.add(bondstrings, np.where(types == 0,
+     " ATOM TYPE NOT FOUND", ""))
+    return bondstrings.tolist()
+
+def write_xyz_frame(outfile, names, coords, types, bondstrings):
+    """Write a TINKER XYZ with the bond strings from xyz_bondstrings. Frames
+    that share a topology only need their coordinates formatted."""
+    ## Add XYZ extension
+    if outfile.split(".")[-1] != "xyz":
+        outfile = outfile+".xyz"
+    n_atoms = len(names)
+    linestrings = ["%6d  %-4s %12.6f %11.6f %11.6f %5d" % line for line in
+     zip(range(1, n_atoms+1), names.tolist(), coords[:, 0].tolist(),
+     coords[:, 1].tolist(), coords[:, 2].tolist(), types.tolist())]
+    ## Write to outfile
+    with open(outfile, "w+") as f:
+        f.write(str(n_atoms)+"\n")
+        f.write(''.join([line+bondstring+"\n" for line, bondstring in
+         zip(linestrings, bondstrings)]))
+
+def write_xyz_arrays(outfile, names, res_names, coords, types, bonds):
+    """Write a TINKER XYZ from flat atom arrays and an (N, 2) array of bonded
+    atom indices."""
+    write_xyz_frame(outfile, names, coords, types, xyz_bondstrings(names,
+     res_names, coords, types, bonds))
+
+def find_frames(batch_frames):
+    """Expand the batch_frames setting (a glob or a list of file names and
+    globs) into a sorted list of frame files for each entry."""
+    if isinstance(batch_frames, str):
+        batch_frames = [batch_frames]
+    frame_files = []
+    for pattern in batch_frames:
+        frame_files += sorted(glob.glob(pattern)) or [pattern]
+    return frame_files
+
+def read_pdb_models(filename):
+    """Yield the atom names, residue names, and coordinates of every model in
+    a PDB, read by the same columns as read_pdb_arrays."""
+    names, res_names, coords = [], [], []
+    with open(filename) as pdb_in:
+        for line in pdb_in:
+            record = line[:6].strip()
+            if record in ('ATOM', 'HETATM'):
+                if line[16] not in (' ', 'A'):
+                    continue
+                names.append(line[12:16].strip())
+                res_names.append(line[17:21].strip())
+                coords.append((float(line[30:38]), float(line[38:46]),
+                 float(line[46:54])))
+            elif record in ('ENDMDL', 'END') and names:
+                yield np.array(names), np.array(res_names), np.array(coords,
+                 dtype=float)
+                names, res_names, coords = [], [], []
+    if names:
+        yield np.array(names), np.array(res_names), np.array(coords,
+         dtype=float)
+
+def read_dcd_frames(filename):
+    """Yield the coordinates of every frame in a DCD trajectory. Needs
+    MDAnalysis, which is only imported for DCD batches."""
+    from MDAnalysis.coordinates.DCD import DCDReader
+    with DCDReader(filename) as dcd:
+        for ts in dcd:
+            yield ts.positions.astype(float)
+
+def batch_coords(frame_files, pdb_file, pdb_names, pdb_res_names,
+ batch_suffix):
+    """Yield the output XYZ name and coordinates of every frame in the batch.
+    Each PDB model has to have the same atom and residue names in the same
+    order as the typed PDB, and each DCD frame the same number of atoms;
+    frames that don't are skipped with a warning."""
+    for frame_file in frame_files:
+        stem = os.path.splitext(frame_file)[0]
+        if frame_file.lower().endswith('.dcd'):
+            for i, coords in enumerate(read_dcd_frames(frame_file)):
+                if len(coords) != len(pdb_names):
+                    print("WARNING! Skipping frame {} of {}: it has {} atoms"
+                     " instead of {}.".format(i+1, frame_file, len(coords),
+                     len(pdb_names)))
+                    continue
+                yield "{}_{}{}".format(stem, i+1, batch_suffix), coords
+            continue
+        models = read_pdb_models(frame_file)
+        ## Only number the XYZs of PDBs with more than one model
+        first_models = list(itertools.islice(models, 2))
+        for i, (names, res_names, coords) in enumerate(itertools.chain(
+         first_models, models)):
+            outfile = stem+batch_suffix
+            if len(first_models) > 1:
+                outfile = "{}_{}{}".format(stem, i+1, batch_suffix)
+            if (len(names) != len(pdb_names) or
+             np.any(names != pdb_names) or np.any(res_names != pdb_res_names)):
+                print("WARNING! Skipping {}: its atoms don't match the order"
+                 " of {}.".format(outfile, pdb_file))
+                continue
+            yield outfile, coords
+
+def set_frame_topology(names, types, bondstrings):
+    """Keep the shared topology in each worker process for write_frame."""
+    global frame_topology
+    frame_topology = (names, types, bondstrings)
+
+def write_frame(outfile, coords):
+    """Write one batch frame with the worker's shared topology."""
+    names, types, bondstrings = frame_topology
+    write_xyz_frame(outfile, names, coords, types, bondstrings)
+
+def convert_batch(frames, names, types, bondstrings, n_procs):
+    """Write a TINKER XYZ for every (outfile, coords) frame with the typed
+    topology. The frames are written by a pool of forked processes that
+    inherit the topology, with only a few frames in flight at a time so a
+    long trajectory isn't held in memory. Without fork, or with n_procs=1,
+    the frames are written one after another."""
+    n_written = 0
+    if n_procs > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        with ProcessPoolExecutor(n_procs,
+         mp_context=multiprocessing.get_context('fork'),
+         initializer=set_frame_topology,
+         initargs=(names, types, bondstrings)) as pool:
+            pending = set()
+            for outfile, coords in frames:
+                if len(pending) >= 2*n_procs:
+                    done, pending = wait(pending,
+                     return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                pending.add(pool.submit(write_frame, outfile, coords))
+                n_written += 1
+            for future in wait(pending)[0]:
+                future.result()
+    else:
+        for outfile, coords in frames:
+            write_xyz_frame(outfile, names, coords, types, bondstrings)
+            n_written += 1
+    print("Wrote {} XYZ frames.".format(n_written))